@@ -0,0 +1,207 @@
+"""
+Logging pipeline that keeps disk and console I/O off the request thread.
+
+Loggers write to QueuedHandler, which only puts records on an in-memory queue.
+A QueueListener thread drains it into the real handlers (console and the
+rotating file), so a request pays for building a record and nothing more.
+When the queue is full, records are dropped rather than blocking the caller,
+and counted in the letterflow_log_records_dropped_total metric.
+
+Records are written as one JSON object per line by JSONFormatter, and noisy
+loggers can be sampled with SamplingFilter. Warnings and errors are always
+kept.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _get_handler(name):
+    # logging.getHandlerByName() from Python 3.12
+    getter = getattr(logging, 'getHandlerByName', None)
+    return getter(name) if getter else logging._handlers.get(name)
+
+
+class QueuedHandler(QueueHandler):
+    """
+    Hand records to a background thread that feeds `handlers`.
+
+    `handlers` are the names of other handlers in the same LOGGING config.
+    dictConfig builds handlers in name order, so they must sort before this
+    one's name.
+    """
+
+    def __init__(self, handlers, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        targets = []
+        for name in handlers:
+            handler = _get_handler(name)
+            if handler is None:
+                raise ValueError(f'Handler {name!r} must be configured before the queued handler')
+            targets.append(handler)
+        # Records dropped because the queue was full
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, *targets, respect_handler_level=True)
+        self.listener.start()
+        self._listening = True
+        atexit.register(self.stop)
+
+    def prepare(self, record):
+        """
+        Freeze the record for the listener thread. The traceback is kept apart
+        from the message so formatters can still write it as its own field.
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        for key, value in vars(record).items():
+            # Objects passed in `extra` (like django.request's request) are
+            # rendered now, while they still belong to this thread
+            if key not in RECORD_ATTRS and not isinstance(value, (str, int, float, bool, type(None))):
+                setattr(record, key, str(value))
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            # Imported on first drop, so configuring logging does not load Django
+            from .metrics import LOG_RECORDS_DROPPED
+            LOG_RECORDS_DROPPED.inc(handler=self.name or '-')
+
+    def stop(self):
+        """Flush what is queued and stop the listener thread"""
+        if self._listening:
+            self._listening = False
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with any `extra` fields alongside the standard ones"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'process': record.process,
+            'thread': record.thread,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS and key not in entry:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of the INFO and DEBUG records of chosen loggers.
+
+    `rates` maps logger names to the fraction kept (0 to 1); a logger without
+    an entry uses its closest configured parent, and 1 otherwise.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self._resolved = {}
+
+    def rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            lookup = name
+            while lookup not in self.rates and '.' in lookup:
+                lookup = lookup.rsplit('.', 1)[0]
+            rate = self._resolved[name] = self.rates.get(lookup, 1.0)
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class SizeAndTimeRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    Rotate on the TimedRotatingFileHandler schedule, and early whenever the
+    file reaches `max_bytes`.
+
+    Rotated files keep the time suffix; further rotations in the same period
+    add `.001`, `.002` and so on, always one past the highest counter of that
+    period. The `backupCount` pruning orders files by period and counter, so
+    it always deletes the oldest. Rotation is per process, so give each
+    process its own file when several of them log to disk.
+    """
+
+    def __init__(self, filename, max_bytes=0, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if not self.max_bytes:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.max_bytes
+
+    def rotated_files(self):
+        """(time suffix, counter, path) of each rotated file, oldest first"""
+        directory, base = os.path.split(self.baseFilename)
+        prefix = base + '.'
+        found = []
+        for filename in os.listdir(directory):
+            if not filename.startswith(prefix):
+                continue
+            suffix, _, counter = filename[len(prefix):].partition('.')
+            if counter and not counter.isdigit():
+                continue
+            try:
+                when = time.strptime(suffix, self.suffix)
+            except ValueError:
+                continue
+            found.append((when, suffix, int(counter or 0), os.path.join(directory, filename)))
+        found.sort()
+        return [(suffix, counter, path) for _, suffix, counter, path in found]
+
+    def rotation_filename(self, default_name):
+        name = super().rotation_filename(default_name)
+        suffix = name[len(self.baseFilename) + 1:]
+        counters = [counter for found, counter, _ in self.rotated_files() if found == suffix]
+        if not counters:
+            return name
+        return f'{name}.{max(counters) + 1:03d}'
+
+    def getFilesToDelete(self):
+        rotated = self.rotated_files()
+        return [path for _, _, path in rotated[:max(len(rotated) - self.backupCount, 0)]]
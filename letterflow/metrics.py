@@ -0,0 +1,362 @@
+"""
+In-process metrics, exported in the Prometheus text format at /metrics/.
+
+Counters and histograms are dictionaries in each process, updated under a
+lock, so recording a value costs a dictionary update. Gunicorn runs several
+worker processes, and each one writes its values to its own file in
+METRICS_DIR (named by host, pid and a random token, so a reused pid never
+overwrites an earlier worker's file) at most every METRICS_FLUSH_INTERVAL
+seconds and on exit. The endpoint adds up the files of every process. Files
+of processes that have exited are folded into merged.json and removed, so
+totals do not go back when a worker is replaced and old files do not pile
+up. Without METRICS_DIR the endpoint only sees the process that serves it.
+
+Access needs `Authorization: Bearer <METRICS_TOKEN>` or an admin session.
+"""
+import atexit
+import bisect
+import fcntl
+import hmac
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseForbidden
+
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # label values -> total
+        self.values = {}
+        _metrics[name] = self
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+    def merge(self, values, rows):
+        for key, value in rows:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values):
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labelnames, key)} {_number(value)}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (the last is +Inf), sum]
+        self.values = {}
+        _metrics[name] = self
+
+    def observe(self, amount, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, amount)
+        with _lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += amount
+
+    def snapshot(self):
+        return [[list(key), list(entry)] for key, entry in self.values.items()]
+
+    def merge(self, values, rows):
+        for key, entry in rows:
+            key = tuple(key)
+            if len(entry) != len(self.buckets) + 2:
+                # Written by a process with other buckets
+                continue
+            total = values.setdefault(key, [0] * len(entry))
+            for index, value in enumerate(entry):
+                total[index] += value
+
+    def render(self, values):
+        for key, entry in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry[:-1]):
+                cumulative += count
+                labels = _labels(self.labelnames + ('le',), key + (_number(bound),))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_number(entry[-1])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_LATENCY = Histogram(
+    'letterflow_http_request_duration_seconds',
+    'Time to build a response, up to the last chunk for streamed ones, by URL name.',
+    ('view', 'method'), LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    'letterflow_http_requests_total', 'Responses sent, by URL name and status code.',
+    ('view', 'method', 'status'),
+)
+DB_QUERIES = Counter(
+    'letterflow_db_queries_total', 'SQL statements run while handling requests, by URL name.',
+    ('view',),
+)
+DB_TIME = Counter(
+    'letterflow_db_query_seconds_total', 'Time spent in SQL statements while handling requests, by URL name.',
+    ('view',),
+)
+CACHE_LOOKUPS = Counter(
+    'letterflow_cache_lookups_total', 'Application cache lookups, by cache and result (hit or miss).',
+    ('cache', 'result'),
+)
+SHIPMENTS_CREATED = Counter(
+    'letterflow_shipments_created_total', 'Shipments created, by direction.',
+    ('direction',),
+)
+SHIPMENT_TRANSITIONS = Counter(
+    'letterflow_shipment_transitions_total', 'Shipment status transitions applied, by new status.',
+    ('status',),
+)
+PACKAGES_RECEIVED = Counter(
+    'letterflow_packages_received_total', 'Packages recorded as received when shipments are confirmed.',
+)
+DISCREPANCIES = Counter(
+    'letterflow_discrepancies_total', 'Shipment items confirmed with a quantity that differs from the plan.',
+)
+LOG_RECORDS_DROPPED = Counter(
+    'letterflow_log_records_dropped_total', 'Log records dropped because the logging queue was full, by handler.',
+    ('handler',),
+)
+
+
+def inc_on_commit(counter, amount=1, using=None, **labels):
+    """Count once the current transaction commits, so rolled back work is not counted"""
+    if amount:
+        transaction.on_commit(lambda: counter.inc(amount, **labels), using=using)
+
+
+def snapshot():
+    with _lock:
+        return {name: metric.snapshot() for name, metric in _metrics.items()}
+
+
+MERGED_FILENAME = 'merged.json'
+
+_last_flush = 0.0
+# <host>_<pid>_<random>: a later process reusing the pid gets its own file
+_file_stem = None
+
+
+def _own_file_stem():
+    global _file_stem
+    if _file_stem is None:
+        _file_stem = f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:12]}'
+    return _file_stem
+
+
+def _after_fork():
+    """A forked worker starts from zero in a file of its own"""
+    global _file_stem, _last_flush
+    _file_stem = None
+    _last_flush = 0.0
+    for metric in _metrics.values():
+        metric.values = {}
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _write_json(directory, filename, data):
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(handle, 'w') as temp:
+        json.dump(data, temp)
+    # Readers only ever see a complete file
+    os.replace(temp_path, os.path.join(directory, filename))
+
+
+def _read_json(path):
+    try:
+        with open(path) as source:
+            return json.load(source)
+    except (OSError, ValueError):
+        return None
+
+
+def flush(force=False):
+    """Write this process's values to METRICS_DIR, at most every METRICS_FLUSH_INTERVAL seconds"""
+    global _last_flush
+    directory = getattr(settings, 'METRICS_DIR', '')
+    now = time.monotonic()
+    if not directory or (not force and now - _last_flush < getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)):
+        return
+    _last_flush = now
+    os.makedirs(directory, exist_ok=True)
+    _write_json(directory, f'{_own_file_stem()}.json', snapshot())
+
+
+atexit.register(flush, force=True)
+
+
+def _has_exited(filename, modified):
+    """Whether the process that wrote `filename` is gone for good"""
+    try:
+        host, pid, token = filename[:-len('.json')].rsplit('_', 2)
+        pid = int(pid)
+    except ValueError:
+        return False
+    if host != socket.gethostname():
+        # Processes on other hosts cannot be checked; only silence tells
+        return time.time() - modified > getattr(settings, 'METRICS_FILE_MAX_AGE', 7 * 24 * 3600)
+    if pid == os.getpid():
+        # An earlier process that had this pid
+        return filename != f'{_own_file_stem()}.json'
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def _fold_exited(directory):
+    """
+    Add the files of exited processes to MERGED_FILENAME and delete them, so
+    their totals survive without the files piling up. Returns the merged
+    file's contents.
+    """
+    merged_path = os.path.join(directory, MERGED_FILENAME)
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            merged = _read_json(merged_path) or {'folded': [], 'metrics': {}}
+            present = set(os.listdir(directory))
+            # Files already counted in the merged totals whose removal was interrupted
+            folded = [filename for filename in merged['folded'] if filename in present]
+            exited = []
+            for filename in sorted(present - set(folded)):
+                if not filename.endswith('.json') or filename == MERGED_FILENAME:
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    modified = os.path.getmtime(path)
+                except OSError:
+                    continue
+                if _has_exited(filename, modified):
+                    exited.append(filename)
+            if not exited and not folded:
+                return merged
+
+            totals = {name: {} for name in _metrics}
+            for data in [merged['metrics']] + [_read_json(os.path.join(directory, name)) or {} for name in exited]:
+                for name, rows in data.items():
+                    if name in _metrics:
+                        _metrics[name].merge(totals[name], rows)
+            merged = {
+                'folded': folded + exited,
+                'metrics': {
+                    name: [[list(key), value] for key, value in values.items()]
+                    for name, values in totals.items()
+                },
+            }
+            # Counted in the merged file before the originals go
+            _write_json(directory, MERGED_FILENAME, merged)
+            for filename in merged['folded']:
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except FileNotFoundError:
+                    pass
+            merged['folded'] = []
+            _write_json(directory, MERGED_FILENAME, merged)
+            return merged
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def collect():
+    """{metric name: {label values: value}} summed over every process"""
+    directory = getattr(settings, 'METRICS_DIR', '')
+    if directory:
+        flush(force=True)
+        merged = _fold_exited(directory)
+        snapshots = [merged['metrics']]
+        for filename in os.listdir(directory):
+            if filename.endswith('.json') and filename != MERGED_FILENAME and filename not in merged['folded']:
+                data = _read_json(os.path.join(directory, filename))
+                if data is not None:
+                    snapshots.append(data)
+    else:
+        snapshots = [snapshot()]
+
+    totals = {name: {} for name in _metrics}
+    for data in snapshots:
+        for name, rows in data.items():
+            if name in _metrics:
+                _metrics[name].merge(totals[name], rows)
+    return totals
+
+
+def render():
+    lines = []
+    for name, values in collect().items():
+        metric = _metrics[name]
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        lines.extend(metric.render(values))
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint"""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorization = request.headers.get('Authorization', '')
+    allowed = bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+    if not allowed:
+        user = request.user
+        allowed = user.is_authenticated and (user.is_superuser or user.role == user.Role.ADMIN)
+    if not allowed:
+        return HttpResponseForbidden('Forbidden')
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
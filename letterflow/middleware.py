@@ -0,0 +1,319 @@
+"""
+Project-wide request instrumentation.
+
+MetricsMiddleware feeds the per-view latency, request and query metrics of
+letterflow.metrics.
+
+QueryInstrumentationMiddleware times every SQL statement a request runs
+through Django's execute_wrapper hook, so it works with DEBUG off and without
+per-statement logging. Each request logs one summary line to
+``letterflow.queries``:
+
+    GET /shipping/ view=shipping:dashboard status=200 queries=9 db_ms=12.4 dup=0 slowest_ms=3.1 total_ms=41.0
+
+`dup` counts repeated runs of the same SQL text, the usual sign of an N+1.
+
+Statements slower than SLOW_QUERY_MS are logged with their EXPLAIN plan, and
+views that run more queries than their QUERY_BUDGETS entry log a warning.
+
+Both measure streamed responses, such as the shipment CSV export, until the
+last chunk is sent, since their queries run while the body is produced.
+
+ProfilingMiddleware profiles single requests on demand for admins and stores
+the result as a shipping.RequestProfile.
+"""
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.http import FileResponse
+
+from . import metrics
+
+
+logger = logging.getLogger('letterflow.queries')
+
+# Slowest statements kept per request; those over SLOW_QUERY_MS get an EXPLAIN
+SLOWEST_KEPT = 3
+
+
+class QueryStats:
+    """The statements one request ran, recorded by an execute wrapper"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        # SQL with placeholders -> times run
+        self.signatures = {}
+        # (duration, alias, sql, params), slowest first
+        self.slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            # executemany batches have no single parameter set to EXPLAIN with
+            self.record(
+                context['connection'].alias, sql, None if many else params,
+                time.perf_counter() - start,
+            )
+
+    def record(self, alias, sql, params, duration):
+        self.count += 1
+        self.duration += duration
+        self.signatures[sql] = self.signatures.get(sql, 0) + 1
+        if len(self.slowest) < SLOWEST_KEPT or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, alias, sql, params))
+            self.slowest.sort(key=lambda entry: entry[0], reverse=True)
+            del self.slowest[SLOWEST_KEPT:]
+
+    @property
+    def duplicates(self):
+        """{sql: times run} for statements run more than once"""
+        return {sql: times for sql, times in self.signatures.items() if times > 1}
+
+
+def explain(alias, sql, params):
+    """The database's plan for a recorded SELECT, or None"""
+    if params is None or not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+            return '\n'.join(' '.join(str(value) for value in row) for row in cursor.fetchall())
+    except DatabaseError:
+        # e.g. the request left the transaction aborted
+        return None
+
+
+def when_sent(response, finish):
+    """
+    Call finish() once `response` has been produced. For streamed responses
+    the body is built while it is sent, so that is after the last chunk (or
+    when the server closes the response early).
+    """
+    # Files go out through the server's file wrapper; async iterators are
+    # consumed elsewhere
+    if not response.streaming or response.is_async or isinstance(response, FileResponse):
+        finish()
+        return response
+    content = response.streaming_content
+
+    def stream():
+        try:
+            yield from content
+        finally:
+            finish()
+
+    response.streaming_content = stream()
+    return response
+
+
+class MetricsMiddleware:
+    """Record each request's latency, status and queries by URL name"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        return when_sent(response, lambda: self.record(request, response, time.perf_counter() - started))
+
+    def record(self, request, response, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        # URL names, not paths, keep the number of label values bounded
+        view_name = (match.view_name if match else None) or 'unmatched'
+        metrics.REQUEST_LATENCY.observe(elapsed, view=view_name, method=request.method)
+        metrics.REQUESTS.inc(view=view_name, method=request.method, status=response.status_code)
+        stats = getattr(request, 'query_stats', None)
+        if stats is not None:
+            metrics.DB_QUERIES.inc(stats.count, view=view_name)
+            metrics.DB_TIME.inc(stats.duration, view=view_name)
+        metrics.flush()
+
+
+class QueryInstrumentationMiddleware:
+    """Count, time and budget the queries of every request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'QUERY_INSTRUMENTATION', True)
+        self.slow_query_ms = getattr(settings, 'SLOW_QUERY_MS', 200)
+        self.budgets = getattr(settings, 'QUERY_BUDGETS', {})
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+
+        stats = QueryStats()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+            # Streamed responses run their queries while they are sent
+            wrappers = stack.pop_all()
+        request.query_stats = stats
+
+        def finish():
+            wrappers.close()
+            self.report(request, response, stats, time.perf_counter() - started)
+
+        return when_sent(response, finish)
+
+    def report(self, request, response, stats, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else '-'
+        duplicates = stats.duplicates
+        slowest_ms = stats.slowest[0][0] * 1000 if stats.slowest else 0.0
+
+        logger.info(
+            '%s %s view=%s status=%s queries=%d db_ms=%.1f dup=%d slowest_ms=%.1f total_ms=%.1f',
+            request.method, request.path, view_name, response.status_code,
+            stats.count, stats.duration * 1000, sum(duplicates.values()) - len(duplicates),
+            slowest_ms, elapsed * 1000,
+        )
+
+        budget = self.budgets.get(view_name)
+        if budget is not None and stats.count > budget:
+            worst = sorted(duplicates.items(), key=lambda entry: entry[1], reverse=True)[:3]
+            logger.warning(
+                'Query budget exceeded: view=%s queries=%d budget=%d path=%s repeated=%s',
+                view_name, stats.count, budget, request.path,
+                '; '.join(f'{times}x {sql[:200]}' for sql, times in worst) or '-',
+            )
+
+        for duration, alias, sql, params in stats.slowest:
+            if duration * 1000 < self.slow_query_ms:
+                break
+            logger.warning(
+                'Slow query: view=%s ms=%.1f sql=%s\n%s',
+                view_name, duration * 1000, sql, explain(alias, sql, params) or '(no plan)',
+            )
+
+
+# Rows of the call tree and the allocation list stored with each profile
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 30
+
+# Frames of the profiler itself, left out of the allocation list
+ALLOCATION_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+class ProfilingMiddleware:
+    """
+    Profile one request when an admin asks for it with an `X-Profile: 1`
+    header or a `_profile=1` query parameter.
+
+    The view and its template rendering run under cProfile, with tracemalloc
+    tracing allocations. The pstats data, a call tree and the allocations
+    still held when the response is ready are saved as a RequestProfile, and
+    the response carries its id in `X-Profile-Id`. Requests from anyone else,
+    or without the flag, pass straight through.
+
+    Profiling slows the whole process down, so only one request is profiled at
+    a time; others asking meanwhile are served unprofiled with
+    `X-Profile: busy`. Must come after AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'REQUEST_PROFILING', True)
+        self.kept = getattr(settings, 'REQUEST_PROFILES_KEPT', 200)
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        if not (self.enabled and self.requested(request) and self.allowed(request.user)):
+            return self.get_response(request)
+        if not self._lock.acquire(blocking=False):
+            response = self.get_response(request)
+            response['X-Profile'] = 'busy'
+            return response
+        try:
+            return self.profile(request)
+        finally:
+            self._lock.release()
+
+    def requested(self, request):
+        return request.headers.get('X-Profile') == '1' or request.GET.get('_profile') == '1'
+
+    def allowed(self, user):
+        return user.is_authenticated and user.role == user.Role.ADMIN
+
+    def profile(self, request):
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        queries = QueryStats()
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(queries))
+                response = profiler.runcall(self.get_response, request)
+            elapsed = time.perf_counter() - started
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+
+        profile = self.save(request, response, profiler, snapshot, elapsed, peak_memory, queries.count)
+        response['X-Profile-Id'] = str(profile.pk)
+        return response
+
+    def save(self, request, response, profiler, snapshot, elapsed, peak_memory, query_count):
+        from shipping.models import RequestProfile
+
+        profiler.create_stats()
+        match = getattr(request, 'resolver_match', None)
+        profile = RequestProfile.objects.create(
+            method=request.method,
+            path=request.get_full_path()[:500],
+            view_name=(match.view_name if match else '')[:200],
+            status_code=response.status_code,
+            duration_ms=elapsed * 1000,
+            query_count=query_count,
+            peak_memory=peak_memory,
+            stats=marshal.dumps(profiler.stats),
+            call_tree=call_tree(profiler),
+            allocations=allocations(snapshot),
+            created_by=request.user,
+        )
+        stale = RequestProfile.objects.values_list('pk', flat=True)[self.kept:]
+        RequestProfile.objects.filter(pk__in=list(stale)).delete()
+        return profile
+
+
+def call_tree(profiler):
+    """The slowest functions by cumulative time, and the calls each one made"""
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE)
+    stats.print_stats(PROFILE_TOP_FUNCTIONS)
+    stats.print_callees(PROFILE_TOP_FUNCTIONS)
+    return output.getvalue()
+
+
+def allocations(snapshot):
+    """The source lines holding the most memory in a tracemalloc snapshot"""
+    top = snapshot.filter_traces(ALLOCATION_FILTERS).statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]
+    return '\n'.join(str(statistic) for statistic in top)
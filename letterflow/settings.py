@@ -45,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'letterflow.middleware.MetricsMiddleware',
+    'letterflow.middleware.QueryInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -53,6 +55,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'letterflow.middleware.ProfilingMiddleware',
     # 'accounts.middleware.ForcePasswordChangeMiddleware',  # Temporarily disabled
 ]
 
@@ -180,6 +183,98 @@ ADMIN_LOGIN_REDIRECT_URL = '/admin/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Cache
+# Local memory is per process: with several gunicorn workers set CACHE_DIR so
+# dashboard invalidations reach every worker through the shared file cache.
+if os.environ.get('CACHE_DIR'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ['CACHE_DIR'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'letterflow',
+        }
+    }
+
+# Dashboards are invalidated per cluster on shipment changes; the timeout bounds
+# how stale the admin's user/cluster/FCP totals can get
+DASHBOARD_CACHE_TIMEOUT = 300
+
+# FCP rosters for the shipment form are versioned per cluster and revalidated
+# by the browser with ETags; max-age lets it skip even the 304 for a while
+FCP_DIRECTORY_MAX_AGE = int(os.environ.get('FCP_DIRECTORY_MAX_AGE', '0'))
+FCP_DIRECTORY_CACHE_TIMEOUT = 86400
+
+# Seconds a process keeps its org directory (clusters, FCPs) before
+# reloading it even without a change signal, in case the cache is not shared
+ORG_DIRECTORY_MAX_AGE = 300
+
+# Shipment list pagination: 'keyset' (cursor based, no COUNT) or 'offset' (page numbers)
+SHIPMENT_LIST_PAGINATION = os.environ.get('SHIPMENT_LIST_PAGINATION', 'keyset')
+# Show a planner-estimated total in keyset mode (PostgreSQL only)
+SHIPMENT_LIST_ESTIMATE_TOTAL = True
+
+# Processes used to hash passwords during bulk user import (default: one per CPU)
+USER_IMPORT_HASH_WORKERS = int(os.environ.get('USER_IMPORT_HASH_WORKERS', 0)) or None
+# Largest accepted import file; the file is streamed, so this bounds run time rather than memory
+USER_IMPORT_MAX_FILE_SIZE = 100 * 1024 * 1024
+
+# Background jobs (manage.py run_jobs)
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', 2))
+JOB_MAX_ATTEMPTS = 3
+# Seconds before the first retry; doubled on each further attempt
+JOB_RETRY_DELAY = 30
+# Running jobs with no progress for this long are assumed orphaned and requeued
+JOB_STALE_AFTER = 600
+# Seconds between the heartbeats that keep a running job from looking stale
+JOB_HEARTBEAT_INTERVAL = 60
+# Seconds between each worker's checks for stale jobs
+JOB_SWEEP_INTERVAL = 60
+
+# Query instrumentation (letterflow.middleware): one summary line per request on
+# the letterflow.queries logger, the EXPLAIN plan of statements slower than
+# SLOW_QUERY_MS, and a warning when a view runs more queries than its budget
+QUERY_INSTRUMENTATION = os.environ.get('QUERY_INSTRUMENTATION', '1') != '0'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+# URL name -> most queries one request to it should need, a little above the
+# counts shipping.tests.QueryBudgetTests measures (which include the first
+# write of the day creating its rollup rows)
+QUERY_BUDGETS = {
+    'shipping:dashboard': 15,
+    'shipping:shipment_list': 15,
+    'shipping:shipment_detail': 12,
+    'shipping:reports': 15,
+    'shipping:create_outgoing_shipment': 24,
+    'shipping:create_roster_shipment': 24,
+    'shipping:create_return_shipment': 24,
+    'shipping:confirm_receipt': 25,
+    'shipping:batch_transition': 20,
+    'shipping:get_fcps_for_cluster': 10,
+    'shipping:shipment_events_feed': 10,
+}
+
+# Metrics (letterflow.metrics) served at /metrics/ to admins or to scrapers
+# sending "Authorization: Bearer <METRICS_TOKEN>". Gunicorn workers share
+# their values through files in METRICS_DIR; without it each worker only
+# reports itself.
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = 5
+# Files from other hosts unchanged this long (seconds) are folded into the
+# merged totals and removed
+METRICS_FILE_MAX_AGE = 7 * 24 * 3600
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# On-demand profiling (letterflow.middleware.ProfilingMiddleware): admins add
+# "X-Profile: 1" or "?_profile=1" to a request to have it profiled. The newest
+# REQUEST_PROFILES_KEPT profiles are listed at /shipping/profiles/.
+REQUEST_PROFILING = os.environ.get('REQUEST_PROFILING', '1') != '0'
+REQUEST_PROFILES_KEPT = 200
+
 # Messages
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 
@@ -197,55 +292,87 @@ SECURE_SSL_REDIRECT = False
 SESSION_COOKIE_SECURE = True
 CSRF_COOKIE_SECURE = True
 
-# Simple logging with more detail
+# Logging (letterflow.log): loggers only queue records; a background thread
+# writes them as JSON lines to the console and, unless LOG_FILE is empty, to a
+# file rotated daily and whenever it reaches LOG_FILE_MAX_BYTES
+LOG_FILE = os.environ.get('LOG_FILE', os.path.join(BASE_DIR, 'django.log'))
+LOG_FILE_MAX_BYTES = int(os.environ.get('LOG_FILE_MAX_BYTES', 50 * 1024 * 1024))
+LOG_FILE_BACKUP_COUNT = 14
+# Logger name -> fraction of its INFO/DEBUG records kept; warnings are always kept
+LOG_SAMPLE_RATES = {
+    'letterflow.queries': float(os.environ.get('QUERY_LOG_SAMPLE_RATE', '1')),
+}
+
+LOG_HANDLERS = {
+    'console': {
+        'class': 'logging.StreamHandler',
+        'level': 'DEBUG',
+        'formatter': 'json',
+    },
+}
+if LOG_FILE:
+    LOG_HANDLERS['file'] = {
+        'class': 'letterflow.log.SizeAndTimeRotatingFileHandler',
+        'filename': LOG_FILE,
+        'when': 'midnight',
+        'max_bytes': LOG_FILE_MAX_BYTES,
+        'backupCount': LOG_FILE_BACKUP_COUNT,
+        'delay': True,
+        'level': 'DEBUG',
+        'formatter': 'json',
+    }
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
-        'verbose': {
-            'format': '{levelname} {asctime} {module} {process:d} {thread:d} {message}',
-            'style': '{',
+        'json': {
+            '()': 'letterflow.log.JSONFormatter',
         },
-        'simple': {
-            'format': '{levelname} {message}',
-            'style': '{',
+    },
+    'filters': {
+        'sample': {
+            '()': 'letterflow.log.SamplingFilter',
+            'rates': LOG_SAMPLE_RATES,
         },
     },
     'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'level': 'DEBUG',
-            'formatter': 'verbose',
-        },
-        'file': {
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(BASE_DIR, 'django.log'),
-            'level': 'DEBUG',
-            'formatter': 'verbose',
+        **LOG_HANDLERS,
+        # The only handler loggers use; named to sort after its targets
+        'queue': {
+            'class': 'letterflow.log.QueuedHandler',
+            'handlers': list(LOG_HANDLERS),
+            'filters': ['sample'],
         },
     },
     'root': {
-        'handlers': ['console', 'file'],
+        'handlers': ['queue'],
         'level': 'INFO',
     },
     'loggers': {
         'django': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': False,
         },
+        # Every SQL statement at DEBUG; production relies on letterflow.queries instead
         'django.db.backends': {
-            'handlers': ['console', 'file'],
-            'level': 'DEBUG',
+            'handlers': ['queue'],
+            'level': 'DEBUG' if DEBUG else 'INFO',
+            'propagate': False,
+        },
+        'letterflow.queries': {
+            'handlers': ['queue'],
+            'level': 'INFO',
             'propagate': False,
         },
         'django.request': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'DEBUG',
             'propagate': False,
         },
         'django.security': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'DEBUG',
             'propagate': False,
         },
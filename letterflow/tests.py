@@ -0,0 +1,232 @@
+import json
+import logging
+import marshal
+import os
+import queue
+import socket
+import subprocess
+import tempfile
+
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from accounts.models import User
+from org.models import Cluster, FCP
+from shipping.models import RequestProfile, Shipment
+from . import metrics
+from .log import QueuedHandler, SizeAndTimeRotatingFileHandler
+from .middleware import ProfilingMiddleware
+
+
+class SizeAndTimeRotatingFileHandlerTests(SimpleTestCase):
+    """Size rotations within one period must keep the newest files"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'app.log')
+
+    def read_all(self):
+        lines = []
+        for name in os.listdir(self.directory.name):
+            with open(os.path.join(self.directory.name, name)) as source:
+                lines.extend(source.read().split())
+        return sorted(lines)
+
+    def test_pruning_keeps_newest_records(self):
+        handler = SizeAndTimeRotatingFileHandler(self.path, when='midnight', max_bytes=100, backupCount=3)
+        self.addCleanup(handler.close)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        for n in range(200):
+            handler.emit(logging.makeLogRecord({'msg': f'record-{n:04d}'}))
+        handler.close()
+
+        kept = self.read_all()
+        self.assertEqual(len(os.listdir(self.directory.name)), 4)
+        self.assertIn('record-0199', kept)
+        # The kept files hold one unbroken run ending with the newest record
+        first = int(kept[0].split('-')[1])
+        self.assertEqual(kept, [f'record-{n:04d}' for n in range(first, 200)])
+
+    def test_counters_follow_the_highest_kept(self):
+        handler = SizeAndTimeRotatingFileHandler(self.path, when='midnight', max_bytes=1, backupCount=2)
+        self.addCleanup(handler.close)
+        for n in range(6):
+            handler.emit(logging.makeLogRecord({'msg': f'record-{n}'}))
+        counters = [counter for _, counter, _ in handler.rotated_files()]
+        self.assertEqual(counters, sorted(counters))
+        self.assertEqual(len(counters), 2)
+        self.assertGreater(counters[0], 0)
+
+
+class QueuedHandlerTests(SimpleTestCase):
+
+    def test_dropped_records_are_counted(self):
+        handler = QueuedHandler([], queue_size=1)
+        self.addCleanup(handler.close)
+        handler.name = 'test-queue'
+        handler.listener.stop()
+        handler._listening = False
+        # The listener is stopped, so the second record finds the queue full
+        handler.queue = queue.Queue(1)
+        before = metrics.LOG_RECORDS_DROPPED.values.get(('test-queue',), 0)
+        handler.emit(logging.makeLogRecord({'msg': 'kept'}))
+        handler.emit(logging.makeLogRecord({'msg': 'dropped'}))
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(metrics.LOG_RECORDS_DROPPED.values[('test-queue',)], before + 1)
+
+
+class MetricsFileTests(SimpleTestCase):
+    """Totals summed over the files of every process never go back"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings = override_settings(METRICS_DIR=self.directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.key = ('files-test',)
+        metrics.LOG_RECORDS_DROPPED.values.pop(self.key, None)
+
+    def write(self, filename, total):
+        with open(os.path.join(self.directory.name, filename), 'w') as target:
+            json.dump({metrics.LOG_RECORDS_DROPPED.name: [[list(self.key), total]]}, target)
+
+    def total(self):
+        return metrics.collect()[metrics.LOG_RECORDS_DROPPED.name].get(self.key, 0)
+
+    def exited_pid(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return process.pid
+
+    def test_reused_pid_keeps_earlier_file(self):
+        # Left by an earlier worker that had this process's pid
+        earlier = f'{socket.gethostname()}_{os.getpid()}_0123456789ab.json'
+        self.write(earlier, 5)
+        metrics.LOG_RECORDS_DROPPED.inc(2, handler='files-test')
+        self.assertEqual(self.total(), 7)
+        self.assertNotIn(earlier, os.listdir(self.directory.name))
+        self.assertEqual(self.total(), 7)
+
+    def test_exited_processes_are_folded(self):
+        self.write(f'{socket.gethostname()}_{self.exited_pid()}_0123456789ab.json', 3)
+        self.write(f'{socket.gethostname()}_{self.exited_pid()}_ba9876543210.json', 4)
+        self.assertEqual(self.total(), 7)
+        self.write(f'{socket.gethostname()}_{self.exited_pid()}_aaaaaaaaaaaa.json', 1)
+        self.assertEqual(self.total(), 8)
+        names = sorted(os.listdir(self.directory.name))
+        self.assertEqual(names, sorted(['.lock', metrics.MERGED_FILENAME, f'{metrics._own_file_stem()}.json']))
+
+    def test_running_processes_are_not_folded(self):
+        # The parent of the test runner outlives it
+        running = f'{socket.gethostname()}_{os.getppid()}_0123456789ab.json'
+        self.write(running, 6)
+        self.assertEqual(self.total(), 6)
+        self.assertIn(running, os.listdir(self.directory.name))
+
+    def test_interrupted_fold_is_not_counted_twice(self):
+        folded = f'{socket.gethostname()}_{self.exited_pid()}_0123456789ab.json'
+        self.write(folded, 3)
+        # Merged totals written, but the process stopped before removing the file
+        with open(os.path.join(self.directory.name, metrics.MERGED_FILENAME), 'w') as target:
+            json.dump({
+                'folded': [folded],
+                'metrics': {metrics.LOG_RECORDS_DROPPED.name: [[list(self.key), 3]]},
+            }, target)
+        self.assertEqual(self.total(), 3)
+        self.assertNotIn(folded, os.listdir(self.directory.name))
+
+
+class StreamedResponseInstrumentationTests(TestCase):
+    """The CSV export's queries run while it streams and must be counted"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('streaming_admin', role=User.Role.ADMIN, must_change_password=False)
+        cluster = Cluster.objects.create(name='Streaming Cluster', sdsa_owner=cls.admin)
+        centre = FCP.objects.create(code='UG9700', cluster=cluster, is_collection_centre=True)
+        Shipment.objects.bulk_create([
+            Shipment(
+                direction=Shipment.Direction.OUT, cluster=cluster, collection_centre=centre,
+                estimated_delivery_date=timezone.localdate(), created_by=cls.admin,
+            )
+            for _ in range(3)
+        ])
+
+    def queries_counted(self):
+        return metrics.DB_QUERIES.values.get(('shipping:export_shipments_csv',), 0)
+
+    def test_export_measured_until_last_chunk(self):
+        self.client.force_login(self.admin)
+        before = self.queries_counted()
+        with self.assertLogs('letterflow.queries', 'INFO') as logs:
+            response = self.client.get('/shipping/shipments/export/')
+            self.assertTrue(response.streaming)
+            self.assertEqual(self.queries_counted(), before)
+            content = b''.join(response.streaming_content).decode()
+        self.assertEqual(len(content.strip().splitlines()), 4)
+        self.assertGreater(self.queries_counted(), before)
+        summary = logs.records[0].getMessage()
+        self.assertIn('view=shipping:export_shipments_csv', summary)
+        # The rows query ran while streaming, after the view returned
+        self.assertNotIn('queries=0 ', summary)
+
+
+class ProfilingMiddlewareTests(TestCase):
+    """Admins can have single requests profiled and stored"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('profiling_admin', role=User.Role.ADMIN, must_change_password=False)
+        cls.sdsa = User.objects.create_user('profiling_sdsa', role=User.Role.SDSA, must_change_password=False)
+
+    def test_admin_request_is_profiled(self):
+        self.client.force_login(self.admin)
+        response = self.client.get('/shipping/', {'_profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        profile = RequestProfile.objects.get(pk=response['X-Profile-Id'])
+        self.assertEqual(profile.view_name, 'shipping:dashboard')
+        self.assertEqual(profile.created_by, self.admin)
+        self.assertEqual(profile.status_code, 200)
+        self.assertGreater(profile.query_count, 0)
+        self.assertTrue(marshal.loads(profile.stats))
+        self.assertIn('function calls', profile.call_tree)
+
+        # The header asks for a profile too
+        response = self.client.get('/shipping/', HTTP_X_PROFILE='1')
+        self.assertIn('X-Profile-Id', response)
+        self.assertEqual(RequestProfile.objects.count(), 2)
+
+    def test_other_requests_pass_through(self):
+        self.client.force_login(self.admin)
+        self.assertNotIn('X-Profile-Id', self.client.get('/shipping/'))
+        self.client.force_login(self.sdsa)
+        self.assertNotIn('X-Profile-Id', self.client.get('/shipping/', {'_profile': '1'}))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_overlapping_request_is_busy(self):
+        inner = []
+
+        def view(request):
+            # A second profiled request arriving while this one is profiled
+            if not inner:
+                inner.append(None)
+                inner[0] = middleware(request)
+            return HttpResponse()
+
+        middleware = ProfilingMiddleware(view)
+        request = RequestFactory().get('/', {'_profile': '1'})
+        request.user = self.admin
+        outer = middleware(request)
+        self.assertIn('X-Profile-Id', outer)
+        self.assertEqual(inner[0]['X-Profile'], 'busy')
+        self.assertNotIn('X-Profile-Id', inner[0])
+        self.assertEqual(RequestProfile.objects.count(), 1)
+
+    @override_settings(REQUEST_PROFILES_KEPT=2)
+    def test_old_profiles_are_pruned(self):
+        self.client.force_login(self.admin)
+        ids = [int(self.client.get('/shipping/', {'_profile': '1'})['X-Profile-Id']) for _ in range(4)]
+        self.assertEqual(sorted(RequestProfile.objects.values_list('pk', flat=True)), ids[-2:])
@@ -23,6 +23,8 @@ from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
 import os
 
+from letterflow.metrics import metrics_view
+
 @csrf_exempt
 def healthcheck(request):
     """Simple healthcheck endpoint for Railway - no CSRF required"""
@@ -133,6 +135,7 @@ urlpatterns = [
     path('db-test/', db_test),  # Database test endpoint
     path('test/', test_endpoint),  # Test endpoint
     path('health/', healthcheck),  # Healthcheck at /health/
+    path('metrics/', metrics_view, name='metrics'),  # Prometheus metrics
     path('debug-auth/', debug_auth),  # Debug authentication state
     path('', root_redirect),  # Root URL redirects to login
 ]
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.core.exceptions import ValidationError
+from .directory import get_directory
 from .models import Cluster, FCP, CollectionCentreUser
 
 
@@ -22,7 +23,7 @@ class ClusterAdmin(admin.ModelAdmin):
     inlines = [FCPInline]
     
     def get_fcp_count(self, obj):
-        return obj.fcps.count()
+        return len(get_directory().cluster_fcp_ids.get(obj.pk, ()))
     get_fcp_count.short_description = 'FCP Count'
     
     def get_collection_centre(self, obj):
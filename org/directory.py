@@ -0,0 +1,211 @@
+"""
+Read-mostly, per-process snapshot of the organisation structure.
+
+Clusters, FCPs and collection centres change a few times a year but are
+consulted on almost every request. The directory loads them in two queries
+into small immutable structures and keeps them until an org model is written.
+
+Writes are picked up through post_save/post_delete signals (see
+org.signals). The writing thread sees its own changes straight away, and
+other threads and processes reload once the transaction commits: a shared
+version counter in the default cache tells them the snapshot is stale.
+ORG_DIRECTORY_MAX_AGE bounds staleness if that cache is not shared.
+
+Because of that bound the directory only serves lookups: names, rosters and
+collection centres for forms and pages. Permission checks read cluster
+ownership and CC links from the database (see shipping.scope.ShipmentScope).
+"""
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+
+VERSION_KEY = 'org-directory:version'
+
+
+class ClusterEntry(NamedTuple):
+    id: int
+    name: str
+    sdsa_owner_id: int
+
+
+class FCPEntry(NamedTuple):
+    id: int
+    code: str
+    name: str
+    cluster_id: int
+    is_collection_centre: bool
+
+
+class OrgDirectory:
+    """One immutable snapshot of the org tables"""
+
+    def __init__(self, clusters, fcps, version=None):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.clusters = {cluster.id: cluster for cluster in clusters}
+        self.fcps = {fcp.id: fcp for fcp in fcps}
+
+        cluster_fcp_ids = {cluster_id: [] for cluster_id in self.clusters}
+        collection_centre_ids = {}
+        for fcp in sorted(self.fcps.values(), key=lambda fcp: fcp.code):
+            cluster_fcp_ids.setdefault(fcp.cluster_id, []).append(fcp.id)
+            if fcp.is_collection_centre:
+                collection_centre_ids.setdefault(fcp.cluster_id, fcp.id)
+
+        # FCP ids per cluster in code order
+        self.cluster_fcp_ids = {key: tuple(ids) for key, ids in cluster_fcp_ids.items()}
+        # cluster id -> collection centre FCP id
+        self.collection_centre_ids = collection_centre_ids
+
+    @classmethod
+    def load(cls, version=None):
+        from .models import Cluster, FCP
+
+        return cls(
+            [ClusterEntry(*row) for row in Cluster.objects.order_by().values_list('id', 'name', 'sdsa_owner_id')],
+            [FCPEntry(*row) for row in FCP.objects.order_by().values_list(
+                'id', 'code', 'name', 'cluster_id', 'is_collection_centre'
+            )],
+            version=version,
+        )
+
+    def fcp(self, fcp_id):
+        """An FCP model instance built from the snapshot, or None"""
+        from .models import FCP
+
+        entry = self.fcps.get(fcp_id)
+        if entry is None:
+            return None
+        return FCP.from_db(None, FCPEntry._fields, entry)
+
+    def cluster(self, cluster_id):
+        """A Cluster model instance built from the snapshot, or None"""
+        from .models import Cluster
+
+        entry = self.clusters.get(cluster_id)
+        if entry is None:
+            return None
+        return Cluster.from_db(None, ClusterEntry._fields, entry)
+
+    def collection_centre(self, cluster_id):
+        """The cluster's collection centre FCP, or None"""
+        return self.fcp(self.collection_centre_ids.get(cluster_id))
+
+    def fcps_in(self, cluster_id):
+        """FCPEntry rows of the cluster, in code order"""
+        return [self.fcps[fcp_id] for fcp_id in self.cluster_fcp_ids.get(cluster_id, ())]
+
+
+_lock = threading.Lock()
+_current = None
+_local = threading.local()
+
+
+def _shared_version():
+    return cache.get(VERSION_KEY)
+
+
+class _PendingWrites:
+    """Org writes made in this thread's open transaction"""
+
+    def __init__(self):
+        self.published = False
+        # Private snapshot, and the savepoints open when it was loaded
+        self.snapshot = None
+        self.savepoint_ids = None
+
+
+def _pending_writes():
+    """
+    This thread's uncommitted org writes, or None.
+
+    A commit publishes and clears them. Once the transaction has ended
+    without that, it was rolled back and the writes are gone.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is not None and not connection.in_atomic_block:
+        pending = _local.pending = None
+    return pending
+
+
+def _uncommitted_snapshot():
+    """This thread's private snapshot while it has uncommitted org writes, or None"""
+    pending = _pending_writes()
+    if pending is None:
+        return None
+    # Releasing or rolling back a savepoint changes what this thread can see,
+    # so the snapshot is loaded again
+    savepoint_ids = list(connection.savepoint_ids)
+    if pending.snapshot is None or pending.savepoint_ids != savepoint_ids:
+        pending.snapshot = OrgDirectory.load()
+        pending.savepoint_ids = savepoint_ids
+    return pending.snapshot
+
+
+def _is_stale(directory, version):
+    max_age = getattr(settings, 'ORG_DIRECTORY_MAX_AGE', 300)
+    return (
+        directory is None
+        or directory.version != version
+        or time.monotonic() - directory.loaded_at > max_age
+    )
+
+
+def get_directory():
+    """The current org directory, reloading it if an org model has changed"""
+    global _current
+
+    snapshot = _uncommitted_snapshot()
+    if snapshot is not None:
+        # Only this thread can see its uncommitted rows
+        return snapshot
+
+    version = _shared_version()
+    directory = _current
+    if _is_stale(directory, version):
+        with _lock:
+            # A commit on another thread may have cleared _current since
+            directory = _current
+            if _is_stale(directory, version):
+                directory = _current = OrgDirectory.load(version)
+    return directory
+
+
+def _publish():
+    global _current
+    _current = None
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def invalidate():
+    """
+    Mark the directory stale after an org write. Call this for bulk writes
+    that bypass model signals.
+    """
+    if not connection.in_atomic_block:
+        _publish()
+        return
+
+    pending = _pending_writes()
+    if pending is None:
+        pending = _local.pending = _PendingWrites()
+    pending.snapshot = None
+
+    def publish():
+        if _local.pending is pending:
+            _local.pending = None
+        if not pending.published:
+            pending.published = True
+            _publish()
+
+    # Queued for every write: rolling back a savepoint drops the callbacks
+    # queued inside it, but not those of writes that survive it
+    transaction.on_commit(publish)
@@ -28,10 +28,9 @@ class Cluster(models.Model):
     
     def get_collection_centre(self):
         """Get the FCP that serves as the collection centre for this cluster."""
-        try:
-            return self.fcps.get(is_collection_centre=True)
-        except FCP.DoesNotExist:
-            return None
+        from .directory import get_directory
+        
+        return get_directory().collection_centre(self.pk)
 
 
 class FCP(models.Model):
@@ -0,0 +1,14 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import directory
+from .models import Cluster, FCP
+
+
+@receiver(post_save, sender=Cluster)
+@receiver(post_save, sender=FCP)
+@receiver(post_delete, sender=Cluster)
+@receiver(post_delete, sender=FCP)
+def invalidate_org_directory(sender, **kwargs):
+    """Any org write makes the cached directory stale"""
+    directory.invalidate()
@@ -1,3 +1,92 @@
-from django.test import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection, connections, transaction
+from django.test import TransactionTestCase
+
+from accounts.models import User
+from . import directory
+from .directory import VERSION_KEY, get_directory
+from .models import Cluster
+
+
+class PublishingLock:
+    """Stands in for directory._lock: another thread's commit lands just before it is taken"""
+
+    def __enter__(self):
+        directory._publish()
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class OrgDirectoryTests(TransactionTestCase):
+    """Org writes reach the directory of the writer at once and of everyone else on commit"""
+
+    def setUp(self):
+        cache.set(VERSION_KEY, 1, timeout=None)
+        directory._current = None
+        directory._local.pending = None
+        self.sdsa = User.objects.create_user('directory_sdsa', role=User.Role.SDSA)
+
+    def cluster_ids_elsewhere(self):
+        """The cluster ids another thread sees, as a concurrent request would"""
+        def read():
+            try:
+                return set(get_directory().clusters)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(1) as pool:
+            return pool.submit(read).result()
+
+    def test_writer_sees_uncommitted_rows(self):
+        get_directory()
+        with transaction.atomic():
+            cluster = Cluster.objects.create(name='Uncommitted', sdsa_owner=self.sdsa)
+            self.assertIn(cluster.pk, get_directory().clusters)
+        self.assertIn(cluster.pk, get_directory().clusters)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Reading from another thread needs a server database')
+    def test_other_threads_reload_after_commit(self):
+        get_directory()
+        with transaction.atomic():
+            cluster = Cluster.objects.create(name='Committed', sdsa_owner=self.sdsa)
+            self.assertNotIn(cluster.pk, self.cluster_ids_elsewhere())
+        self.assertIn(cluster.pk, self.cluster_ids_elsewhere())
+        self.assertEqual(cache.get(VERSION_KEY), 2)
+
+    def test_rolled_back_write_is_not_published(self):
+        get_directory()
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                cluster = Cluster.objects.create(name='Rolled Back', sdsa_owner=self.sdsa)
+                self.assertIn(cluster.pk, get_directory().clusters)
+                raise RuntimeError
+        self.assertNotIn(cluster.pk, get_directory().clusters)
+        self.assertEqual(cache.get(VERSION_KEY), 1)
+
+    def test_savepoint_rollback_keeps_surviving_writes(self):
+        get_directory()
+        with transaction.atomic():
+            kept = Cluster.objects.create(name='Kept', sdsa_owner=self.sdsa)
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    dropped = Cluster.objects.create(name='Dropped', sdsa_owner=self.sdsa)
+                    self.assertIn(dropped.pk, get_directory().clusters)
+                    raise RuntimeError
+            self.assertIn(kept.pk, get_directory().clusters)
+            self.assertNotIn(dropped.pk, get_directory().clusters)
+        self.assertEqual(cache.get(VERSION_KEY), 2)
+        self.assertIn(kept.pk, get_directory().clusters)
+
+    def test_commit_during_reload_never_returns_none(self):
+        cluster = Cluster.objects.create(name='Existing', sdsa_owner=self.sdsa)
+        get_directory()
+        # The loaded snapshot is now stale, and a publish clears it before the lock
+        cache.set(VERSION_KEY, 5, timeout=None)
+        with mock.patch.object(directory, '_lock', PublishingLock()):
+            current = get_directory()
+        self.assertIsNotNone(current)
+        self.assertIn(cluster.pk, current.clusters)
@@ -1,8 +1,13 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
 from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.safestring import mark_safe
-from .models import Shipment, ShipmentItem
+from .models import Job, Shipment, ShipmentItem
+from .scope import ShipmentScope
+from .transitions import (
+    APPLIED, DISTRIBUTE, OUTCOME_LABELS, POST, TRANSITIONS, action_between, transition, transition_many
+)
 
 
 class ShipmentItemInline(admin.TabularInline):
@@ -16,8 +21,30 @@ class ShipmentItemInline(admin.TabularInline):
         return qs.order_by('fcp__code')
 
 
+class ShipmentAdminForm(forms.ModelForm):
+    """Status edits must be one of the transitions the app itself makes"""
+    
+    class Meta:
+        model = Shipment
+        fields = '__all__'
+    
+    def clean_status(self):
+        status = self.cleaned_data['status']
+        shipment = self.instance
+        self.transition_action = None
+        if shipment.pk and status != shipment.status:
+            self.transition_action = action_between(shipment.direction, shipment.status, status)
+            if self.transition_action is None:
+                raise forms.ValidationError(
+                    f'A {shipment.get_direction_display().lower()} shipment cannot move from '
+                    f'{shipment.get_status_display()} to {Shipment.Status(status).label}.'
+                )
+        return status
+
+
 @admin.register(Shipment)
 class ShipmentAdmin(admin.ModelAdmin):
+    form = ShipmentAdminForm
     list_display = (
         'id', 'direction', 'cluster', 'collection_centre', 'status', 
         'total_packages', 'estimated_delivery_date', 'created_by', 'created_at'
@@ -25,8 +52,12 @@ class ShipmentAdmin(admin.ModelAdmin):
     list_filter = ('direction', 'status', 'cluster', 'created_at', 'estimated_delivery_date')
     search_fields = ('cluster__name', 'collection_centre__code', 'collection_centre__name', 'notes')
     ordering = ('-created_at',)
-    readonly_fields = ('direction', 'total_packages', 'total_received', 'created_at', 'sent_at')
+    readonly_fields = (
+        'direction', 'total_packages', 'total_received', 'item_count', 'discrepancy_count',
+        'created_at', 'sent_at'
+    )
     inlines = [ShipmentItemInline]
+    actions = ['mark_distributed', 'mark_posted']
     
     fieldsets = (
         ('Basic Information', {
@@ -40,23 +71,61 @@ class ShipmentAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
         ('Summary', {
-            'fields': ('total_packages', 'total_received'),
+            'fields': ('total_packages', 'total_received', 'item_count', 'discrepancy_count'),
             'classes': ('collapse',)
         }),
     )
     
-    def total_packages(self, obj):
-        return obj.total_packages
-    total_packages.short_description = 'Total Packages'
-    
-    def total_received(self, obj):
-        return obj.total_received
-    total_received.short_description = 'Total Received'
-    
     def get_queryset(self, request):
         qs = super().get_queryset(request)
         return qs.select_related('cluster', 'collection_centre', 'created_by')
     
+    def save_model(self, request, obj, form, change):
+        action = getattr(form, 'transition_action', None)
+        if action is None:
+            return super().save_model(request, obj, form, change)
+        
+        # The status moves through transition(), so the rollup and the event
+        # log see it like any other; the other edited fields are saved first
+        _, _, timestamp_field = TRANSITIONS[(action, obj.direction)]
+        obj.status = form.initial['status']
+        at = getattr(obj, timestamp_field) if timestamp_field in form.changed_data else None
+        fields = [name for name in form.changed_data if name not in ('status', timestamp_field)]
+        if fields:
+            obj.save(update_fields=fields)
+        if not transition(obj, action, actor=request.user, at=at):
+            self.message_user(
+                request, 'The status was not changed: the shipment changed status in the meantime.',
+                messages.WARNING
+            )
+    
+    def _batch_transition(self, request, queryset, action, done):
+        if request.user.is_superuser:
+            cluster_ids = None
+        else:
+            cluster_ids = ShipmentScope.for_user(request.user).batch_cluster_ids
+        outcomes = transition_many(
+            queryset.values_list('pk', flat=True), action,
+            cluster_ids=cluster_ids, actor=request.user
+        )
+        
+        skipped = {}
+        for pk, outcome in sorted(outcomes.items()):
+            if outcome != APPLIED:
+                skipped.setdefault(outcome, []).append(f'#{pk}')
+        applied = len(outcomes) - sum(len(ids) for ids in skipped.values())
+        self.message_user(request, f'{applied} shipment(s) {done}.', messages.SUCCESS)
+        for outcome, ids in skipped.items():
+            self.message_user(request, f'{OUTCOME_LABELS[outcome]}: {", ".join(ids)}', messages.WARNING)
+    
+    @admin.action(description='Mark selected outgoing shipments as distributed')
+    def mark_distributed(self, request, queryset):
+        self._batch_transition(request, queryset, DISTRIBUTE, 'marked as distributed')
+    
+    @admin.action(description='Mark selected return shipments as posted')
+    def mark_posted(self, request, queryset):
+        self._batch_transition(request, queryset, POST, 'marked as posted')
+    
     def has_add_permission(self, request):
         # Only allow admins to create shipments from admin
         return request.user.is_superuser
@@ -94,3 +163,19 @@ class ShipmentItemAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         qs = super().get_queryset(request)
         return qs.select_related('shipment__cluster', 'fcp')
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = (
+        'id', 'kind', 'status', 'progress_done', 'progress_total', 'attempts',
+        'created_by', 'created_at', 'finished_at'
+    )
+    list_filter = ('kind', 'status')
+    ordering = ('-created_at',)
+    exclude = ('payload',)
+    readonly_fields = (
+        'kind', 'status', 'result', 'result_filename', 'progress_done', 'progress_total',
+        'progress_message', 'attempts', 'max_attempts', 'error', 'created_by', 'created_at',
+        'run_after', 'locked_by', 'started_at', 'heartbeat_at', 'finished_at'
+    )
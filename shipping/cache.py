@@ -0,0 +1,144 @@
+import hashlib
+import secrets
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from letterflow import metrics
+
+
+# Version counter shared by every cluster, for dashboards that span all of them
+ALL_CLUSTERS = 'all'
+
+
+def dashboard_cache():
+    return caches[getattr(settings, 'DASHBOARD_CACHE_ALIAS', 'default')]
+
+
+def _version_key(cluster_id, namespace='dashboard'):
+    return f'{namespace}:version:{cluster_id}'
+
+
+def _fresh_version():
+    # A new value from the clock rather than an increment: the file cache's
+    # incr() is a read then a write, so two processes bumping at once could
+    # both store the same value and one bump would be lost. A clock value also
+    # never comes back to one an older cached entry was stored under.
+    return f'{time.time_ns()}-{secrets.token_hex(4)}'
+
+
+def cluster_versions(cluster_ids, namespace='dashboard'):
+    """Current version of each cluster's entries in `namespace`, creating missing counters"""
+    cache = dashboard_cache()
+    keys = {_version_key(cluster_id, namespace): cluster_id for cluster_id in cluster_ids}
+    versions = cache.get_many(keys)
+    for key in keys.keys() - versions.keys():
+        cache.add(key, _fresh_version(), timeout=None)
+        versions[key] = cache.get(key)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def bump_cluster_versions(cluster_ids, namespace='dashboard'):
+    """
+    Invalidate cached dashboards (or other `namespace` entries) covering any of
+    the clusters, once the current transaction commits. Entries for other
+    clusters are untouched.
+    """
+    cluster_ids = set(cluster_ids)
+
+    def bump():
+        dashboard_cache().set_many(
+            {_version_key(cluster_id, namespace): _fresh_version() for cluster_id in cluster_ids | {ALL_CLUSTERS}},
+            timeout=None,
+        )
+
+    if cluster_ids:
+        transaction.on_commit(bump)
+
+
+def dashboard_cache_key(kind, scope, extra=''):
+    """Cache key for a dashboard, derived from the versions of the clusters it covers"""
+    cluster_ids = scope.visible_cluster_ids
+    if cluster_ids is None:
+        cluster_ids = [ALL_CLUSTERS]
+    versions = cluster_versions(sorted(cluster_ids, key=str))
+    fingerprint = ','.join(f'{cluster_id}={version}' for cluster_id, version in sorted(versions.items(), key=str))
+    digest = hashlib.md5(f'{extra}|{fingerprint}'.encode()).hexdigest()
+    return f'dashboard:{kind}:{digest}'
+
+
+def cached_dashboard(kind, scope, build, extra=''):
+    """Return build()'s context for this scope, from the cache when it is still current"""
+    cache = dashboard_cache()
+    key = dashboard_cache_key(kind, scope, extra)
+    data = cache.get(key)
+    if data is not None:
+        metrics.CACHE_LOOKUPS.inc(cache='dashboard', result='hit')
+        return data
+
+    metrics.CACHE_LOOKUPS.inc(cache='dashboard', result='miss')
+    data = build()
+    cache.set(key, data, getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 300))
+    return data
+
+
+def dashboard_cache_stats():
+    """
+    Hit and miss counters for the dashboard cache, from the lookup metrics
+    (summed over every worker when METRICS_DIR is set)
+    """
+    lookups = metrics.collect()[metrics.CACHE_LOOKUPS.name]
+    hits = lookups.get(('dashboard', 'hit'), 0)
+    misses = lookups.get(('dashboard', 'miss'), 0)
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / lookups, 4) if lookups else None,
+    }
+
+
+# FCP rosters per cluster, for the shipment form's FCP directory
+FCP_DIRECTORY = 'fcp-directory'
+
+
+def bump_fcp_directory_versions(cluster_ids):
+    """Invalidate the cached FCP rosters of the clusters once the transaction commits"""
+    bump_cluster_versions(cluster_ids, namespace=FCP_DIRECTORY)
+
+
+def fcp_rosters(cluster_ids):
+    """
+    Current version and roster of each cluster's FCPs.
+
+    Returns ({cluster_id: version}, {cluster_id: [[id, code, name, is_collection_centre], ...]}).
+    Rosters still at their cluster's version come from the cache; the rest
+    are loaded together in one query.
+    """
+    from org.models import FCP
+
+    cache = dashboard_cache()
+    # Versions are read before any rows, so a roster is never stored under a
+    # version newer than the data it was built from
+    versions = cluster_versions(cluster_ids, namespace=FCP_DIRECTORY)
+    keys = {f'{FCP_DIRECTORY}:{cluster_id}:{version}': cluster_id for cluster_id, version in versions.items()}
+    rosters = {keys[key]: roster for key, roster in cache.get_many(keys).items()}
+
+    missing = [cluster_id for cluster_id in cluster_ids if cluster_id not in rosters]
+    metrics.CACHE_LOOKUPS.inc(len(rosters), cache=FCP_DIRECTORY, result='hit')
+    metrics.CACHE_LOOKUPS.inc(len(missing), cache=FCP_DIRECTORY, result='miss')
+    if missing:
+        loaded = {cluster_id: [] for cluster_id in missing}
+        rows = FCP.objects.filter(cluster_id__in=missing).order_by('cluster_id', 'code').values_list(
+            'cluster_id', 'id', 'code', 'name', 'is_collection_centre'
+        )
+        for cluster_id, *fcp in rows:
+            loaded[cluster_id].append(fcp)
+        cache.set_many(
+            {key: loaded[cluster_id] for key, cluster_id in keys.items() if cluster_id in loaded},
+            getattr(settings, 'FCP_DIRECTORY_CACHE_TIMEOUT', 86400)
+        )
+        rosters.update(loaded)
+    return versions, rosters
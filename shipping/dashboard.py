@@ -1,12 +1,19 @@
 from django.shortcuts import render, redirect
+from django.http import JsonResponse
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic import TemplateView
-from django.db.models import Count, Q, Sum, Avg, F
+from django.db.models import Count, Q, Sum
 from django.utils import timezone
 from datetime import datetime, timedelta
 
-from .models import Shipment, ShipmentItem
+from .models import Job, Shipment, ShipmentDailyRollup, ShipmentItem
+from .filters import created_between, current_month_bounds
+from .scope import shipment_scope
+from .cache import cached_dashboard, dashboard_cache_stats
+from .turnaround import turnaround_stats
+from .jobs import submit
 from org.models import Cluster, FCP
 from accounts.models import User
 
@@ -16,18 +23,33 @@ class DashboardView(LoginRequiredMixin, TemplateView):
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        user = self.request.user
+        scope = shipment_scope(self.request)
         
-        if user.is_admin():
-            context.update(self.get_admin_dashboard_data())
-        elif user.is_sdsa():
-            context.update(self.get_sdsa_dashboard_data(user))
-        elif user.is_collection_centre():
-            context.update(self.get_cc_dashboard_data(user))
+        # Cached per role scope; any shipment created or changing status in one
+        # of the scope's clusters moves its version on and forces a rebuild
+        if scope.is_admin:
+            context.update(cached_dashboard(
+                'admin', scope, lambda: self.get_admin_dashboard_data(scope)
+            ))
+        elif scope.is_sdsa:
+            context.update(cached_dashboard(
+                'sdsa', scope, lambda: self.get_sdsa_dashboard_data(scope)
+            ))
+        elif scope.is_collection_centre:
+            context.update(cached_dashboard(
+                'cc', scope, lambda: self.get_cc_dashboard_data(scope), extra=scope.cc_fcp_id
+            ))
         
         return context
     
-    def get_admin_dashboard_data(self):
+    def get_monthly_stats(self, scope):
+        """Month-to-date shipment counts, read from the daily rollup"""
+        first, last = current_month_bounds()
+        return ShipmentDailyRollup.objects.visible_to(scope).filter(
+            day__gte=first, day__lte=last
+        ).status_counts()
+    
+    def get_admin_dashboard_data(self, scope):
         """Get data for admin dashboard"""
         # Counts
         total_clusters = Cluster.objects.count()
@@ -36,9 +58,9 @@ class DashboardView(LoginRequiredMixin, TemplateView):
         total_users = User.objects.count()
         
         # Recent shipments
-        recent_shipments = Shipment.objects.select_related(
+        recent_shipments = list(Shipment.objects.select_related(
             'cluster', 'collection_centre', 'created_by'
-        ).order_by('-created_at')[:10]
+        ).order_by('-created_at')[:10])
         
         # Pending confirmations
         pending_outgoing = Shipment.objects.filter(
@@ -52,28 +74,7 @@ class DashboardView(LoginRequiredMixin, TemplateView):
         ).count()
         
         # Monthly statistics
-        current_month = timezone.now().month
-        current_year = timezone.now().year
-        
-        monthly_stats = Shipment.objects.filter(
-            created_at__year=current_year,
-            created_at__month=current_month
-        ).aggregate(
-            outgoing_created=Count('id', filter=Q(direction=Shipment.Direction.OUT)),
-            outgoing_received=Count('id', filter=Q(
-                direction=Shipment.Direction.OUT,
-                status__in=[Shipment.Status.RECEIVED_CC, Shipment.Status.DISTRIBUTED]
-            )),
-            returns_created=Count('id', filter=Q(direction=Shipment.Direction.RET)),
-            returns_received=Count('id', filter=Q(
-                direction=Shipment.Direction.RET,
-                status__in=[Shipment.Status.RECEIVED_NO, Shipment.Status.POSTED]
-            )),
-            returns_posted=Count('id', filter=Q(
-                direction=Shipment.Direction.RET,
-                status=Shipment.Status.POSTED
-            ))
-        )
+        monthly_stats = self.get_monthly_stats(scope)
         
         return {
             'dashboard_type': 'admin',
@@ -87,52 +88,29 @@ class DashboardView(LoginRequiredMixin, TemplateView):
             'monthly_stats': monthly_stats,
         }
     
-    def get_sdsa_dashboard_data(self, user):
+    def get_sdsa_dashboard_data(self, scope):
         """Get data for SDSA dashboard"""
         # Get managed clusters
-        managed_clusters = user.managed_clusters.all()
+        managed_clusters = list(scope.clusters())
+        shipments = Shipment.objects.visible_to(scope)
         
         # Recent outgoing shipments
-        recent_outgoing = Shipment.objects.filter(
-            direction=Shipment.Direction.OUT,
-            cluster__in=managed_clusters
-        ).select_related('cluster', 'collection_centre').order_by('-created_at')[:10]
+        recent_outgoing = list(shipments.filter(
+            direction=Shipment.Direction.OUT
+        ).select_related('cluster', 'collection_centre').order_by('-created_at')[:10])
         
         # Incoming return shipments
-        incoming_returns = Shipment.objects.filter(
+        incoming_returns = list(shipments.filter(
             direction=Shipment.Direction.RET,
-            cluster__in=managed_clusters,
             status__in=[Shipment.Status.CREATED, Shipment.Status.RECEIVED_NO]
-        ).select_related('cluster', 'collection_centre').order_by('-created_at')
+        ).select_related('cluster', 'collection_centre').order_by('-created_at'))
         
         # Pending confirmations
-        pending_returns = incoming_returns.filter(status=Shipment.Status.CREATED).count()
-        pending_posted = incoming_returns.filter(status=Shipment.Status.RECEIVED_NO).count()
+        pending_returns = sum(1 for s in incoming_returns if s.status == Shipment.Status.CREATED)
+        pending_posted = sum(1 for s in incoming_returns if s.status == Shipment.Status.RECEIVED_NO)
         
         # Monthly statistics for managed clusters
-        current_month = timezone.now().month
-        current_year = timezone.now().year
-        
-        monthly_stats = Shipment.objects.filter(
-            cluster__in=managed_clusters,
-            created_at__year=current_year,
-            created_at__month=current_month
-        ).aggregate(
-            outgoing_created=Count('id', filter=Q(direction=Shipment.Direction.OUT)),
-            outgoing_received=Count('id', filter=Q(
-                direction=Shipment.Direction.OUT,
-                status__in=[Shipment.Status.RECEIVED_CC, Shipment.Status.DISTRIBUTED]
-            )),
-            returns_created=Count('id', filter=Q(direction=Shipment.Direction.RET)),
-            returns_received=Count('id', filter=Q(
-                direction=Shipment.Direction.RET,
-                status__in=[Shipment.Status.RECEIVED_NO, Shipment.Status.POSTED]
-            )),
-            returns_posted=Count('id', filter=Q(
-                direction=Shipment.Direction.RET,
-                status=Shipment.Status.POSTED
-            ))
-        )
+        monthly_stats = self.get_monthly_stats(scope)
         
         return {
             'dashboard_type': 'sdsa',
@@ -144,57 +122,36 @@ class DashboardView(LoginRequiredMixin, TemplateView):
             'monthly_stats': monthly_stats,
         }
     
-    def get_cc_dashboard_data(self, user):
+    def get_cc_dashboard_data(self, scope):
         """Get data for Collection Centre dashboard"""
-        try:
-            cc_fcp = user.collection_centre.fcp
-            cluster = cc_fcp.cluster
-        except:
+        if scope.cc_fcp_id is None:
             return {'dashboard_type': 'cc', 'error': 'Collection centre not configured'}
+        cc_fcp = FCP.objects.select_related('cluster').get(pk=scope.cc_fcp_id)
+        cluster = cc_fcp.cluster
+        shipments = Shipment.objects.visible_to(scope)
         
         # Incoming outgoing shipments to confirm
-        incoming_outgoing = Shipment.objects.filter(
+        incoming_outgoing = list(shipments.filter(
             direction=Shipment.Direction.OUT,
-            cluster=cluster,
             status=Shipment.Status.CREATED
-        ).select_related('cluster', 'collection_centre').order_by('-created_at')
+        ).select_related('cluster', 'collection_centre').order_by('-created_at'))
         
         # Recent outgoing shipments (already confirmed)
-        recent_outgoing = Shipment.objects.filter(
+        recent_outgoing = list(shipments.filter(
             direction=Shipment.Direction.OUT,
-            cluster=cluster,
             status__in=[Shipment.Status.RECEIVED_CC, Shipment.Status.DISTRIBUTED]
-        ).select_related('cluster', 'collection_centre').order_by('-created_at')[:5]
+        ).select_related('cluster', 'collection_centre').order_by('-created_at')[:5])
         
         # Recent return shipments
-        recent_returns = Shipment.objects.filter(
-            direction=Shipment.Direction.RET,
-            cluster=cluster
-        ).select_related('cluster', 'collection_centre').order_by('-created_at')[:5]
+        recent_returns = list(shipments.filter(
+            direction=Shipment.Direction.RET
+        ).select_related('cluster', 'collection_centre').order_by('-created_at')[:5])
         
         # Pending confirmations
-        pending_outgoing = incoming_outgoing.count()
+        pending_outgoing = len(incoming_outgoing)
         
         # Monthly statistics
-        current_month = timezone.now().month
-        current_year = timezone.now().year
-        
-        monthly_stats = Shipment.objects.filter(
-            cluster=cluster,
-            created_at__year=current_year,
-            created_at__month=current_month
-        ).aggregate(
-            outgoing_created=Count('id', filter=Q(direction=Shipment.Direction.OUT)),
-            outgoing_received=Count('id', filter=Q(
-                direction=Shipment.Direction.OUT,
-                status__in=[Shipment.Status.RECEIVED_CC, Shipment.Status.DISTRIBUTED]
-            )),
-            returns_created=Count('id', filter=Q(direction=Shipment.Direction.RET)),
-            returns_received=Count('id', filter=Q(
-                direction=Shipment.Direction.RET,
-                status__in=[Shipment.Status.RECEIVED_NO, Shipment.Status.POSTED]
-            ))
-        )
+        monthly_stats = self.get_monthly_stats(scope)
         
         return {
             'dashboard_type': 'cc',
@@ -211,7 +168,8 @@ class DashboardView(LoginRequiredMixin, TemplateView):
 @login_required
 def reports_view(request):
     """Reports and analytics view"""
-    if not request.user.is_admin() and not request.user.is_sdsa():
+    scope = shipment_scope(request)
+    if not scope.is_admin and not scope.is_sdsa:
         messages.error(request, 'You do not have permission to view reports.')
         return redirect('dashboard')
     
@@ -220,26 +178,50 @@ def reports_view(request):
     date_to = request.GET.get('date_to')
     
     if not date_from:
-        date_from = (timezone.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+        date_from = (timezone.localdate() - timedelta(days=30)).strftime('%Y-%m-%d')
     if not date_to:
-        date_to = timezone.now().strftime('%Y-%m-%d')
+        date_to = timezone.localdate().strftime('%Y-%m-%d')
     
     # Parse dates
     try:
         start_date = datetime.strptime(date_from, '%Y-%m-%d').date()
         end_date = datetime.strptime(date_to, '%Y-%m-%d').date()
     except ValueError:
-        start_date = (timezone.now() - timedelta(days=30)).date()
-        end_date = timezone.now().date()
+        start_date = timezone.localdate() - timedelta(days=30)
+        end_date = timezone.localdate()
     
-    # Base queryset
-    shipments = Shipment.objects.filter(
-        created_at__date__range=[start_date, end_date]
-    )
+    # Long date ranges can be run by the job worker instead of in the request
+    if request.GET.get('background'):
+        job = submit('report', request.user, {
+            'date_from': start_date.isoformat(),
+            'date_to': end_date.isoformat(),
+        })
+        return redirect('shipping:job_detail', pk=job.pk)
+    
+    report = None
+    job_id = request.GET.get('job')
+    if job_id and job_id.isdigit():
+        job = Job.objects.filter(pk=job_id, kind='report', status=Job.Status.SUCCEEDED).first()
+        if job and job.can_view(scope):
+            report = job.result
+            date_from, date_to = job.payload['date_from'], job.payload['date_to']
+    if report is None:
+        report = build_report(scope, start_date, end_date)
+    
+    context = {
+        'date_from': date_from,
+        'date_to': date_to,
+        'clusters': scope.clusters(),
+    }
+    context.update(report)
     
-    # Apply role-based filtering
-    if request.user.is_sdsa():
-        shipments = shipments.filter(cluster__in=request.user.managed_clusters.all())
+    return render(request, 'shipping/reports.html', context)
+
+
+def build_report(scope, start_date, end_date):
+    """Report figures for the user's clusters between two local dates"""
+    # Base queryset
+    shipments = Shipment.objects.visible_to(scope).filter(created_between(start_date, end_date))
     
     # Cluster statistics
     cluster_stats = shipments.values('cluster__name').annotate(
@@ -277,56 +259,19 @@ def reports_view(request):
         ))
     )
     
-    # Calculate turnaround times
-    turnaround_stats = {}
-    for direction in [Shipment.Direction.OUT, Shipment.Direction.RET]:
-        direction_shipments = shipments.filter(direction=direction)
-        
-        if direction == Shipment.Direction.OUT:
-            # OUT: created → received at CC → distributed
-            received_shipments = direction_shipments.filter(
-                status__in=[Shipment.Status.RECEIVED_CC, Shipment.Status.DISTRIBUTED]
-            )
-            
-            if received_shipments.exists():
-                avg_receipt_time = received_shipments.aggregate(
-                    avg_time=Avg(F('received_at') - F('created_at'))
-                )['avg_time']
-                turnaround_stats['outgoing_receipt'] = avg_receipt_time
-                
-                distributed_shipments = direction_shipments.filter(status=Shipment.Status.DISTRIBUTED)
-                if distributed_shipments.exists():
-                    avg_distribution_time = distributed_shipments.aggregate(
-                        avg_time=Avg(F('distributed_at') - F('received_at'))
-                    )['avg_time']
-                    turnaround_stats['outgoing_distribution'] = avg_distribution_time
-        
-        else:  # RET
-            # RET: created → received at NO → posted
-            received_shipments = direction_shipments.filter(
-                status__in=[Shipment.Status.RECEIVED_NO, Shipment.Status.POSTED]
-            )
-            
-            if received_shipments.exists():
-                avg_receipt_time = received_shipments.aggregate(
-                    avg_time=Avg(F('received_at') - F('created_at'))
-                )['avg_time']
-                turnaround_stats['returns_receipt'] = avg_receipt_time
-                
-                posted_shipments = direction_shipments.filter(status=Shipment.Status.POSTED)
-                if posted_shipments.exists():
-                    avg_posting_time = posted_shipments.aggregate(
-                        avg_time=Avg(F('posted_at') - F('received_at'))
-                    )['avg_time']
-                    turnaround_stats['returns_posting'] = avg_posting_time
+    # Turnaround times per stage, overall and by cluster
+    turnaround = turnaround_stats(shipments)
     
-    context = {
-        'date_from': date_from,
-        'date_to': date_to,
-        'cluster_stats': cluster_stats,
+    return {
+        'cluster_stats': list(cluster_stats),
         'overall_stats': overall_stats,
-        'turnaround_stats': turnaround_stats,
-        'clusters': Cluster.objects.all() if request.user.is_admin() else request.user.managed_clusters.all(),
+        'turnaround_stats': turnaround,
     }
-    
-    return render(request, 'shipping/reports.html', context)
+
+
+@login_required
+def dashboard_cache_stats_view(request):
+    """Dashboard cache hit/miss counters (admin only)"""
+    if not shipment_scope(request).is_admin:
+        return JsonResponse({'error': 'Only admin users can view cache statistics.'}, status=403)
+    return JsonResponse(dashboard_cache_stats())
@@ -0,0 +1,52 @@
+import csv
+
+from .models import Shipment
+
+
+SHIPMENT_CSV_HEADER = [
+    'ID', 'Direction', 'Cluster', 'Collection Centre', 'Status',
+    'ETA', 'Total Packages', 'Total Received', 'Created By', 'Created At'
+]
+
+SHIPMENT_CSV_COLUMNS = (
+    'id', 'direction', 'cluster__name', 'collection_centre__code', 'status',
+    'estimated_delivery_date', 'total_packages', 'total_received',
+    'created_by__username', 'created_at'
+)
+
+# Rows fetched per round trip; on PostgreSQL this is the server-side cursor batch size
+EXPORT_CHUNK_SIZE = 2000
+
+
+class Echo:
+    """File-like object whose write() hands the row straight back to the caller"""
+    
+    def write(self, value):
+        return value
+
+
+def iter_shipment_csv(queryset):
+    """Yield CSV lines for the given shipments without materialising the queryset"""
+    directions = dict(Shipment.Direction.choices)
+    statuses = dict(Shipment.Status.choices)
+    writer = csv.writer(Echo())
+    
+    yield writer.writerow(SHIPMENT_CSV_HEADER)
+    
+    # values_list() joins cluster, CC and creator in the same query and skips
+    # model instantiation; the totals are stored columns on the shipment row
+    rows = queryset.values_list(*SHIPMENT_CSV_COLUMNS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for (pk, direction, cluster_name, cc_code, status, eta,
+         total_packages, total_received, created_by, created_at) in rows:
+        yield writer.writerow([
+            pk,
+            directions.get(direction, direction),
+            cluster_name,
+            cc_code,
+            statuses.get(status, status),
+            eta,
+            total_packages,
+            total_received,
+            created_by,
+            created_at.strftime('%Y-%m-%d %H:%M'),
+        ])
@@ -0,0 +1,76 @@
+from datetime import datetime, time, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Shipment
+from .scope import shipment_scope
+
+
+def local_day_start(day):
+    """Aware datetime for local midnight at the start of `day`"""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def created_between(date_from=None, date_to=None):
+    """
+    Q for shipments created on the local dates date_from..date_to (inclusive).
+    
+    Expressed as a half-open range on created_at itself rather than
+    created_at__date, so the database compares raw timestamps and can use
+    an index instead of converting every row to local time.
+    """
+    condition = Q()
+    if date_from:
+        condition &= Q(created_at__gte=local_day_start(date_from))
+    if date_to:
+        condition &= Q(created_at__lt=local_day_start(date_to + timedelta(days=1)))
+    return condition
+
+
+def current_month_bounds():
+    """First and last local dates of the current month"""
+    today = timezone.localdate()
+    first = today.replace(day=1)
+    last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return first, last
+
+
+def filter_shipments(queryset, params):
+    """Apply the shipment list filters (cluster, direction, status, dates) from GET params"""
+    cluster = params.get('cluster')
+    direction = params.get('direction')
+    status = params.get('status')
+    date_from = params.get('date_from')
+    date_to = params.get('date_to')
+    
+    if cluster:
+        queryset = queryset.filter(cluster_id=cluster)
+    
+    if direction:
+        queryset = queryset.filter(direction=direction)
+    
+    if status:
+        queryset = queryset.filter(status=status)
+    
+    if date_from:
+        try:
+            date_from = datetime.strptime(date_from, '%Y-%m-%d').date()
+            queryset = queryset.filter(created_between(date_from=date_from))
+        except ValueError:
+            pass
+    
+    if date_to:
+        try:
+            date_to = datetime.strptime(date_to, '%Y-%m-%d').date()
+            queryset = queryset.filter(created_between(date_to=date_to))
+        except ValueError:
+            pass
+    
+    return queryset
+
+
+def shipments_for_request(request):
+    """Filtered, role-scoped shipments for the list view and its exports"""
+    queryset = filter_shipments(Shipment.objects.all(), request.GET)
+    return queryset.visible_to(shipment_scope(request)).order_by('-created_at')
@@ -1,7 +1,13 @@
+import json
+
 from django import forms
+from django.conf import settings
 from django.forms import inlineformset_factory, BaseInlineFormSet
 from django.core.exceptions import ValidationError
+from django.db import connection
 from .models import Shipment, ShipmentItem
+from .user_import import CSVImportReader, ImportFileError
+from org.directory import get_directory
 from org.models import Cluster, FCP
 from accounts.models import User
 
@@ -17,30 +23,18 @@ class ShipmentForm(forms.ModelForm):
         }
     
     def __init__(self, *args, **kwargs):
-        self.user = kwargs.pop('user', None)
+        self.scope = kwargs.pop('scope', None)
         super().__init__(*args, **kwargs)
         
-        if self.user:
-            try:
-                if self.user.role == User.Role.SDSA:
-                    # SDSA can only select from assigned clusters
-                    managed_clusters = self.user.managed_clusters.all()
-                    print(f"DEBUG: SDSA managed clusters: {list(managed_clusters)}")
-                    self.fields['cluster'].queryset = managed_clusters
-                elif self.user.role == User.Role.CC:
-                    # CC is restricted to their cluster
-                    try:
-                        cc_fcp = self.user.collection_centre.fcp
-                        self.fields['cluster'].queryset = Cluster.objects.filter(pk=cc_fcp.cluster.pk)
-                        self.fields['cluster'].initial = cc_fcp.cluster
-                        self.fields['cluster'].widget.attrs['readonly'] = True
-                    except Exception as e:
-                        print(f"DEBUG: CC error: {e}")
-                        pass
-            except Exception as e:
-                print(f"DEBUG: Form init error: {e}")
-                # Fallback to all clusters if there's an error
-                self.fields['cluster'].queryset = Cluster.objects.all()
+        if self.scope:
+            if self.scope.is_sdsa:
+                # SDSA can only select from assigned clusters
+                self.fields['cluster'].queryset = self.scope.clusters()
+            elif self.scope.is_collection_centre and self.scope.cc_cluster_id is not None:
+                # CC is restricted to their cluster
+                self.fields['cluster'].queryset = self.scope.clusters()
+                self.fields['cluster'].initial = self.scope.cc_cluster_id
+                self.fields['cluster'].widget.attrs['readonly'] = True
     
     def clean_cluster(self):
         cluster = self.cleaned_data.get('cluster')
@@ -48,12 +42,52 @@ class ShipmentForm(forms.ModelForm):
             raise ValidationError('Cluster is required.')
         
         # Check if cluster has a collection centre
-        if not cluster.get_collection_centre():
+        if cluster.pk not in get_directory().collection_centre_ids:
             raise ValidationError(f'No collection centre defined for cluster {cluster.name}.')
         
         return cluster
 
 
+class FCPChoices:
+    """
+    FCP options built once per request and shared by every form in a
+    ShipmentItemFormSet, for rendering and validation alike.
+
+    Entries come from the org directory, so building them costs no queries.
+    """
+    
+    def __init__(self, cluster_ids, include_collection_centres=True):
+        directory = get_directory()
+        entries = sorted(
+            (fcp for cluster_id in cluster_ids for fcp in directory.fcps_in(cluster_id)
+             if include_collection_centres or not fcp.is_collection_centre),
+            key=lambda fcp: (fcp.code, fcp.id)
+        )
+        self.fcps = {entry.id: directory.fcp(entry.id) for entry in entries}
+        self.choices = [('', 'Select FCP')] + [(fcp.pk, str(fcp)) for fcp in self.fcps.values()]
+
+
+class SharedFCPChoiceField(forms.ModelChoiceField):
+    """ModelChoiceField that renders and validates from an FCPChoices instead of querying"""
+    
+    def __init__(self, fcp_choices, **kwargs):
+        super().__init__(queryset=FCP.objects.none(), **kwargs)
+        self.fcp_choices = fcp_choices
+        self.choices = fcp_choices.choices
+    
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return self.fcp_choices.fcps[int(value)]
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice',
+                params={'value': value},
+            )
+
+
 class ShipmentItemForm(forms.ModelForm):
     class Meta:
         model = ShipmentItem
@@ -65,9 +99,17 @@ class ShipmentItemForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         self.cluster = kwargs.pop('cluster', None)
         self.direction = kwargs.pop('direction', None)
+        fcp_choices = kwargs.pop('fcp_choices', None)
         super().__init__(*args, **kwargs)
         
-        if self.cluster:
+        if fcp_choices is not None:
+            # Shared with the other forms in the formset; no per-form queries
+            self.fields['fcp'] = SharedFCPChoiceField(
+                fcp_choices,
+                label=self.fields['fcp'].label,
+                widget=forms.Select(attrs={'class': 'form-select fcp-select'}),
+            )
+        elif self.cluster:
             # Filter FCPs by cluster
             fcp_queryset = FCP.objects.filter(cluster=self.cluster)
             
@@ -88,13 +130,21 @@ class ShipmentItemForm(forms.ModelForm):
             raise ValidationError('Quantity must be greater than 0.')
         return qty
 
+    def _get_validation_exclusions(self):
+        exclude = super()._get_validation_exclusions()
+        if isinstance(self.fields['fcp'], SharedFCPChoiceField):
+            # Already checked against the shared choices; skip the per-row
+            # existence query ForeignKey.validate would run
+            exclude.add('fcp')
+        return exclude
+    
     def clean_fcp(self):
         fcp = self.cleaned_data.get('fcp')
         if not fcp:
             raise ValidationError('FCP is required.')
         
         # Validate that FCP belongs to the selected cluster
-        if self.cluster and fcp.cluster != self.cluster:
+        if self.cluster and fcp.cluster_id != self.cluster.pk:
             raise ValidationError(f'FCP {fcp.code} does not belong to the selected cluster {self.cluster.name}.')
         
         # Additional validation for collection centre FCPs
@@ -114,20 +164,31 @@ class ShipmentItemFormSet(BaseInlineFormSet):
         for form in self.forms:
             if form.cleaned_data and not form.cleaned_data.get('DELETE'):
                 fcp = form.cleaned_data.get('fcp')
+                if fcp is None:
+                    # The row's own error already explains this
+                    continue
                 if fcp in fcps:
                     raise ValidationError(f'Duplicate FCP {fcp.code} found in shipment.')
                 fcps.append(fcp)
         
         # Validate that all FCPs belong to the same cluster
         if fcps:
-            first_cluster = fcps[0].cluster
+            first_cluster_id = fcps[0].cluster_id
             for fcp in fcps[1:]:
-                if fcp.cluster != first_cluster:
-                    raise ValidationError(f'All FCPs in a shipment must belong to the same cluster. FCP {fcp.code} belongs to {fcp.cluster.name}, but {fcps[0].code} belongs to {first_cluster.name}.')
+                if fcp.cluster_id != first_cluster_id:
+                    clusters = get_directory().clusters
+                    raise ValidationError(f'All FCPs in a shipment must belong to the same cluster. FCP {fcp.code} belongs to {clusters[fcp.cluster_id].name}, but {fcps[0].code} belongs to {clusters[first_cluster_id].name}.')
         
         # Ensure at least one FCP is selected
         if not fcps:
             raise ValidationError('At least one FCP must be selected for the shipment.')
+    
+    def save_new_items(self):
+        """
+        Insert the items of a new shipment with one bulk_create, which also
+        refreshes the shipment's totals once, however many rows were posted
+        """
+        return ShipmentItem.objects.bulk_create(self.save(commit=False))
 
 
 # Create formset for shipment items
@@ -143,16 +204,100 @@ ShipmentItemFormSet = inlineformset_factory(
 )
 
 
+def max_quantity():
+    """The largest quantity the item and shipment total columns hold"""
+    return connection.ops.integer_field_range(
+        ShipmentItem._meta.get_field('qty_planned').get_internal_type()
+    )[1]
+
+
+class ShipmentRosterForm(ShipmentForm):
+    """
+    Outgoing shipment to many FCPs of one cluster at once.
+    
+    The page lists every FCP of the chosen cluster as a quantity grid and
+    posts the non-zero quantities as one JSON object, {fcp_id: qty}, which is
+    checked against the cluster in a single query.
+    """
+    quantities = forms.CharField(widget=forms.HiddenInput)
+    
+    def clean_quantities(self):
+        error = 'The FCP quantities could not be read. Please reload the page and try again.'
+        try:
+            data = json.loads(self.cleaned_data['quantities'])
+        except ValueError:
+            raise ValidationError(error)
+        if not isinstance(data, dict):
+            raise ValidationError(error)
+        
+        quantities = {}
+        for fcp_id, qty in data.items():
+            try:
+                fcp_id = int(fcp_id)
+            except ValueError:
+                raise ValidationError(error)
+            if not isinstance(qty, int) or isinstance(qty, bool) or qty < 0:
+                raise ValidationError('Quantities must be whole numbers of 0 or more.')
+            if qty:
+                quantities[fcp_id] = qty
+        
+        if not quantities:
+            raise ValidationError('At least one FCP must be given a quantity.')
+        # bulk_create skips the model fields' validators, and the shipment stores the sum
+        if sum(quantities.values()) > max_quantity():
+            raise ValidationError(f'The quantities cannot add up to more than {max_quantity()}.')
+        return quantities
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        cluster = cleaned_data.get('cluster')
+        quantities = cleaned_data.get('quantities')
+        
+        if cluster and quantities:
+            known = set(
+                FCP.objects.filter(cluster=cluster, pk__in=quantities).values_list('pk', flat=True)
+            )
+            unknown = len(quantities.keys() - known)
+            if unknown:
+                self.add_error('quantities', (
+                    f'{unknown} of the FCPs entered are not in cluster {cluster.name}. '
+                    'Please reload the page and try again.'
+                ))
+        return cleaned_data
+    
+    def build_items(self, shipment):
+        """Unsaved ShipmentItems for the validated quantities"""
+        return [
+            ShipmentItem(shipment=shipment, fcp_id=fcp_id, qty_planned=qty)
+            for fcp_id, qty in self.cleaned_data['quantities'].items()
+        ]
+
+
+def shipment_items_snapshot(shipment, items=None):
+    """The shipment's items with their FCPs, loaded in one query unless already given"""
+    if items is not None:
+        return list(items)
+    if shipment is None:
+        return []
+    return list(shipment.items.select_related('fcp'))
+
+
 class ConfirmReceiptForm(forms.Form):
-    """Form for confirming receipt of shipments"""
+    """
+    Form for confirming receipt of shipments.
+    
+    Pass `items` (the shipment's items with their FCPs) to share one load
+    between the form and the view that saves them.
+    """
     
     def __init__(self, *args, **kwargs):
         self.shipment = kwargs.pop('shipment', None)
+        self.items = shipment_items_snapshot(self.shipment, kwargs.pop('items', None))
         super().__init__(*args, **kwargs)
         
         if self.shipment:
             # Create fields for each shipment item
-            for item in self.shipment.items.all():
+            for item in self.items:
                 field_name = f'qty_received_{item.id}'
                 field_note = f'discrepancy_note_{item.id}'
                 
@@ -173,7 +318,7 @@ class ConfirmReceiptForm(forms.Form):
         cleaned_data = super().clean()
         
         if self.shipment:
-            for item in self.shipment.items.all():
+            for item in self.items:
                 qty_field = f'qty_received_{item.id}'
                 note_field = f'discrepancy_note_{item.id}'
                 
@@ -191,16 +336,85 @@ class ConfirmReceiptForm(forms.Form):
         return cleaned_data
 
 
+class DiscrepancyReceiptForm(forms.Form):
+    """
+    Receipt confirmation that only carries the items that differ from the plan.
+    
+    `discrepancies` is a JSON object {fcp_code: {"qty": n, "note": "..."}};
+    every item not listed is received in full. Only the listed items are
+    loaded, so the form costs the same however large the shipment is.
+    """
+    MODE = 'discrepancies'
+    
+    discrepancies = forms.CharField(widget=forms.HiddenInput, required=False)
+    
+    def __init__(self, *args, **kwargs):
+        self.shipment = kwargs.pop('shipment', None)
+        super().__init__(*args, **kwargs)
+        # Items that differ from the plan, with qty_received and the note applied
+        self.exceptions = []
+    
+    def clean_discrepancies(self):
+        raw = self.cleaned_data['discrepancies']
+        error = 'The discrepancies could not be read. Please reload the page and try again.'
+        try:
+            data = json.loads(raw) if raw else {}
+        except ValueError:
+            raise ValidationError(error)
+        if not isinstance(data, dict) or not all(isinstance(entry, dict) for entry in data.values()):
+            raise ValidationError(error)
+        
+        items = {}
+        if data:
+            listed = self.shipment.items.filter(fcp__code__in=data).select_related('fcp')
+            items = {item.fcp.code: item for item in listed}
+        unknown = sorted(code for code in data if code not in items)
+        if unknown:
+            raise ValidationError(f'Not in this shipment: {", ".join(unknown)}.')
+        
+        errors = []
+        for code, entry in data.items():
+            item = items[code]
+            qty = entry.get('qty')
+            note = entry.get('note') or ''
+            if (not isinstance(qty, int) or isinstance(qty, bool) or not 0 <= qty <= max_quantity()
+                    or not isinstance(note, str)):
+                errors.append(f'Enter a received quantity from 0 to {max_quantity()} for {code}.')
+                continue
+            note = note.strip()
+            if qty != item.qty_planned and not note:
+                errors.append(f'Please provide a note explaining the quantity discrepancy for {code}.')
+                continue
+            item.qty_received = qty
+            item.discrepancy_note = note
+            self.exceptions.append(item)
+        if errors:
+            raise ValidationError(errors)
+        # bulk_update skips the model fields' validators, and the shipment stores the sum
+        if self.shipment.total_received + self.totals_delta()[0] > max_quantity():
+            raise ValidationError(f'The received quantities cannot add up to more than {max_quantity()}.')
+        return data
+    
+    def totals_delta(self):
+        """(received_delta, discrepancy_delta) this confirmation applies to the shipment's stored totals"""
+        shipment = self.shipment
+        planned = sum(item.qty_planned for item in self.exceptions)
+        received = shipment.total_packages - planned + sum(item.qty_received for item in self.exceptions)
+        discrepancies = sum(item.has_discrepancy for item in self.exceptions)
+        return received - shipment.total_received, discrepancies - shipment.discrepancy_count
+
+
 class MarkDistributedForm(forms.Form):
     """Form for marking shipments as distributed"""
     
     def __init__(self, *args, **kwargs):
         self.shipment = kwargs.pop('shipment', None)
+        self.items = shipment_items_snapshot(self.shipment, kwargs.pop('items', None))
         super().__init__(*args, **kwargs)
         
         if self.shipment:
             # Create checkbox for each FCP
-            for item in self.shipment.items.all():
+            for item in self.items:
                 field_name = f'distributed_{item.id}'
                 self.fields[field_name] = forms.BooleanField(
                     label=f'Distributed to {item.fcp.code}',
@@ -254,6 +468,14 @@ class BulkUserImportForm(forms.Form):
         widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
     )
     
+    run_in_background = forms.BooleanField(
+        label='Run in Background',
+        help_text='Queue the import for the job worker; recommended for large files',
+        required=False,
+        initial=False,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+    
     def clean_csv_file(self):
         csv_file = self.cleaned_data.get('csv_file')
         if csv_file:
@@ -261,33 +483,18 @@ class BulkUserImportForm(forms.Form):
             if not csv_file.name.endswith('.csv'):
                 raise ValidationError('Please upload a CSV file.')
             
-            # Check file size (max 5MB)
-            if csv_file.size > 5 * 1024 * 1024:
-                raise ValidationError('File size must be less than 5MB.')
+            # Check file size
+            max_size = settings.USER_IMPORT_MAX_FILE_SIZE
+            if csv_file.size > max_size:
+                raise ValidationError(f'File size must be less than {max_size // (1024 * 1024)}MB.')
             
-            # Try to read the first few lines to validate format
+            # Validate the header from the first line only; rows are checked
+            # one at a time while the import runs
             try:
+                CSVImportReader(csv_file.chunks())
+            except ImportFileError as e:
+                raise ValidationError(str(e))
+            finally:
                 csv_file.seek(0)
-                content = csv_file.read().decode('utf-8')
-                lines = content.split('\n')
-                
-                if len(lines) < 2:
-                    raise ValidationError('CSV file must have at least a header row and one data row.')
-                
-                # Check if required columns exist
-                header = lines[0].lower().strip().split(',')
-                required_columns = ['username', 'first_name', 'last_name', 'email', 'role']
-                
-                for col in required_columns:
-                    if col not in header:
-                        raise ValidationError(f'CSV must contain a "{col}" column.')
-                
-                # Reset file pointer
-                csv_file.seek(0)
-                
-            except UnicodeDecodeError:
-                raise ValidationError('CSV file must be encoded in UTF-8.')
-            except Exception as e:
-                raise ValidationError(f'Error reading CSV file: {str(e)}')
         
         return csv_file
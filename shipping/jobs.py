@@ -0,0 +1,231 @@
+import logging
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Job, JobFileChunk
+
+
+logger = logging.getLogger(__name__)
+
+# kind -> (handler, payload keys to drop once the job is finished)
+HANDLERS = {}
+
+# Progress writes are throttled to one per this many seconds
+PROGRESS_INTERVAL = 1.0
+
+# Bytes stored per JobFileChunk row
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
+class UnknownJobKind(Exception):
+    pass
+
+
+def job_handler(kind, secret_keys=()):
+    """
+    Register `handler(job, progress)` as the runner for jobs of `kind`.
+    The handler returns a JSON-serialisable result (or None) and may call
+    `store_result_file(job, name, pieces)`; `secret_keys` are removed from
+    the payload when the job finishes.
+    """
+    def register(handler):
+        HANDLERS[kind] = (handler, tuple(secret_keys))
+        return handler
+    return register
+
+
+def submit(kind, user, payload=None, input_file=None, max_attempts=None):
+    """
+    Queue a job and return it; a worker picks it up once the transaction
+    commits. `input_file` is an iterable of byte chunks, such as
+    UploadedFile.chunks(), stored as they are read.
+    """
+    if kind not in HANDLERS:
+        raise UnknownJobKind(kind)
+    with transaction.atomic():
+        job = Job.objects.create(
+            kind=kind,
+            created_by=user,
+            payload=payload or {},
+            max_attempts=max_attempts or getattr(settings, 'JOB_MAX_ATTEMPTS', 3),
+        )
+        if input_file is not None:
+            write_file(job, JobFileChunk.Kind.INPUT, input_file)
+    return job
+
+
+def write_file(job, kind, pieces):
+    """
+    Store an iterable of str or bytes pieces as the job's `kind` file,
+    replacing any earlier one, in rows of about FILE_CHUNK_SIZE bytes.
+    Returns the number of bytes written.
+    """
+    JobFileChunk.objects.filter(job=job, kind=kind).delete()
+    buffer = bytearray()
+    seq = size = 0
+    for piece in pieces:
+        buffer += piece.encode() if isinstance(piece, str) else piece
+        if len(buffer) >= FILE_CHUNK_SIZE:
+            JobFileChunk.objects.create(job=job, kind=kind, seq=seq, data=bytes(buffer))
+            seq += 1
+            size += len(buffer)
+            buffer.clear()
+    if buffer:
+        JobFileChunk.objects.create(job=job, kind=kind, seq=seq, data=bytes(buffer))
+        size += len(buffer)
+    return size
+
+
+def read_file(job, kind):
+    """Yield the job's `kind` file as bytes, one stored chunk at a time"""
+    chunks = JobFileChunk.objects.filter(job=job, kind=kind).order_by('seq').values_list('data', flat=True)
+    for data in chunks.iterator(chunk_size=1):
+        yield bytes(data)
+
+
+def store_result_file(job, name, pieces):
+    """Write the job's result file from str or bytes (or an iterable of them)"""
+    if isinstance(pieces, (str, bytes)):
+        pieces = [pieces]
+    write_file(job, JobFileChunk.Kind.RESULT, pieces)
+    job.result_filename = name
+
+
+class Progress:
+    """Callable handed to handlers: progress(done, total=None, message=None)"""
+
+    def __init__(self, job):
+        self.job = job
+        self.last_write = 0
+
+    def __call__(self, done, total=None, message=None, force=False):
+        job = self.job
+        job.progress_done = done
+        if total is not None:
+            job.progress_total = total
+        if message is not None:
+            job.progress_message = message[:200]
+
+        now = time.monotonic()
+        if force or now - self.last_write >= PROGRESS_INTERVAL:
+            self.last_write = now
+            # Doubles as the heartbeat that keeps the job from being requeued
+            Job.objects.filter(pk=job.pk).update(
+                progress_done=job.progress_done,
+                progress_total=job.progress_total,
+                progress_message=job.progress_message,
+                heartbeat_at=timezone.now(),
+            )
+
+
+@contextmanager
+def heartbeat(job, interval=None):
+    """
+    Mark the claimed `job` alive every `interval` seconds while the block
+    runs, so a handler that reports no progress is not swept as stale and
+    run a second time.
+    """
+    interval = interval or getattr(settings, 'JOB_HEARTBEAT_INTERVAL', 60)
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(interval):
+                try:
+                    Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+                        heartbeat_at=timezone.now()
+                    )
+                except Exception:
+                    logger.warning('Heartbeat of job %s failed', job.pk, exc_info=True)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f'job-{job.pk}-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def retry_delay(attempts):
+    """Exponential backoff before retrying a failed attempt"""
+    base = getattr(settings, 'JOB_RETRY_DELAY', 30)
+    return timedelta(seconds=base * 2 ** (attempts - 1))
+
+
+def run_job(job):
+    """Run a claimed job and record its outcome, retrying failures with backoff"""
+    handler, secret_keys = HANDLERS.get(job.kind, (None, ()))
+    fields = ['status', 'finished_at', 'error', 'payload', 'result', 'result_filename',
+              'progress_done', 'progress_total', 'progress_message', 'run_after']
+
+    try:
+        if handler is None:
+            raise UnknownJobKind(job.kind)
+        with heartbeat(job):
+            result = handler(job, Progress(job))
+    except Exception:
+        job.error = traceback.format_exc()
+        if job.attempts < job.max_attempts and job.kind in HANDLERS:
+            logger.warning('Job %s failed on attempt %s, retrying', job.pk, job.attempts, exc_info=True)
+            job.status = Job.Status.QUEUED
+            job.run_after = timezone.now() + retry_delay(job.attempts)
+        else:
+            logger.error('Job %s failed after %s attempts', job.pk, job.attempts, exc_info=True)
+            job.status = Job.Status.FAILED
+    else:
+        job.status = Job.Status.SUCCEEDED
+        job.result = result
+        job.error = ''
+        if job.progress_total is not None:
+            job.progress_done = job.progress_total
+
+    if job.is_finished:
+        _clear_finished(job, secret_keys)
+
+    job.save(update_fields=fields)
+    return job
+
+
+def _clear_finished(job, secret_keys):
+    job.finished_at = timezone.now()
+    chunks = JobFileChunk.objects.filter(job=job)
+    if job.status == Job.Status.SUCCEEDED:
+        chunks = chunks.filter(kind=JobFileChunk.Kind.INPUT)
+    else:
+        job.result_filename = ''
+    chunks.delete()
+    for key in secret_keys:
+        job.payload.pop(key, None)
+
+
+def sweep_stale(older_than):
+    """
+    Requeue running jobs whose worker has not reported since `older_than`,
+    and fail those with no attempts left. Returns (requeued, failed).
+    """
+    requeued = Job.objects.requeue_stale(older_than)
+    failed = 0
+    with transaction.atomic():
+        exhausted = Job.objects.exhausted(older_than).select_for_update(skip_locked=True)
+        for job in exhausted:
+            logger.error('Job %s stopped reporting on attempt %s; not retrying', job.pk, job.attempts)
+            job.status = Job.Status.FAILED
+            job.locked_by = ''
+            job.error = (
+                f'The worker stopped reporting during attempt {job.attempts} of {job.max_attempts}, '
+                'most likely because it was killed.\n' + job.error
+            ).strip()
+            _clear_finished(job, HANDLERS.get(job.kind, (None, ()))[1])
+            job.save(update_fields=['status', 'locked_by', 'error', 'finished_at', 'result_filename', 'payload'])
+            failed += 1
+    return requeued, failed
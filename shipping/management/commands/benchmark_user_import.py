@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from shipping.models import ImportRun
+from shipping.user_import import hash_workers, import_users
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Time the bulk user import on generated rows; nothing is kept'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000, help='Number of users to import')
+        parser.add_argument('--workers', type=int, help='Password hashing processes (default: setting or CPU count)')
+
+    def handle(self, *args, **options):
+        count = options['rows']
+        workers = options['workers'] or hash_workers()
+        stamp = time.time_ns()
+        rows = [
+            {
+                'username': f'bench_{stamp}_{n}',
+                'first_name': 'Bench',
+                'last_name': f'User {n}',
+                'email': f'bench_{stamp}_{n}@example.com',
+                'role': 'ADMIN',
+            }
+            for n in range(count)
+        ]
+
+        started = time.perf_counter()
+        try:
+            with transaction.atomic():
+                run = ImportRun.objects.create(filename='benchmark')
+                import_users(run, enumerate(rows, start=2), workers=workers)
+                elapsed = time.perf_counter() - started
+                raise Rollback
+        except Rollback:
+            pass
+
+        created = run.created_count
+        self.stdout.write(
+            f'Imported {created} users in {elapsed:.2f}s with {workers} hashing '
+            f'process(es): {created / elapsed:.1f} rows/s (rolled back).'
+        )
+        if run.error_count:
+            self.stdout.write(self.style.WARNING(f'{run.error_count} rows failed.'))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from shipping.models import Shipment, TOTALS_FIELDS
+
+
+class Command(BaseCommand):
+    help = 'Check stored shipment totals against their items and optionally repair drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Recompute the totals of every drifted shipment',
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='With --fix, recompute totals for every shipment instead of only drifted ones',
+        )
+
+    def handle(self, *args, **options):
+        if options['fix'] and options['all']:
+            updated = Shipment.objects.refresh_totals()
+            self.stdout.write(self.style.SUCCESS(f'Recomputed totals for {updated} shipments.'))
+            return
+
+        drifted = Shipment.objects.with_drifted_totals().order_by('pk')
+        drifted_ids = []
+        for shipment in drifted:
+            drifted_ids.append(shipment.pk)
+            details = ', '.join(
+                f'{name} {getattr(shipment, name)} != {getattr(shipment, f"actual_{name}")}'
+                for name in TOTALS_FIELDS
+                if getattr(shipment, name) != getattr(shipment, f'actual_{name}')
+            )
+            self.stdout.write(f'Shipment #{shipment.pk}: {details}')
+
+        if not drifted_ids:
+            self.stdout.write(self.style.SUCCESS('All shipment totals are consistent.'))
+            return
+
+        if options['fix']:
+            Shipment.objects.filter(pk__in=drifted_ids).refresh_totals()
+            self.stdout.write(self.style.SUCCESS(f'Repaired totals for {len(drifted_ids)} shipments.'))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f'{len(drifted_ids)} shipments have drifted totals. Run with --fix to repair them.'
+            ))
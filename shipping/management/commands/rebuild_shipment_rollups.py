@@ -0,0 +1,30 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shipping.models import ShipmentDailyRollup
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily shipment rollup from the shipments table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='day_from', help='First local date to rebuild (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='day_to', help='Last local date to rebuild (YYYY-MM-DD)')
+
+    def handle(self, *args, **options):
+        try:
+            day_from = self.parse_day(options['day_from'])
+            day_to = self.parse_day(options['day_to'])
+        except ValueError as e:
+            raise CommandError(f'Invalid date: {e}')
+
+        rows = ShipmentDailyRollup.objects.rebuild(day_from, day_to)
+        span = f'{day_from or "the beginning"} to {day_to or "today"}'
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} rollup rows from {span}.'))
+
+    @staticmethod
+    def parse_day(value):
+        if not value:
+            return None
+        return datetime.strptime(value, '%Y-%m-%d').date()
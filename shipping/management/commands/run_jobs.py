@@ -0,0 +1,105 @@
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from shipping.jobs import run_job, sweep_stale
+from shipping.models import Job
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (imports, exports, reports)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int,
+            default=getattr(settings, 'JOB_WORKER_CONCURRENCY', 2),
+            help='Jobs run at the same time by this worker'
+        )
+        parser.add_argument('--kind', action='append', dest='kinds', help='Only run jobs of this kind (repeatable)')
+        parser.add_argument('--poll', type=float, default=2.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument(
+            '--stale-after', type=int,
+            default=getattr(settings, 'JOB_STALE_AFTER', 600),
+            help='Requeue running jobs with no progress for this many seconds'
+        )
+        parser.add_argument(
+            '--sweep-interval', type=float,
+            default=getattr(settings, 'JOB_SWEEP_INTERVAL', 60),
+            help='Seconds between checks for stale jobs'
+        )
+        parser.add_argument('--burst', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.stopping = threading.Event()
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, self.stop)
+
+        self.sweep()
+
+        self.stdout.write(f'Worker {self.name} running {options["concurrency"]} job(s) at a time.')
+        threads = [
+            threading.Thread(target=self.work, name=f'{self.name}/{n}')
+            for n in range(options['concurrency'])
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Jobs orphaned by other workers are picked up while this one runs
+        next_sweep = time.monotonic() + options['sweep_interval']
+        try:
+            while True:
+                alive = [thread for thread in threads if thread.is_alive()]
+                if not alive:
+                    break
+                alive[0].join(timeout=1)
+                if not self.stopping.is_set() and time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + options['sweep_interval']
+                    self.sweep()
+        finally:
+            connection.close()
+        self.stdout.write('Worker stopped.')
+
+    def sweep(self):
+        close_old_connections()
+        requeued, failed = sweep_stale(
+            timezone.now() - timedelta(seconds=self.options['stale_after'])
+        )
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} stale job(s).')
+        if failed:
+            self.stdout.write(f'Failed {failed} stale job(s) with no attempts left.')
+
+    def stop(self, signum, frame):
+        self.stdout.write('Finishing running jobs before exiting...')
+        self.stopping.set()
+
+    def work(self):
+        worker = threading.current_thread().name
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                job = Job.objects.claim(worker, self.options['kinds'])
+                if job is None:
+                    if self.options['burst']:
+                        return
+                    self.stopping.wait(self.options['poll'])
+                    continue
+
+                self.stdout.write(f'{worker}: running {job} (attempt {job.attempts})')
+                job = run_job(job)
+                self.stdout.write(f'{worker}: {job}')
+        finally:
+            # Each thread has its own connection
+            connection.close()
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:53
+
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_totals(apps, schema_editor):
+    Shipment = apps.get_model('shipping', 'Shipment')
+    ShipmentItem = apps.get_model('shipping', 'ShipmentItem')
+
+    def item_subquery(aggregate):
+        items = ShipmentItem.objects.filter(shipment=OuterRef('pk')).order_by()
+        return Coalesce(
+            Subquery(items.values('shipment').annotate(value=aggregate).values('value')),
+            0
+        )
+
+    Shipment.objects.update(
+        total_packages=item_subquery(Sum('qty_planned')),
+        total_received=item_subquery(Sum('qty_received')),
+        item_count=item_subquery(Count('id')),
+        discrepancy_count=item_subquery(Count('id', filter=Q(
+            qty_received__isnull=False
+        ) & ~Q(qty_received=F('qty_planned')))),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shipping', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shipment',
+            name='discrepancy_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='shipment',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='shipment',
+            name='total_packages',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='shipment',
+            name='total_received',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:57
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction, and avoids
+    # locking the shipment table against writes while the indexes build
+    atomic = False
+
+    dependencies = [
+        ('org', '0001_initial'),
+        ('shipping', '0002_shipment_totals'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='shipment',
+            index=models.Index(fields=['created_at', 'id'], name='shipment_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='shipment',
+            index=models.Index(fields=['cluster', 'created_at', 'id'], name='shipment_cluster_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='shipment',
+            index=models.Index(fields=['cluster', 'direction', 'status', 'created_at'], name='shipment_cl_dir_status_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='shipment',
+            index=models.Index(condition=models.Q(('status', 'CREATED')), fields=['direction', 'cluster', 'created_at'], name='shipment_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.5 on 2026-10-17 03:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollup(apps, schema_editor):
+    Shipment = apps.get_model('shipping', 'Shipment')
+    ShipmentDailyRollup = apps.get_model('shipping', 'ShipmentDailyRollup')
+
+    rows = Shipment.objects.order_by().values_list(
+        TruncDate('created_at'), 'cluster_id', 'direction', 'status'
+    ).annotate(count=Count('id'))
+    ShipmentDailyRollup.objects.bulk_create(
+        [
+            ShipmentDailyRollup(
+                day=day, cluster_id=cluster_id, direction=direction, status=status, count=count
+            )
+            for day, cluster_id, direction, status, count in rows
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('org', '0001_initial'),
+        ('shipping', '0003_shipment_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShipmentDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('direction', models.CharField(choices=[('OUT', 'Outgoing (SDSA → Collection Centre)'), ('RET', 'Return (Collection Centre → SDSA)')], max_length=3)),
+                ('status', models.CharField(choices=[('CREATED', 'Created/Sent'), ('RECEIVED_CC', 'Received at Collection Centre'), ('DISTRIBUTED', 'Distributed to FCPs'), ('RECEIVED_NO', 'Received at National Office'), ('POSTED', 'Posted')], max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('cluster', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shipment_rollups', to='org.cluster')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['cluster', 'day'], name='shipment_rollup_cluster_idx')],
+                'constraints': [models.UniqueConstraint(fields=('day', 'cluster', 'direction', 'status'), name='shipment_rollup_key')],
+            },
+        ),
+        migrations.RunPython(backfill_rollup, migrations.RunPython.noop),
+    ]
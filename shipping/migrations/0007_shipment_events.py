@@ -0,0 +1,36 @@
+# Generated by Django 5.2.5 on 2026-10-17 03:29
+
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('org', '0001_initial'),
+        ('shipping', '0006_import_runs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShipmentEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.CharField(choices=[('CREATED', 'Created/Sent'), ('RECEIVED_CC', 'Received at Collection Centre'), ('DISTRIBUTED', 'Distributed to FCPs'), ('RECEIVED_NO', 'Received at National Office'), ('POSTED', 'Posted')], max_length=20)),
+                ('to_status', models.CharField(choices=[('CREATED', 'Created/Sent'), ('RECEIVED_CC', 'Received at Collection Centre'), ('DISTRIBUTED', 'Distributed to FCPs'), ('RECEIVED_NO', 'Received at National Office'), ('POSTED', 'Posted')], max_length=20)),
+                ('occurred_at', models.DateTimeField()),
+                ('received_delta', models.IntegerField(default=0)),
+                ('discrepancy_delta', models.IntegerField(default=0)),
+                ('actor', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('cluster', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='org.cluster')),
+                ('shipment', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='events', to='shipping.shipment')),
+            ],
+            options={
+                'ordering': ['occurred_at', 'id'],
+                'indexes': [models.Index(fields=['shipment', 'occurred_at'], name='shipment_event_timeline_idx'), django.contrib.postgres.indexes.BrinIndex(fields=['occurred_at'], name='shipment_event_time_brin')],
+            },
+        ),
+    ]
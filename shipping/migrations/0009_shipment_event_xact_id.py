@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-17 03:57
+
+import shipping.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('org', '0001_initial'),
+        ('shipping', '0008_request_profiles'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shipmentevent',
+            name='xact_id',
+            field=models.BigIntegerField(db_default=shipping.models.CurrentTransactionId(), editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='shipmentevent',
+            index=models.Index(fields=['xact_id', 'id'], name='shipment_event_feed_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.5 on 2026-10-17 04:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_files_to_chunks(apps, schema_editor):
+    Job = apps.get_model('shipping', 'Job')
+    JobFileChunk = apps.get_model('shipping', 'JobFileChunk')
+
+    for field, kind in (('input_file', 'INPUT'), ('result_file', 'RESULT')):
+        jobs = Job.objects.filter(**{f'{field}__isnull': False}).values_list('pk', field)
+        for job_id, data in jobs.iterator(chunk_size=1):
+            JobFileChunk.objects.create(job_id=job_id, kind=kind, seq=0, data=bytes(data))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shipping', '0009_shipment_event_xact_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobFileChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('INPUT', 'Input'), ('RESULT', 'Result')], max_length=6)),
+                ('seq', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='file_chunks', to='shipping.job')),
+            ],
+            options={
+                'ordering': ['job', 'kind', 'seq'],
+                'constraints': [models.UniqueConstraint(fields=('job', 'kind', 'seq'), name='job_file_chunk_seq_uniq')],
+            },
+        ),
+        migrations.RunPython(move_files_to_chunks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='job',
+            name='input_file',
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='result_file',
+        ),
+    ]
@@ -1,8 +1,161 @@
-from django.db import models
+import operator
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import reduce
+
+from django.db import models, transaction
 from django.core.exceptions import ValidationError
-from django.db.models import Sum
+from django.contrib.postgres.indexes import BrinIndex
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Sum, When
+from django.db.models.functions import Coalesce, Greatest, TruncDate
+from django.utils import timezone
 from accounts.models import User
 from org.models import Cluster, FCP
+from .cache import bump_cluster_versions
+
+
+# Stored on Shipment and maintained from ShipmentItem writes
+TOTALS_FIELDS = ('total_packages', 'total_received', 'item_count', 'discrepancy_count')
+
+# ShipmentItem fields that feed into the stored totals
+TOTALS_SOURCE_FIELDS = {'shipment', 'shipment_id', 'qty_planned', 'qty_received'}
+
+# Shipment fields that decide which ShipmentDailyRollup row a shipment counts towards
+ROLLUP_SOURCE_FIELDS = {'created_at', 'cluster', 'cluster_id', 'direction', 'status'}
+
+
+def rollup_counts(queryset):
+    """Counter of shipments per (local day, cluster id, direction, status)"""
+    rows = queryset.order_by().values_list(
+        TruncDate('created_at'), 'cluster_id', 'direction', 'status'
+    ).annotate(count=Count('id'))
+    return Counter({key[:4]: key[4] for key in rows})
+
+
+def actual_totals_expressions():
+    """Subquery expressions computing each stored total from the shipment's items"""
+    def item_subquery(aggregate):
+        items = ShipmentItem.objects.filter(shipment=OuterRef('pk')).order_by()
+        return Coalesce(
+            Subquery(items.values('shipment').annotate(value=aggregate).values('value')),
+            0
+        )
+
+    return {
+        'total_packages': item_subquery(Sum('qty_planned')),
+        'total_received': item_subquery(Sum('qty_received')),
+        'item_count': item_subquery(Count('id')),
+        'discrepancy_count': item_subquery(Count('id', filter=Q(
+            qty_received__isnull=False
+        ) & ~Q(qty_received=F('qty_planned')))),
+    }
+
+
+_local = threading.local()
+
+
+@contextmanager
+def refreshing_totals_once():
+    """
+    Within the block, ShipmentItem queryset writes note the shipments they
+    touch instead of each refreshing their totals; one UPDATE refreshes them
+    all when the block exits without an error. Use it inside a transaction.
+    """
+    if getattr(_local, 'totals_batch', None) is not None:
+        # The outer block refreshes
+        yield
+        return
+    batch = _local.totals_batch = {}
+    try:
+        yield
+    finally:
+        _local.totals_batch = None
+    _refresh_totals(batch)
+
+
+def _refresh_totals(shipment_clusters):
+    """
+    Refresh the stored totals of the shipments in a {shipment id: cluster id}
+    mapping, where a cluster id of None means it is not known
+    """
+    batch = getattr(_local, 'totals_batch', None)
+    if batch is not None:
+        for shipment_id, cluster_id in shipment_clusters.items():
+            if batch.get(shipment_id) is None:
+                batch[shipment_id] = cluster_id
+        return
+    if not shipment_clusters:
+        return
+    cluster_ids = set(shipment_clusters.values())
+    Shipment.objects.filter(pk__in=shipment_clusters).refresh_totals(
+        None if None in cluster_ids else cluster_ids
+    )
+
+
+class ClusterScopedQuerySet(models.QuerySet):
+    def visible_to(self, scope):
+        """Rows in the clusters the user behind a ShipmentScope may see"""
+        cluster_ids = scope.visible_cluster_ids
+        if cluster_ids is None:
+            return self
+        if not cluster_ids:
+            return self.none()
+        return self.filter(cluster_id__in=cluster_ids)
+
+
+class ShipmentQuerySet(ClusterScopedQuerySet):
+    def update(self, **kwargs):
+        if not ROLLUP_SOURCE_FIELDS.intersection(kwargs):
+            return super().update(**kwargs)
+        
+        # Move the updated shipments between rollup rows by diffing their
+        # grouped counts before and after the update
+        with transaction.atomic(using=self.db):
+            pks = list(self.values_list('pk', flat=True))
+            before = rollup_counts(Shipment.objects.filter(pk__in=pks))
+            rows = super().update(**kwargs)
+            after = rollup_counts(Shipment.objects.filter(pk__in=pks))
+            changes = Counter(after)
+            changes.subtract(before)
+            ShipmentDailyRollup.objects.apply(changes)
+        return rows
+    
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            counts = rollup_counts(self)
+            result = super().delete()
+            ShipmentDailyRollup.objects.apply({key: -count for key, count in counts.items()})
+        return result
+    
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        ShipmentDailyRollup.objects.apply(Counter(obj.rollup_key() for obj in objs))
+        for obj in objs:
+            obj._snapshot_rollup_key()
+        return objs
+    
+    def refresh_totals(self, cluster_ids=None):
+        """
+        Recompute the stored totals of every shipment in this queryset in one
+        UPDATE, and invalidate cached dashboards for their clusters. Callers
+        that know the clusters pass `cluster_ids` to save looking them up.
+        """
+        updated = self.update(**actual_totals_expressions())
+        if updated:
+            if cluster_ids is None:
+                cluster_ids = self.order_by().values_list('cluster_id', flat=True).distinct()
+            bump_cluster_versions(cluster_ids)
+        return updated
+
+    def with_drifted_totals(self):
+        """Shipments whose stored totals no longer match their items"""
+        expressions = actual_totals_expressions()
+        queryset = self.annotate(**{f'actual_{name}': expr for name, expr in expressions.items()})
+        drift = Q()
+        for name in TOTALS_FIELDS:
+            drift |= ~Q(**{name: F(f'actual_{name}')})
+        return queryset.filter(drift)
 
 
 class Shipment(models.Model):
@@ -55,8 +208,33 @@ class Shipment(models.Model):
         related_name='created_shipments'
     )
     
+    # Denormalized totals, kept in step with the items by ShipmentItem
+    total_packages = models.PositiveIntegerField(default=0, editable=False)
+    total_received = models.PositiveIntegerField(default=0, editable=False)
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    discrepancy_count = models.PositiveIntegerField(default=0, editable=False)
+    
+    objects = ShipmentQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Unscoped list/keyset pages, admin changelist, date-range reports
+            models.Index(fields=['created_at', 'id'], name='shipment_created_idx'),
+            # Role-scoped list pages and per-cluster monthly stats
+            models.Index(fields=['cluster', 'created_at', 'id'], name='shipment_cluster_created_idx'),
+            # Filtered list pages and dashboard breakdowns
+            models.Index(
+                fields=['cluster', 'direction', 'status', 'created_at'],
+                name='shipment_cl_dir_status_idx'
+            ),
+            # Pending confirmations; only a small slice of shipments is ever CREATED
+            models.Index(
+                fields=['direction', 'cluster', 'created_at'],
+                name='shipment_pending_idx',
+                condition=models.Q(status='CREATED')
+            ),
+        ]
     
     def __str__(self):
         return f"{self.get_direction_display()} - {self.cluster.name} - {self.get_status_display()}"
@@ -66,19 +244,59 @@ class Shipment(models.Model):
         # Basic validation only
         pass
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_rollup_key()
+        return instance
+    
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._snapshot_rollup_key()
+    
     def save(self, *args, **kwargs):
-        # Simple save without complex logic
-        super().save(*args, **kwargs)
+        adding = self._state.adding
+        loaded_key = getattr(self, '_loaded_rollup_key', None)
+        
+        # Never write back in-memory totals over ones maintained by item writes
+        if not adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in TOTALS_FIELDS
+            ]
+        
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            new_key = self.rollup_key()
+            if adding:
+                ShipmentDailyRollup.objects.apply({new_key: 1})
+            elif loaded_key is None:
+                # Rollup fields were deferred when loaded; fall back to a rebuild of the day
+                ShipmentDailyRollup.objects.rebuild_day(new_key[0])
+            elif loaded_key != new_key:
+                ShipmentDailyRollup.objects.apply({loaded_key: -1, new_key: 1})
+        self._snapshot_rollup_key()
     
-    @property
-    def total_packages(self):
-        """Auto-calculated total from shipment items"""
-        return self.items.aggregate(total=Sum('qty_planned'))['total'] or 0
+    def rollup_key(self):
+        """The (local day, cluster id, direction, status) rollup row this shipment counts towards"""
+        return (
+            timezone.localdate(self.created_at),
+            self.cluster_id,
+            self.direction,
+            self.status,
+        )
     
-    @property
-    def total_received(self):
-        """Total received packages"""
-        return self.items.aggregate(total=Sum('qty_received'))['total'] or 0
+    def _snapshot_rollup_key(self):
+        loaded = self.__dict__
+        if all(name in loaded for name in ('created_at', 'cluster_id', 'direction', 'status')):
+            self._loaded_rollup_key = self.rollup_key()
+        else:
+            self._loaded_rollup_key = None
+    
+    def refresh_totals(self):
+        """Recompute the stored totals from the items and reload them"""
+        Shipment.objects.filter(pk=self.pk).refresh_totals()
+        self.refresh_from_db(fields=TOTALS_FIELDS)
     
     def can_confirm_receipt(self):
         """Check if shipment can be confirmed as received"""
@@ -90,46 +308,29 @@ class Shipment(models.Model):
     
     def can_confirm_receipt_as_user(self, user):
         """Check if specific user can confirm receipt"""
-        if not self.can_confirm_receipt():
-            return False
-        
-        if self.direction == self.Direction.OUT:
-            # For outgoing shipments, only Collection Centre users can confirm
-            return user.is_collection_centre() and user.collection_centre.fcp.cluster == self.cluster
-        else:  # RET
-            # For return shipments, only SDSA users can confirm
-            return user.is_sdsa() and self.cluster in user.managed_clusters.all()
+        from .scope import ShipmentScope
+        return ShipmentScope.for_user(user).can_confirm_receipt(self)
     
     @property
     def can_confirm_receipt_for_current_user(self):
         """Property to check if current user can confirm receipt (for templates)"""
-        # This will be set by the view context
-        if hasattr(self, '_current_user'):
-            return self.can_confirm_receipt_as_user(self._current_user)
+        # The view attaches the request's ShipmentScope
+        if hasattr(self, '_scope'):
+            return self._scope.can_confirm_receipt(self)
         return False
     
     @property
     def can_mark_distributed_for_current_user(self):
         """Property to check if current user can mark as distributed (for templates)"""
-        if hasattr(self, '_current_user'):
-            user = self._current_user
-            # Only SDSA users can mark as distributed for outgoing shipments
-            return (user.is_sdsa() and 
-                    self.direction == self.Direction.OUT and 
-                    self.status == self.Status.RECEIVED_CC and
-                    self.cluster in user.managed_clusters.all())
+        if hasattr(self, '_scope'):
+            return self._scope.can_mark_distributed(self)
         return False
     
     @property
     def can_mark_posted_for_current_user(self):
         """Property to check if current user can mark as posted (for templates)"""
-        if hasattr(self, '_current_user'):
-            user = self._current_user
-            # Only SDSA users can mark as posted for return shipments
-            return (user.is_sdsa() and 
-                    self.direction == self.Direction.RET and 
-                    self.status == self.Status.RECEIVED_NO and
-                    self.cluster in user.managed_clusters.all())
+        if hasattr(self, '_scope'):
+            return self._scope.can_mark_posted(self)
         return False
     
     def can_mark_distributed(self):
@@ -143,6 +344,39 @@ class Shipment(models.Model):
                 self.status == self.Status.RECEIVED_NO)
 
 
+class ShipmentItemQuerySet(models.QuerySet):
+    """Keeps shipment totals correct for writes that bypass ShipmentItem.save()"""
+    
+    def _shipment_clusters(self):
+        """{shipment id: cluster id} for the items matched, in one query"""
+        return dict(self.order_by().values_list('shipment_id', 'shipment__cluster_id').distinct())
+    
+    def update(self, **kwargs):
+        if not TOTALS_SOURCE_FIELDS.intersection(kwargs):
+            return super().update(**kwargs)
+        
+        shipment_clusters = self._shipment_clusters()
+        target = kwargs.get('shipment_id', kwargs.get('shipment'))
+        if target is not None:
+            shipment_clusters.setdefault(getattr(target, 'pk', target), getattr(target, 'cluster_id', None))
+        
+        rows = super().update(**kwargs)
+        _refresh_totals(shipment_clusters)
+        return rows
+    
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        # Items are usually built from their shipment, which knows its cluster
+        _refresh_totals({obj.shipment_id: obj._shipment_cluster_id(obj.shipment_id) for obj in objs})
+        return objs
+    
+    def delete(self):
+        shipment_clusters = self._shipment_clusters()
+        result = super().delete()
+        _refresh_totals(shipment_clusters)
+        return result
+
+
 class ShipmentItem(models.Model):
     shipment = models.ForeignKey(
         Shipment,
@@ -158,6 +392,8 @@ class ShipmentItem(models.Model):
     qty_received = models.PositiveIntegerField(null=True, blank=True)
     discrepancy_note = models.TextField(blank=True)
     
+    objects = ShipmentItemQuerySet.as_manager()
+    
     class Meta:
         unique_together = ['shipment', 'fcp']
         ordering = ['fcp__code']
@@ -170,9 +406,75 @@ class ShipmentItem(models.Model):
         # Basic validation only
         pass
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_totals()
+        return instance
+    
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._snapshot_totals()
+    
     def save(self, *args, **kwargs):
-        # Simple save without validation
+        adding = self._state.adding
+        loaded = getattr(self, '_loaded_totals', None)
         super().save(*args, **kwargs)
+        
+        cluster_id = self._shipment_cluster_id(self.shipment_id)
+        if adding:
+            self._apply_totals(self.shipment_id, self.totals_contribution(), cluster_id)
+        elif loaded is None:
+            # Totals fields were deferred when loaded, so no delta is known
+            _refresh_totals({self.shipment_id: cluster_id})
+        else:
+            old_shipment_id, old_contribution = loaded
+            new_contribution = self.totals_contribution()
+            if old_shipment_id == self.shipment_id:
+                self._apply_totals(self.shipment_id, {
+                    name: new_contribution[name] - old_contribution[name]
+                    for name in TOTALS_FIELDS
+                }, cluster_id)
+            else:
+                self._apply_totals(old_shipment_id, {
+                    name: -value for name, value in old_contribution.items()
+                })
+                self._apply_totals(self.shipment_id, new_contribution, cluster_id)
+        self._snapshot_totals()
+    
+    def totals_contribution(self):
+        """What this item adds to each of its shipment's stored totals"""
+        return {
+            'total_packages': self.qty_planned or 0,
+            'total_received': self.qty_received or 0,
+            'item_count': 1,
+            'discrepancy_count': 1 if self.has_discrepancy else 0,
+        }
+    
+    def _snapshot_totals(self):
+        loaded = self.__dict__
+        if all(name in loaded for name in ('shipment_id', 'qty_planned', 'qty_received')):
+            self._loaded_totals = (self.shipment_id, self.totals_contribution())
+        else:
+            self._loaded_totals = None
+    
+    def _shipment_cluster_id(self, shipment_id):
+        """The cluster of shipment `shipment_id` when this item holds it already, else None"""
+        shipment = self._state.fields_cache.get('shipment')
+        if shipment is not None and shipment.pk == shipment_id:
+            return shipment.cluster_id
+        return None
+    
+    @staticmethod
+    def _apply_totals(shipment_id, delta, cluster_id=None):
+        """Add `delta` to the shipment's stored totals; pass its `cluster_id` if known"""
+        changes = {name: F(name) + value for name, value in delta.items() if value}
+        if shipment_id is not None and changes:
+            shipment = Shipment.objects.filter(pk=shipment_id)
+            if shipment.update(**changes):
+                bump_cluster_versions(
+                    [cluster_id] if cluster_id is not None else shipment.values_list('cluster_id', flat=True)
+                )
     
     @property
     def has_discrepancy(self):
@@ -180,3 +482,454 @@ class ShipmentItem(models.Model):
         if self.qty_received is None:
             return False
         return self.qty_received != self.qty_planned
+
+
+class ShipmentDailyRollupQuerySet(ClusterScopedQuerySet):
+    def apply(self, changes):
+        """
+        Add each delta in a {(day, cluster_id, direction, status): delta} mapping,
+        and invalidate cached dashboards for the clusters that changed.
+        """
+        changes = {key: delta for key, delta in changes.items() if delta}
+        if not changes:
+            return
+        fields = ('day', 'cluster_id', 'direction', 'status')
+        
+        def row(key):
+            return Q(**dict(zip(fields, key)))
+        
+        # Missing rows are created empty first, so the UPDATE below finds every
+        # row however other requests interleave; sorted, so concurrent inserts
+        # wait on each other in the same order rather than deadlocking
+        self.bulk_create(
+            [self.model(count=0, **dict(zip(fields, key))) for key in sorted(changes)],
+            ignore_conflicts=True,
+        )
+        self.filter(reduce(operator.or_, map(row, changes))).update(count=Greatest(
+            Case(
+                *(When(row(key), then=F('count') + delta) for key, delta in changes.items()),
+                default=F('count'), output_field=models.IntegerField(),
+            ),
+            0
+        ))
+        bump_cluster_versions({cluster_id for _, cluster_id, _, _ in changes})
+    
+    def rebuild(self, day_from=None, day_to=None):
+        """Recompute rollup rows from the shipments table, optionally for a date range only"""
+        from .filters import created_between
+        
+        with transaction.atomic(using=self.db):
+            stale = self.all()
+            if day_from:
+                stale = stale.filter(day__gte=day_from)
+            if day_to:
+                stale = stale.filter(day__lte=day_to)
+            stale.delete()
+            
+            counts = rollup_counts(Shipment.objects.filter(created_between(day_from, day_to)))
+            self.bulk_create(
+                [
+                    ShipmentDailyRollup(
+                        day=day, cluster_id=cluster_id, direction=direction,
+                        status=status, count=count
+                    )
+                    for (day, cluster_id, direction, status), count in counts.items()
+                ],
+                batch_size=1000
+            )
+        return len(counts)
+    
+    def rebuild_day(self, day):
+        return self.rebuild(day, day)
+    
+    def status_counts(self):
+        """Shipment counts in the same shape as the dashboards' monthly_stats"""
+        Direction, Status = Shipment.Direction, Shipment.Status
+        
+        def total(**conditions):
+            return Coalesce(Sum('count', filter=Q(**conditions)), 0)
+        
+        return self.aggregate(
+            outgoing_created=total(direction=Direction.OUT),
+            outgoing_received=total(
+                direction=Direction.OUT,
+                status__in=[Status.RECEIVED_CC, Status.DISTRIBUTED]
+            ),
+            returns_created=total(direction=Direction.RET),
+            returns_received=total(
+                direction=Direction.RET,
+                status__in=[Status.RECEIVED_NO, Status.POSTED]
+            ),
+            returns_posted=total(direction=Direction.RET, status=Status.POSTED),
+        )
+
+
+class ShipmentDailyRollup(models.Model):
+    """
+    Shipment counts per local creation date, cluster, direction and current status.
+    
+    Maintained incrementally as shipments are created and change status, so
+    dashboards read a handful of rows instead of scanning shipments.
+    """
+    day = models.DateField()
+    cluster = models.ForeignKey(
+        Cluster,
+        on_delete=models.CASCADE,
+        related_name='shipment_rollups'
+    )
+    direction = models.CharField(max_length=3, choices=Shipment.Direction.choices)
+    status = models.CharField(max_length=20, choices=Shipment.Status.choices)
+    count = models.PositiveIntegerField(default=0)
+    
+    objects = ShipmentDailyRollupQuerySet.as_manager()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'cluster', 'direction', 'status'],
+                name='shipment_rollup_key'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['cluster', 'day'], name='shipment_rollup_cluster_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.day} - {self.cluster_id} - {self.direction} - {self.status}: {self.count}"
+
+
+class CurrentTransactionId(models.Func):
+    """The id of the transaction running the statement (PostgreSQL 13+)"""
+    template = '(pg_current_xact_id()::text::bigint)'
+    output_field = models.BigIntegerField()
+
+
+class OldestRunningTransactionId(models.Func):
+    """Transaction ids below this belong to transactions that have committed or rolled back"""
+    template = '(pg_snapshot_xmin(pg_current_snapshot())::text::bigint)'
+    output_field = models.BigIntegerField()
+
+
+class ShipmentEventQuerySet(ClusterScopedQuerySet):
+    def after(self, cursor):
+        """
+        Settled events after `cursor`, an (xact_id, id) pair or None, in feed order.
+        
+        Ids are taken at INSERT but transactions commit in any order, so the
+        feed is ordered by the inserting transaction and only serves
+        transactions older than every one still running. Nothing that
+        commits later can then sort before an event already served.
+        """
+        queryset = self.filter(xact_id__lt=OldestRunningTransactionId()).order_by('xact_id', 'id')
+        if cursor:
+            xact_id, event_id = cursor
+            queryset = queryset.filter(Q(xact_id__gt=xact_id) | Q(xact_id=xact_id, id__gt=event_id))
+        return queryset
+    
+    def occurred_between(self, start=None, end=None):
+        """Events in a half-open [start, end) time range"""
+        queryset = self
+        if start is not None:
+            queryset = queryset.filter(occurred_at__gte=start)
+        if end is not None:
+            queryset = queryset.filter(occurred_at__lt=end)
+        return queryset
+
+
+class ShipmentEvent(models.Model):
+    """
+    One shipment status transition, appended in the transaction that applies it.
+    
+    Rows are never updated. Received quantities are stored as the change the
+    transition made to the shipment's totals, so consumers can fold the stream
+    into their own aggregates.
+    """
+    # The timeline index leads with the shipment, so no separate FK indexes
+    shipment = models.ForeignKey(
+        Shipment,
+        on_delete=models.CASCADE,
+        related_name='events',
+        db_index=False
+    )
+    cluster = models.ForeignKey(
+        Cluster,
+        on_delete=models.CASCADE,
+        related_name='+',
+        db_index=False
+    )
+    actor = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        db_index=False
+    )
+    from_status = models.CharField(max_length=20, choices=Shipment.Status.choices)
+    to_status = models.CharField(max_length=20, choices=Shipment.Status.choices)
+    occurred_at = models.DateTimeField()
+    received_delta = models.IntegerField(default=0)
+    discrepancy_delta = models.IntegerField(default=0)
+    # Transaction that inserted the event, for the feed's commit-safe order
+    xact_id = models.BigIntegerField(db_default=CurrentTransactionId(), editable=False)
+    
+    objects = ShipmentEventQuerySet.as_manager()
+    
+    class Meta:
+        ordering = ['occurred_at', 'id']
+        indexes = [
+            # Detail page timeline
+            models.Index(fields=['shipment', 'occurred_at'], name='shipment_event_timeline_idx'),
+            # Time-range scans; rows arrive in time order, so a BRIN index stays tiny
+            BrinIndex(fields=['occurred_at'], name='shipment_event_time_brin'),
+            # Events feed
+            models.Index(fields=['xact_id', 'id'], name='shipment_event_feed_idx'),
+        ]
+    
+    def __str__(self):
+        return f"#{self.shipment_id}: {self.from_status} → {self.to_status}"
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError('Shipment events are append-only')
+        super().save(*args, **kwargs)
+
+
+class JobQuerySet(models.QuerySet):
+    def runnable(self):
+        return self.filter(
+            status=Job.Status.QUEUED, run_after__lte=timezone.now(), attempts__lt=F('max_attempts')
+        )
+    
+    def claim(self, worker, kinds=None):
+        """
+        Lock the next runnable job for `worker` and mark it running, or return None.
+        SKIP LOCKED lets any number of workers poll the same table without
+        handing one job to two of them.
+        """
+        with transaction.atomic():
+            jobs = self.runnable()
+            if kinds:
+                jobs = jobs.filter(kind__in=kinds)
+            job = jobs.select_for_update(skip_locked=True).order_by('run_after', 'id').first()
+            if job is None:
+                return None
+            now = timezone.now()
+            job.status = Job.Status.RUNNING
+            job.attempts += 1
+            job.locked_by = worker
+            job.started_at = now
+            job.heartbeat_at = now
+            job.save(update_fields=['status', 'attempts', 'locked_by', 'started_at', 'heartbeat_at'])
+        return job
+    
+    def stale(self, older_than):
+        """Running jobs whose worker has not reported since `older_than`"""
+        return self.filter(status=Job.Status.RUNNING, heartbeat_at__lt=older_than)
+    
+    def requeue_stale(self, older_than):
+        """Put back stale jobs that have attempts left; returns how many"""
+        return self.stale(older_than).filter(attempts__lt=F('max_attempts')).update(
+            status=Job.Status.QUEUED, locked_by='', run_after=timezone.now()
+        )
+    
+    def exhausted(self, older_than):
+        """
+        Stale or queued jobs that have used all their attempts. A job that
+        kills its worker never records a failure, so these are failed by
+        jobs.sweep_stale() rather than retried forever.
+        """
+        return self.filter(
+            Q(status=Job.Status.RUNNING, heartbeat_at__lt=older_than) | Q(status=Job.Status.QUEUED),
+            attempts__gte=F('max_attempts'),
+        )
+
+
+class Job(models.Model):
+    """
+    A unit of background work (import, export, report) queued in the database
+    and run by `manage.py run_jobs`, so heavy requests do not hold a web worker.
+    """
+    class Status(models.TextChoices):
+        QUEUED = 'QUEUED', 'Queued'
+        RUNNING = 'RUNNING', 'Running'
+        SUCCEEDED = 'SUCCEEDED', 'Succeeded'
+        FAILED = 'FAILED', 'Failed'
+    
+    kind = models.CharField(max_length=50)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    payload = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    # Set once the job has written its result file (JobFileChunk rows)
+    result_filename = models.CharField(max_length=200, blank=True)
+    
+    progress_done = models.PositiveIntegerField(default=0)
+    progress_total = models.PositiveIntegerField(null=True, blank=True)
+    progress_message = models.CharField(max_length=200, blank=True)
+    
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    error = models.TextField(blank=True)
+    
+    created_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='jobs'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = JobQuerySet.as_manager()
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(
+                fields=['run_after', 'id'],
+                name='job_queued_idx',
+                condition=Q(status='QUEUED')
+            ),
+            models.Index(fields=['created_by', '-created_at'], name='job_owner_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.get_status_display()})"
+    
+    @property
+    def is_finished(self):
+        return self.status in (self.Status.SUCCEEDED, self.Status.FAILED)
+    
+    def can_view(self, scope):
+        return scope.is_admin or self.created_by_id == scope.user_id
+
+
+class JobFileChunk(models.Model):
+    """
+    One piece of a job's uploaded input or produced result file. Files are
+    kept in the database so the web and worker processes need no shared
+    filesystem, and in chunks so neither side holds a whole file in memory.
+    """
+    class Kind(models.TextChoices):
+        INPUT = 'INPUT', 'Input'
+        RESULT = 'RESULT', 'Result'
+    
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name='file_chunks')
+    kind = models.CharField(max_length=6, choices=Kind.choices)
+    seq = models.PositiveIntegerField()
+    data = models.BinaryField()
+    
+    class Meta:
+        ordering = ['job', 'kind', 'seq']
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'kind', 'seq'], name='job_file_chunk_seq_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} chunk {self.seq} of job #{self.job_id}"
+
+
+class ImportRun(models.Model):
+    """One bulk user import, with per-row outcomes in ImportRowResult"""
+    class Status(models.TextChoices):
+        PENDING = 'PENDING', 'Pending'
+        RUNNING = 'RUNNING', 'Running'
+        COMPLETED = 'COMPLETED', 'Completed'
+        FAILED = 'FAILED', 'Failed'
+    
+    filename = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    rows_read = models.PositiveIntegerField(default=0)
+    created_count = models.PositiveIntegerField(default=0)
+    warning_count = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    message = models.TextField(blank=True)
+    
+    created_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='import_runs'
+    )
+    job = models.ForeignKey(
+        Job,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='import_runs'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"Import #{self.pk} {self.filename} ({self.get_status_display()})"
+    
+    @property
+    def is_finished(self):
+        return self.status in (self.Status.COMPLETED, self.Status.FAILED)
+
+
+class ImportRowResult(models.Model):
+    """What happened to one row of an import; rows created cleanly keep no message"""
+    class Outcome(models.TextChoices):
+        CREATED = 'CREATED', 'Created'
+        WARNING = 'WARNING', 'Created with warning'
+        ERROR = 'ERROR', 'Not imported'
+    
+    run = models.ForeignKey(ImportRun, on_delete=models.CASCADE, related_name='rows')
+    row_number = models.PositiveIntegerField()
+    outcome = models.CharField(max_length=7, choices=Outcome.choices)
+    username = models.CharField(max_length=150, blank=True)
+    message = models.CharField(max_length=255, blank=True)
+    
+    class Meta:
+        ordering = ['row_number', 'id']
+        indexes = [
+            models.Index(fields=['run', 'outcome', 'row_number'], name='import_row_outcome_idx'),
+            models.Index(fields=['run', 'row_number'], name='import_row_number_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Row {self.row_number}: {self.get_outcome_display()}"
+
+
+class RequestProfile(models.Model):
+    """
+    One request profiled on demand by an admin (see
+    letterflow.middleware.ProfilingMiddleware), kept for download.
+    """
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    view_name = models.CharField(max_length=200, blank=True)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    query_count = models.PositiveIntegerField(null=True, blank=True)
+    # Largest amount of memory traced while the request ran, in bytes
+    peak_memory = models.PositiveBigIntegerField(default=0)
+    # cProfile stats in the pstats file format, for snakeviz or pstats.Stats
+    stats = models.BinaryField(editable=False)
+    # Functions by cumulative time, with the calls they made
+    call_tree = models.TextField(blank=True)
+    # Allocations still held when the response was ready, by source line
+    allocations = models.TextField(blank=True)
+    
+    created_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='+'
+    )
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"Profile #{self.pk} {self.method} {self.path} ({self.duration_ms:.0f} ms)"
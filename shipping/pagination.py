@@ -0,0 +1,129 @@
+import base64
+import json
+from datetime import datetime
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created_at, pk):
+    """Opaque cursor for a (created_at, id) position"""
+    raw = f'{created_at.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+
+
+def estimate_count(queryset):
+    """
+    Planner row estimate for the queryset on PostgreSQL, or None elsewhere.
+    Cheap regardless of table size, unlike COUNT(*).
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    try:
+        sql, params = queryset.order_by().query.sql_with_params()
+    except EmptyResultSet:
+        # e.g. .none() for users who can see no shipments
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetPage:
+    """A page of objects addressed by (created_at, id) cursors rather than offsets"""
+    
+    def __init__(self, object_list, has_next, has_previous, estimated_total=None):
+        self.object_list = object_list
+        self.has_next_page = has_next
+        self.has_previous_page = has_previous
+        self.estimated_total = estimated_total
+    
+    def __iter__(self):
+        return iter(self.object_list)
+    
+    def __len__(self):
+        return len(self.object_list)
+    
+    def has_next(self):
+        return self.has_next_page
+    
+    def has_previous(self):
+        return self.has_previous_page
+    
+    def has_other_pages(self):
+        return self.has_next_page or self.has_previous_page
+    
+    @property
+    def next_cursor(self):
+        if self.has_next_page and self.object_list:
+            last = self.object_list[-1]
+            return encode_cursor(last.created_at, last.pk)
+        return None
+    
+    @property
+    def previous_cursor(self):
+        if self.has_previous_page and self.object_list:
+            first = self.object_list[0]
+            return encode_cursor(first.created_at, first.pk)
+        return None
+
+
+class KeysetPaginator:
+    """
+    Newest-first pagination over (created_at, id).
+    
+    Each page is a single indexed range scan of per_page + 1 rows, so deep pages
+    cost the same as the first one and no COUNT(*) is issued.
+    """
+    
+    def __init__(self, queryset, per_page, estimate_total=False):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.estimate_total = estimate_total
+    
+    def page(self, after=None, before=None):
+        """Page following the `after` cursor, preceding the `before` cursor, or the first page"""
+        queryset = self.queryset
+        if before:
+            created_at, pk = decode_cursor(before)
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk)
+            ).order_by('created_at', 'id')
+        else:
+            if after:
+                created_at, pk = decode_cursor(after)
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+                )
+            queryset = queryset.order_by('-created_at', '-id')
+        
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        
+        if before:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, bool(after)
+        
+        estimated_total = estimate_count(self.queryset) if self.estimate_total else None
+        return KeysetPage(rows, has_next, has_previous, estimated_total)
@@ -0,0 +1,119 @@
+from org.models import Cluster, CollectionCentreUser
+from accounts.models import User
+from .models import Shipment
+
+
+class ShipmentScope:
+    """
+    Everything the shipment permission checks need to know about a user,
+    loaded once per request.
+
+    All checks are answered from the ids held here, so rendering a page of
+    shipments costs no extra queries however many rows it shows.
+    """
+
+    def __init__(self, user_id, role, managed_cluster_ids=(), cc_cluster_id=None, cc_fcp_id=None):
+        self.user_id = user_id
+        self.role = role
+        self.managed_cluster_ids = frozenset(managed_cluster_ids)
+        self.cc_cluster_id = cc_cluster_id
+        self.cc_fcp_id = cc_fcp_id
+
+    @classmethod
+    def for_user(cls, user):
+        """
+        Build the scope with at most one query.
+        
+        Cluster ownership and CC links are read from the database rather than
+        the per-process org directory, so a user whose clusters are reassigned
+        or whose link is removed loses access on their next request in every
+        worker, whatever cache backend is configured.
+        """
+        if user.is_sdsa():
+            return cls(
+                user.pk, user.role,
+                managed_cluster_ids=Cluster.objects.filter(sdsa_owner_id=user.pk).values_list('pk', flat=True)
+            )
+        if user.is_collection_centre():
+            link = CollectionCentreUser.objects.filter(user_id=user.pk).values_list(
+                'fcp_id', 'fcp__cluster_id'
+            ).first()
+            if link:
+                fcp_id, cluster_id = link
+                return cls(user.pk, user.role, cc_cluster_id=cluster_id, cc_fcp_id=fcp_id)
+        return cls(user.pk, user.role)
+
+    @property
+    def is_admin(self):
+        return self.role == User.Role.ADMIN
+
+    @property
+    def is_sdsa(self):
+        return self.role == User.Role.SDSA
+
+    @property
+    def is_collection_centre(self):
+        return self.role == User.Role.CC
+
+    @property
+    def visible_cluster_ids(self):
+        """Cluster ids this user may see, or None for every cluster"""
+        if self.is_admin:
+            return None
+        if self.is_sdsa:
+            return self.managed_cluster_ids
+        if self.cc_cluster_id is not None:
+            return frozenset([self.cc_cluster_id])
+        return frozenset()
+
+    @property
+    def batch_cluster_ids(self):
+        """Cluster ids whose shipments the user may transition in batches, or None for every cluster"""
+        if self.is_admin:
+            return None
+        if self.is_sdsa:
+            return self.managed_cluster_ids
+        return frozenset()
+
+    def manages(self, cluster_id):
+        return self.is_sdsa and cluster_id in self.managed_cluster_ids
+
+    def can_access(self, shipment):
+        """Whether the user may view the shipment at all"""
+        cluster_ids = self.visible_cluster_ids
+        return cluster_ids is None or shipment.cluster_id in cluster_ids
+
+    def can_confirm_receipt(self, shipment):
+        if not shipment.can_confirm_receipt():
+            return False
+        if shipment.direction == Shipment.Direction.OUT:
+            # For outgoing shipments, only Collection Centre users can confirm
+            return (self.is_collection_centre and
+                    self.cc_cluster_id is not None and
+                    shipment.cluster_id == self.cc_cluster_id)
+        # For return shipments, only SDSA users can confirm
+        return self.manages(shipment.cluster_id)
+
+    def can_mark_distributed(self, shipment):
+        # Only SDSA users can mark as distributed for outgoing shipments
+        return shipment.can_mark_distributed() and self.manages(shipment.cluster_id)
+
+    def can_mark_posted(self, shipment):
+        # Only SDSA users can mark as posted for return shipments
+        return shipment.can_mark_posted() and self.manages(shipment.cluster_id)
+
+    def clusters(self):
+        """Clusters the user may see, as a queryset"""
+        cluster_ids = self.visible_cluster_ids
+        if cluster_ids is None:
+            return Cluster.objects.all()
+        return Cluster.objects.filter(pk__in=cluster_ids)
+
+
+def shipment_scope(request):
+    """The request's ShipmentScope, built on first use"""
+    scope = getattr(request, '_shipment_scope', None)
+    if scope is None or scope.user_id != request.user.pk:
+        scope = ShipmentScope.for_user(request.user)
+        request._shipment_scope = scope
+    return scope
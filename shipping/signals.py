@@ -0,0 +1,60 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from letterflow import metrics
+from org.models import Cluster, FCP
+from .cache import bump_fcp_directory_versions
+from .models import Shipment, ShipmentDailyRollup, ShipmentItem, TOTALS_FIELDS
+
+
+@receiver(post_delete, sender=ShipmentItem)
+def subtract_deleted_item_from_totals(sender, instance, origin=None, **kwargs):
+    """Keep shipment totals correct for single item and cascade deletes"""
+    # Either the shipment itself is going away, or ShipmentItemQuerySet.delete()
+    # recomputes the affected totals once the whole batch is gone
+    if isinstance(origin, Shipment) or getattr(origin, 'model', None) in (Shipment, ShipmentItem):
+        return
+    
+    loaded = getattr(instance, '_loaded_totals', None)
+    if loaded is None:
+        loaded = (instance.shipment_id, instance.totals_contribution())
+    shipment_id, contribution = loaded
+    instance._apply_totals(shipment_id, {
+        name: -contribution[name] for name in TOTALS_FIELDS
+    }, instance._shipment_cluster_id(shipment_id))
+
+
+@receiver(post_save, sender=Shipment)
+def count_created_shipment(sender, instance, created=False, raw=False, using=None, **kwargs):
+    """Shipments created per direction, for the metrics endpoint"""
+    if created and not raw:
+        metrics.inc_on_commit(metrics.SHIPMENTS_CREATED, using=using, direction=instance.direction)
+
+
+@receiver(post_delete, sender=Shipment)
+def subtract_deleted_shipment_from_rollup(sender, instance, origin=None, **kwargs):
+    """Keep the daily rollup correct for single shipment and cascade deletes"""
+    # Rollup rows go with their cluster, and ShipmentQuerySet.delete()
+    # adjusts the rollup for the whole batch itself
+    if isinstance(origin, Cluster) or getattr(origin, 'model', None) in (Cluster, Shipment):
+        return
+    
+    key = getattr(instance, '_loaded_rollup_key', None) or instance.rollup_key()
+    ShipmentDailyRollup.objects.apply({key: -1})
+
+
+@receiver(pre_save, sender=FCP)
+def remember_fcp_cluster(sender, instance, raw=False, **kwargs):
+    """Note the cluster an edited FCP was in, in case it is being moved"""
+    if instance.pk and not raw:
+        instance._saved_cluster_id = FCP.objects.filter(pk=instance.pk).values_list(
+            'cluster_id', flat=True
+        ).first()
+
+
+@receiver(post_save, sender=FCP)
+@receiver(post_delete, sender=FCP)
+def invalidate_fcp_directory(sender, instance, **kwargs):
+    """New rosters for the FCP's cluster, and the one it left if it moved"""
+    cluster_ids = {instance.cluster_id, getattr(instance, '_saved_cluster_id', None)}
+    bump_fcp_directory_versions(cluster_ids - {None})
@@ -0,0 +1,58 @@
+from datetime import date
+
+from django.urls import reverse
+
+from .dashboard import build_report
+from .exports import EXPORT_CHUNK_SIZE, iter_shipment_csv
+from .filters import filter_shipments
+from .jobs import job_handler, read_file, store_result_file
+from .models import ImportRun, JobFileChunk, Shipment
+from .scope import ShipmentScope
+from .user_import import CSVImportReader, import_users
+
+
+@job_handler('user_import', secret_keys=('default_password', 'default_password_hash'))
+def run_user_import(job, progress):
+    run = ImportRun.objects.get(pk=job.payload['run_id'])
+    import_users(
+        run, CSVImportReader(read_file(job, JobFileChunk.Kind.INPUT)),
+        job.payload.get('default_password', ''), progress=progress,
+        default_password_hash=job.payload.get('default_password_hash', ''),
+    )
+    return {
+        'created': run.created_count,
+        'errors': run.error_count,
+        'url': reverse('shipping:import_run_detail', args=[run.pk]),
+    }
+
+
+@job_handler('shipment_export')
+def run_shipment_export(job, progress):
+    scope = ShipmentScope.for_user(job.created_by)
+    shipments = filter_shipments(
+        Shipment.objects.all(), job.payload.get('params', {})
+    ).visible_to(scope).order_by('-created_at')
+
+    total = shipments.count()
+    progress(0, total, 'Writing CSV', force=True)
+
+    def lines():
+        # The first line is the header
+        for written, line in enumerate(iter_shipment_csv(shipments)):
+            yield line
+            if written and written % EXPORT_CHUNK_SIZE == 0:
+                progress(written, total)
+
+    # Stored a chunk at a time, so memory stays bounded as for streamed exports
+    store_result_file(job, 'shipments.csv', lines())
+    return {'rows': total}
+
+
+@job_handler('report')
+def run_report(job, progress):
+    scope = ShipmentScope.for_user(job.created_by)
+    return build_report(
+        scope,
+        date.fromisoformat(job.payload['date_from']),
+        date.fromisoformat(job.payload['date_to']),
+    )
@@ -1,3 +1,1598 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import admin
+from django.db import connection, connections, transaction
+from django.db.models import F
+from django.forms.models import model_to_dict
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from accounts.models import User
+from org import directory
+from org.models import Cluster, CollectionCentreUser, FCP
+from .admin import ShipmentAdmin, ShipmentAdminForm
+from .cache import ALL_CLUSTERS, cached_dashboard, cluster_versions, dashboard_cache, dashboard_cache_stats
+from .exports import SHIPMENT_CSV_HEADER
+from .forms import DiscrepancyReceiptForm, max_quantity
+from .jobs import read_file, run_job, submit, sweep_stale
+from .models import ImportRowResult, ImportRun, Job, JobFileChunk, Shipment, ShipmentDailyRollup, ShipmentEvent, ShipmentItem, rollup_counts
+from .pagination import encode_cursor
+from . import turnaround
+from .transitions import (
+    APPLIED, DISTRIBUTE, NOT_ALLOWED, NOT_FOUND, POST, RECEIVE, transition, transition_many
+)
+from .turnaround import turnaround_stats
+from .scope import ShipmentScope
+from .user_import import CSVImportReader, ImportFileError, import_users
+from .views import BATCH_TRANSITION_LIMIT
+
+
+def seq_scans(plan, relation):
+    """Every sequential scan on `relation` anywhere in an EXPLAIN (FORMAT JSON) plan"""
+    found = []
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') == relation:
+        found.append(plan)
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child, relation))
+    return found
+
+
+def settle_org_directory():
+    """
+    Forget the org writes setUpTestData left uncommitted, so the directory is
+    loaded once as it is in production rather than once per savepoint
+    """
+    directory._local.pending = None
+    directory._current = None
+    directory.get_directory()
+
+
+def count_queries(call):
+    """The number of queries call() runs"""
+    with CaptureQueriesContext(connection) as queries:
+        call()
+    return len(queries)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are checked against PostgreSQL only')
+class ShipmentQueryPlanTests(TestCase):
+    """The hot shipment queries must stay on indexes once the table is large"""
+
+    SHIPMENTS = 40000
+    CLUSTERS = 40
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('planner_admin', role=User.Role.ADMIN, must_change_password=False)
+        cls.sdsa = User.objects.create_user('planner_sdsa', role=User.Role.SDSA, must_change_password=False)
+        others = User.objects.create_user('planner_other_sdsa', role=User.Role.SDSA)
+        # The SDSA owns two clusters, as most do
+        cls.clusters = [
+            Cluster.objects.create(name=f'Cluster {n}', sdsa_owner=cls.sdsa if n < 2 else others)
+            for n in range(cls.CLUSTERS)
+        ]
+        centres = [
+            FCP.objects.create(code=f'UG{n:04d}', cluster=cluster, is_collection_centre=True)
+            for n, cluster in enumerate(cls.clusters)
+        ]
+        cls.cc_user = User.objects.create_user('planner_cc', role=User.Role.CC, must_change_password=False)
+        CollectionCentreUser.objects.create(user=cls.cc_user, fcp=centres[3])
+
+        shipments = []
+        for n in range(cls.SHIPMENTS):
+            direction = Shipment.Direction.OUT if n % 2 else Shipment.Direction.RET
+            done = Shipment.Status.DISTRIBUTED if n % 2 else Shipment.Status.POSTED
+            shipments.append(Shipment(
+                direction=direction,
+                cluster=cls.clusters[n % cls.CLUSTERS],
+                collection_centre=centres[n % cls.CLUSTERS],
+                estimated_delivery_date=timezone.localdate(),
+                status=Shipment.Status.CREATED if n % 50 == 0 else done,
+                created_by=cls.admin,
+            ))
+        Shipment.objects.bulk_create(shipments, batch_size=5000)
+
+        with connection.cursor() as cursor:
+            # Spread the history over five years, newest first
+            cursor.execute(
+                "UPDATE shipping_shipment SET created_at = now() - (id % 1825) * interval '1 day'"
+            )
+            cursor.execute('ANALYZE shipping_shipment')
+
+    def assertViewUsesIndexes(self, user, url, params=None):
+        """Every shipment query the view runs for `user` must avoid a sequential scan"""
+        table = Shipment._meta.db_table
+        self.client.force_login(user)
+        dashboard_cache().clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+
+        checked = 0
+        for query in queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or f'"{table}"' not in sql:
+                continue
+            if ' WHERE ' not in sql and ' LIMIT ' not in sql:
+                # Counts of the whole table read all of it by design
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+                plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            scans = seq_scans(plan[0]['Plan'], table)
+            self.assertFalse(scans, f'Sequential scan on shipments for:\n{sql}')
+            checked += 1
+        self.assertTrue(checked, f'No shipment queries ran for {url}')
+
+    def test_list_first_page(self):
+        for user in (self.admin, self.sdsa, self.cc_user):
+            with self.subTest(user=user.username):
+                self.assertViewUsesIndexes(user, '/shipping/shipments/')
+
+    def test_list_deep_keyset_page(self):
+        oldest = Shipment.objects.order_by('created_at', 'id')[500]
+        self.assertViewUsesIndexes(
+            self.admin, '/shipping/shipments/', {'after': encode_cursor(oldest.created_at, oldest.pk)}
+        )
+
+    def test_list_all_filters(self):
+        today = timezone.localdate()
+        self.assertViewUsesIndexes(self.admin, '/shipping/shipments/', {
+            'cluster': self.clusters[3].pk,
+            'direction': Shipment.Direction.OUT,
+            'status': Shipment.Status.DISTRIBUTED,
+            'date_from': (today - timedelta(days=90)).isoformat(),
+            'date_to': today.isoformat(),
+        })
+
+    def test_dashboards(self):
+        for user in (self.admin, self.sdsa, self.cc_user):
+            with self.subTest(user=user.username):
+                self.assertViewUsesIndexes(user, '/shipping/')
+
+    def test_reports_date_range(self):
+        for user in (self.admin, self.sdsa):
+            with self.subTest(user=user.username):
+                self.assertViewUsesIndexes(user, '/shipping/reports/')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Concurrent transitions need a server database')
+class ShipmentTransitionConcurrencyTests(TransactionTestCase):
+    """Parallel requests for the same transition must apply it exactly once"""
+
+    WORKERS = 8
+
+    def setUp(self):
+        sdsa = User.objects.create_user('transition_sdsa', role=User.Role.SDSA)
+        cluster = Cluster.objects.create(name='Transition Cluster', sdsa_owner=sdsa)
+        centre = FCP.objects.create(code='UG9000', cluster=cluster, is_collection_centre=True)
+        self.shipment = Shipment.objects.create(
+            direction=Shipment.Direction.OUT, cluster=cluster, collection_centre=centre,
+            estimated_delivery_date=timezone.localdate(), created_by=sdsa,
+        )
+
+    def race(self, action):
+        """Fire `action` at the shipment from every worker at once; returns each outcome"""
+        barrier = threading.Barrier(self.WORKERS)
+
+        def attempt(_):
+            try:
+                # Each thread loads its own copy, as separate requests would
+                shipment = Shipment.objects.get(pk=self.shipment.pk)
+                barrier.wait()
+                return transition(shipment, action)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(self.WORKERS) as pool:
+            return list(pool.map(attempt, range(self.WORKERS)))
+
+    def rollup_counts(self):
+        return dict(
+            ShipmentDailyRollup.objects.filter(count__gt=0).values_list('status', 'count')
+        )
+
+    def test_parallel_receipt_applies_once(self):
+        outcomes = self.race(RECEIVE)
+
+        self.assertEqual(outcomes.count(True), 1)
+        shipment = Shipment.objects.get(pk=self.shipment.pk)
+        self.assertEqual(shipment.status, Shipment.Status.RECEIVED_CC)
+        self.assertIsNotNone(shipment.received_at)
+        self.assertEqual(self.rollup_counts(), {Shipment.Status.RECEIVED_CC: 1})
+        self.assertEqual(
+            list(ShipmentEvent.objects.values_list('from_status', 'to_status')),
+            [(Shipment.Status.CREATED, Shipment.Status.RECEIVED_CC)]
+        )
+
+    def test_parallel_chain_stays_consistent(self):
+        self.assertEqual(self.race(RECEIVE).count(True), 1)
+        self.assertEqual(self.race(DISTRIBUTE).count(True), 1)
+        self.assertEqual(self.rollup_counts(), {Shipment.Status.DISTRIBUTED: 1})
+
+    def test_transition_requires_current_status(self):
+        stale = Shipment.objects.get(pk=self.shipment.pk)
+        self.assertTrue(transition(self.shipment, RECEIVE))
+
+        # The stale copy still says CREATED, but the row has moved on
+        self.assertFalse(transition(stale, RECEIVE))
+        self.assertEqual(stale.status, Shipment.Status.CREATED)
+        # Posting only applies to returns
+        self.assertFalse(transition(self.shipment, POST))
+        self.assertEqual(self.rollup_counts(), {Shipment.Status.RECEIVED_CC: 1})
+
+    def test_overlapping_batches_apply_each_shipment_once(self):
+        shipments = [self.shipment] + [
+            Shipment.objects.create(
+                direction=Shipment.Direction.OUT, cluster=self.shipment.cluster,
+                collection_centre=self.shipment.collection_centre,
+                estimated_delivery_date=timezone.localdate(), created_by=self.shipment.created_by,
+            )
+            for _ in range(11)
+        ]
+        for shipment in shipments:
+            transition(shipment, RECEIVE)
+        ids = [shipment.pk for shipment in shipments]
+        barrier = threading.Barrier(self.WORKERS)
+
+        def batch(n):
+            try:
+                barrier.wait()
+                # Each batch shares half its shipments with the next
+                return transition_many(ids[n % 4 * 3:n % 4 * 3 + 6], DISTRIBUTE)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(self.WORKERS) as pool:
+            results = list(pool.map(batch, range(self.WORKERS)))
+
+        applied = Counter(
+            pk for outcomes in results for pk, outcome in outcomes.items() if outcome == APPLIED
+        )
+        self.assertEqual(applied, Counter(ids))
+        self.assertEqual(self.rollup_counts(), {Shipment.Status.DISTRIBUTED: len(ids)})
+        self.assertEqual(
+            ShipmentEvent.objects.filter(to_status=Shipment.Status.DISTRIBUTED).count(), len(ids)
+        )
+
+
+class BatchTransitionTests(TestCase):
+    """Batch transitions report an outcome per shipment; admin status edits are logged"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('batch_sdsa', role=User.Role.SDSA, must_change_password=False)
+        other = User.objects.create_user('batch_other', role=User.Role.SDSA)
+        cls.cluster = Cluster.objects.create(name='Batch Cluster', sdsa_owner=cls.sdsa)
+        cls.other_cluster = Cluster.objects.create(name='Batch Other Cluster', sdsa_owner=other)
+        cls.centre = FCP.objects.create(code='UG9300', cluster=cls.cluster, is_collection_centre=True)
+        cls.superuser = User.objects.create_superuser('batch_root', password='x', role=User.Role.ADMIN)
+
+    def shipment(self, direction=Shipment.Direction.OUT, status=Shipment.Status.RECEIVED_CC, cluster=None):
+        return Shipment.objects.create(
+            direction=direction, cluster=cluster or self.cluster, collection_centre=self.centre,
+            estimated_delivery_date=timezone.localdate(), created_by=self.sdsa, status=status,
+        )
+
+    def assertRollupMatches(self):
+        stored = {
+            (row.day, row.cluster_id, row.direction, row.status): row.count
+            for row in ShipmentDailyRollup.objects.filter(count__gt=0)
+        }
+        self.assertEqual(stored, dict(rollup_counts(Shipment.objects.all())))
+
+    def test_outcome_per_shipment(self):
+        ready = self.shipment()
+        too_early = self.shipment(status=Shipment.Status.CREATED)
+        a_return = self.shipment(direction=Shipment.Direction.RET, status=Shipment.Status.RECEIVED_NO)
+        elsewhere = self.shipment(cluster=self.other_cluster)
+        missing = elsewhere.pk + 1000
+
+        outcomes = transition_many(
+            [ready.pk, too_early.pk, a_return.pk, elsewhere.pk, missing], DISTRIBUTE,
+            cluster_ids=[self.cluster.pk], actor=self.sdsa,
+        )
+        self.assertEqual(outcomes, {
+            ready.pk: APPLIED, too_early.pk: NOT_ALLOWED, a_return.pk: NOT_ALLOWED,
+            elsewhere.pk: NOT_FOUND, missing: NOT_FOUND,
+        })
+        self.assertEqual(
+            list(ShipmentEvent.objects.values_list('shipment_id', 'actor', 'to_status')),
+            [(ready.pk, self.sdsa.pk, Shipment.Status.DISTRIBUTED)],
+        )
+        self.assertRollupMatches()
+        # Done once; a second run finds it no longer in the starting status
+        self.assertEqual(transition_many([ready.pk], DISTRIBUTE), {ready.pk: NOT_ALLOWED})
+
+    def test_batch_limit(self):
+        self.client.force_login(self.sdsa)
+        shipment = self.shipment()
+        unknown = list(range(10 ** 6, 10 ** 6 + BATCH_TRANSITION_LIMIT))
+
+        def post(ids):
+            return self.client.post('/shipping/shipments/batch-transition/', {
+                'action': DISTRIBUTE, 'ids': ids,
+            }, HTTP_ACCEPT='application/json')
+
+        too_many = post([shipment.pk] + unknown)
+        self.assertEqual(too_many.status_code, 400)
+        self.assertEqual(Shipment.objects.get(pk=shipment.pk).status, Shipment.Status.RECEIVED_CC)
+
+        at_limit = post([shipment.pk] + unknown[1:])
+        self.assertEqual(at_limit.status_code, 200)
+        results = at_limit.json()['results']
+        self.assertEqual(len(results), BATCH_TRANSITION_LIMIT)
+        self.assertEqual(results[str(shipment.pk)], APPLIED)
+
+    def admin_save(self, shipment, **changes):
+        """Save the admin change form for `shipment` with `changes`; returns the form"""
+        data = {**model_to_dict(shipment), **changes}
+        form = ShipmentAdminForm(
+            {name: '' if value is None else value for name, value in data.items()}, instance=shipment
+        )
+        form.message_user = mock.Mock()
+        if form.is_valid():
+            request = RequestFactory().post('/')
+            request.user = self.superuser
+            model_admin = ShipmentAdmin(Shipment, admin.site)
+            model_admin.message_user = form.message_user
+            model_admin.save_model(request, form.save(commit=False), form, change=True)
+        return form
+
+    def test_admin_status_edit_is_a_transition(self):
+        shipment = self.shipment(status=Shipment.Status.CREATED)
+        form = self.admin_save(shipment, status=Shipment.Status.RECEIVED_CC, notes='Checked by phone')
+        form.message_user.assert_not_called()
+
+        shipment.refresh_from_db()
+        self.assertEqual((shipment.status, shipment.notes), (Shipment.Status.RECEIVED_CC, 'Checked by phone'))
+        self.assertIsNotNone(shipment.received_at)
+        self.assertEqual(
+            list(ShipmentEvent.objects.values_list('actor', 'from_status', 'to_status')),
+            [(self.superuser.pk, Shipment.Status.CREATED, Shipment.Status.RECEIVED_CC)],
+        )
+        self.assertRollupMatches()
+
+    def test_admin_rejects_status_jumps(self):
+        shipment = self.shipment(status=Shipment.Status.CREATED)
+        form = self.admin_save(shipment, status=Shipment.Status.DISTRIBUTED)
+        self.assertTrue(form.has_error('status'))
+        shipment.refresh_from_db()
+        self.assertEqual(shipment.status, Shipment.Status.CREATED)
+        self.assertFalse(ShipmentEvent.objects.exists())
+
+    def test_admin_status_edit_after_another_change(self):
+        shipment = self.shipment(status=Shipment.Status.CREATED)
+        stale = Shipment.objects.get(pk=shipment.pk)
+        transition(shipment, RECEIVE)
+        form = self.admin_save(stale, status=Shipment.Status.RECEIVED_CC)
+        form.message_user.assert_called_once()
+        self.assertEqual(ShipmentEvent.objects.count(), 1)
+        self.assertRollupMatches()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Commit order needs concurrent server transactions')
+class ShipmentEventFeedTests(TransactionTestCase):
+    """The events feed never skips an event that commits after a newer one"""
+
+    def setUp(self):
+        self.admin = User.objects.create_user('feed_admin', role=User.Role.ADMIN, must_change_password=False)
+        cluster = Cluster.objects.create(name='Feed Cluster', sdsa_owner=self.admin)
+        centre = FCP.objects.create(code='UG9100', cluster=cluster, is_collection_centre=True)
+        self.shipment = Shipment.objects.create(
+            direction=Shipment.Direction.OUT, cluster=cluster, collection_centre=centre,
+            estimated_delivery_date=timezone.localdate(), created_by=self.admin,
+        )
+        self.client.force_login(self.admin)
+
+    def append_event(self, to_status):
+        return ShipmentEvent.objects.create(
+            shipment=self.shipment, cluster_id=self.shipment.cluster_id,
+            from_status=Shipment.Status.CREATED, to_status=to_status, occurred_at=timezone.now(),
+        )
+
+    def feed(self, after='', **params):
+        return self.client.get('/shipping/shipments/events/', {'after': after, **params}).json()
+
+    def test_out_of_order_commits(self):
+        inserted = threading.Event()
+        commit = threading.Event()
+
+        def slow_transaction():
+            try:
+                with transaction.atomic():
+                    event = self.append_event(Shipment.Status.RECEIVED_CC)
+                    inserted.set()
+                    commit.wait(10)
+                return event.pk
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(1) as pool:
+            slow = pool.submit(slow_transaction)
+            inserted.wait(10)
+            # Gets the higher id but commits first
+            fast = self.append_event(Shipment.Status.DISTRIBUTED)
+
+            page = self.feed()
+            self.assertEqual(page['events'], [])
+            commit.set()
+            slow_id = slow.result()
+
+        self.assertLess(slow_id, fast.pk)
+        page = self.feed(page['next_after'])
+        self.assertEqual([event['id'] for event in page['events']], [slow_id, fast.pk])
+        self.assertEqual(self.feed(page['next_after'])['events'], [])
+        # A bare event id cursor resumes after that event
+        self.assertEqual([event['id'] for event in self.feed(str(slow_id))['events']], [fast.pk])
+
+    def test_pages_across_transactions_since(self):
+        old = self.append_event(Shipment.Status.RECEIVED_CC)
+        ShipmentEvent.objects.filter(pk=old.pk).update(occurred_at=timezone.now() - timedelta(days=2))
+        # Each in its own transaction
+        expected = [self.append_event(Shipment.Status.RECEIVED_CC).pk for _ in range(3)]
+        since = (timezone.now() - timedelta(days=1)).isoformat()
+
+        seen, after = [], ''
+        for more in (True, True, False):
+            page = self.feed(after, since=since, limit=1)
+            self.assertEqual(page['has_more'], more)
+            seen.extend(event['id'] for event in page['events'])
+            after = page['next_after']
+        self.assertEqual(seen, expected)
+        self.assertEqual(self.feed(after, since=since)['events'], [])
+
+    def test_limit_is_clamped(self):
+        self.append_event(Shipment.Status.RECEIVED_CC)
+        self.append_event(Shipment.Status.DISTRIBUTED)
+        self.assertEqual(len(self.feed(limit=-5)['events']), 1)
+        self.assertEqual(len(self.feed(limit=0)['events']), 1)
+        self.assertEqual(len(self.feed(limit=10 ** 6)['events']), 2)
+        response = self.client.get('/shipping/shipments/events/', {'limit': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class EmptyScopeTests(TestCase):
+    """Users who can see no shipments get empty pages, not errors"""
+
+    def test_shipment_list_without_collection_centre(self):
+        user = User.objects.create_user('unlinked_cc', role=User.Role.CC, must_change_password=False)
+        self.client.force_login(user)
+        response = self.client.get('/shipping/shipments/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['shipments']), [])
+
+    def test_reports_without_clusters(self):
+        user = User.objects.create_user('clusterless_sdsa', role=User.Role.SDSA, must_change_password=False)
+        self.client.force_login(user)
+        response = self.client.get('/shipping/reports/')
+        self.assertEqual(response.status_code, 200)
+
+
+class TurnaroundStatsTests(TestCase):
+    """Turnaround percentiles match known values, in SQL and in the fallback"""
+
+    @classmethod
+    def setUpTestData(cls):
+        sdsa = User.objects.create_user('turnaround_sdsa', role=User.Role.SDSA)
+        cls.clusters = [Cluster.objects.create(name=f'Turnaround {n}', sdsa_owner=sdsa) for n in range(2)]
+        start = timezone.now() - timedelta(days=30)
+        for cluster, days in zip(cls.clusters, (range(1, 11), (2, 4))):
+            centre = FCP.objects.create(code=f'UG93{cluster.pk:02d}', cluster=cluster, is_collection_centre=True)
+            for n in days:
+                shipment = Shipment.objects.create(
+                    direction=Shipment.Direction.OUT, cluster=cluster, collection_centre=centre,
+                    estimated_delivery_date=timezone.localdate(), created_by=sdsa,
+                )
+                Shipment.objects.filter(pk=shipment.pk).update(
+                    created_at=start, received_at=start + timedelta(days=n)
+                )
+        # Not received yet, so in no stage
+        Shipment.objects.create(
+            direction=Shipment.Direction.RET, cluster=cls.clusters[1], collection_centre=centre,
+            estimated_delivery_date=timezone.localdate(), created_by=sdsa,
+        )
+
+    def assert_stats(self, stats):
+        self.assertEqual([stage['key'] for stage in stats], ['outgoing_receipt'])
+        stage = stats[0]
+        expected = {
+            None: {'count': 12, 'mean': 61 / 12, 'median': 4.5, 'p90': 8.9, 'max': 10},
+            self.clusters[0].pk: {'count': 10, 'mean': 5.5, 'median': 5.5, 'p90': 9.1, 'max': 10},
+            self.clusters[1].pk: {'count': 2, 'mean': 3, 'median': 3, 'p90': 3.8, 'max': 4},
+        }
+        rows = {None: stage['overall'], **{row['cluster_id']: row for row in stage['clusters']}}
+        self.assertEqual(rows.keys(), expected.keys())
+        for cluster_id, values in expected.items():
+            for name, value in values.items():
+                with self.subTest(cluster=cluster_id, value=name):
+                    self.assertAlmostEqual(rows[cluster_id][name], value)
+
+    def test_postgres(self):
+        self.assert_stats(turnaround_stats(Shipment.objects.all()))
+
+    def test_fallback(self):
+        self.assert_stats(turnaround._collate(turnaround._python_rows(Shipment.objects.all())))
+
+
+class JobSweepTests(TestCase):
+    """Jobs whose worker dies are retried only while they have attempts left"""
+
+    def setUp(self):
+        self.admin = User.objects.create_user('job_admin', role=User.Role.ADMIN)
+
+    def orphan(self, max_attempts):
+        """Submit a user import, claim it and let its worker go silent"""
+        job = submit(
+            'user_import', self.admin, {'default_password_hash': 'hash', 'run_id': 0},
+            input_file=[b'username\n'], max_attempts=max_attempts,
+        )
+        Job.objects.claim('dead-worker')
+        Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        return job
+
+    def test_requeues_job_with_attempts_left(self):
+        job = self.orphan(max_attempts=2)
+        self.assertEqual(sweep_stale(timezone.now() - timedelta(minutes=10)), (1, 0))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.QUEUED)
+        self.assertEqual(Job.objects.claim('next-worker'), job)
+
+    def test_fails_job_out_of_attempts(self):
+        job = self.orphan(max_attempts=1)
+        self.assertEqual(sweep_stale(timezone.now() - timedelta(minutes=10)), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.FAILED)
+        self.assertIsNotNone(job.finished_at)
+        self.assertFalse(job.file_chunks.exists())
+        self.assertNotIn('default_password_hash', job.payload)
+        self.assertIsNone(Job.objects.claim('next-worker'))
+
+    def test_claim_skips_queued_job_out_of_attempts(self):
+        job = submit('user_import', self.admin, {'run_id': 0}, max_attempts=1)
+        Job.objects.filter(pk=job.pk).update(attempts=1)
+        self.assertIsNone(Job.objects.claim('worker'))
+        self.assertEqual(sweep_stale(timezone.now()), (0, 1))
+
+    def test_running_job_is_left_alone(self):
+        self.orphan(max_attempts=1)
+        self.assertEqual(sweep_stale(timezone.now() - timedelta(days=1)), (0, 0))
+
+
+class JobFileTests(TestCase):
+    """Export jobs write their file a chunk at a time and it downloads as a stream"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('job_file_sdsa', role=User.Role.SDSA, must_change_password=False)
+        cluster = Cluster.objects.create(name='Job File Cluster', sdsa_owner=cls.sdsa)
+        centre = FCP.objects.create(code='UG9400', cluster=cluster, is_collection_centre=True)
+        for n in range(12):
+            Shipment.objects.create(
+                direction=Shipment.Direction.OUT, cluster=cluster, collection_centre=centre,
+                estimated_delivery_date=timezone.localdate(), created_by=cls.sdsa,
+            )
+
+    def test_export_in_background(self):
+        self.client.force_login(self.sdsa)
+        streamed = b''.join(self.client.get('/shipping/shipments/export/').streaming_content)
+        self.client.get('/shipping/shipments/export/', {'background': '1'})
+        job = Job.objects.claim('test-worker')
+        with mock.patch('shipping.jobs.FILE_CHUNK_SIZE', 256):
+            job = run_job(job)
+        self.assertEqual(job.status, Job.Status.SUCCEEDED)
+        self.assertEqual(job.result, {'rows': 12})
+        self.assertGreater(job.file_chunks.count(), 1)
+
+        response = self.client.get(f'/shipping/jobs/{job.pk}/download/')
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), streamed)
+
+    def test_failed_job_keeps_no_files(self):
+        job = submit('shipment_export', self.sdsa, {'params': {}}, input_file=[b'data'], max_attempts=1)
+        job = Job.objects.claim('test-worker')
+        with mock.patch('shipping.tasks.iter_shipment_csv', side_effect=RuntimeError('disk full')):
+            job = run_job(job)
+        self.assertEqual(job.status, Job.Status.FAILED)
+        self.assertEqual(job.result_filename, '')
+        self.assertFalse(job.file_chunks.exists())
+
+
+class JobHeartbeatTests(TransactionTestCase):
+    """A running job stays fresh while its handler works without reporting progress"""
+
+    def test_heartbeat_while_running(self):
+        admin = User.objects.create_user('heartbeat_admin', role=User.Role.ADMIN)
+        submit('report', admin, {'date_from': '2024-01-01', 'date_to': '2024-01-31'})
+        job = Job.objects.claim('test-worker')
+        claimed_at = job.heartbeat_at
+
+        def silent(job, progress):
+            time.sleep(0.5)
+
+        with mock.patch.dict('shipping.jobs.HANDLERS', {'report': (silent, ())}), \
+                self.settings(JOB_HEARTBEAT_INTERVAL=0.1):
+            job = run_job(job)
+        self.assertEqual(job.status, Job.Status.SUCCEEDED)
+        job.refresh_from_db()
+        self.assertGreater(job.heartbeat_at, claimed_at)
+        self.assertEqual(sweep_stale(claimed_at + timedelta(microseconds=1)), (0, 0))
+
+
+class ShipmentTotalsTests(TestCase):
+    """Stored shipment totals follow every way items are written"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('totals_sdsa', role=User.Role.SDSA)
+        cls.cluster = Cluster.objects.create(name='Totals Cluster', sdsa_owner=cls.sdsa)
+        cls.centre = FCP.objects.create(code='UG9200', cluster=cls.cluster, is_collection_centre=True)
+        cls.fcps = [FCP.objects.create(code=f'UG92{n:02d}', cluster=cls.cluster) for n in range(1, 5)]
+
+    def setUp(self):
+        self.shipment = self.create_shipment()
+
+    def create_shipment(self):
+        return Shipment.objects.create(
+            direction=Shipment.Direction.OUT, cluster=self.cluster, collection_centre=self.centre,
+            estimated_delivery_date=timezone.localdate(), created_by=self.sdsa,
+        )
+
+    def assertTotals(self, shipment, total_packages, total_received, item_count, discrepancy_count):
+        shipment.refresh_from_db()
+        self.assertEqual(
+            (shipment.total_packages, shipment.total_received, shipment.item_count, shipment.discrepancy_count),
+            (total_packages, total_received, item_count, discrepancy_count),
+        )
+        self.assertFalse(Shipment.objects.with_drifted_totals().exists())
+
+    def add(self, fcp, qty_planned, qty_received=None, shipment=None):
+        return ShipmentItem.objects.create(
+            shipment=shipment or self.shipment, fcp=fcp,
+            qty_planned=qty_planned, qty_received=qty_received,
+        )
+
+    def test_create(self):
+        self.add(self.fcps[0], 10)
+        self.add(self.fcps[1], 5, qty_received=4)
+        self.assertTotals(self.shipment, 15, 4, 2, 1)
+
+    def test_edit(self):
+        item = self.add(self.fcps[0], 10)
+        item.qty_planned = 12
+        item.qty_received = 12
+        item.save()
+        self.assertTotals(self.shipment, 12, 12, 1, 0)
+
+        item = ShipmentItem.objects.get(pk=item.pk)
+        item.qty_received = 7
+        item.save()
+        self.assertTotals(self.shipment, 12, 7, 1, 1)
+
+    def test_edit_with_deferred_fields(self):
+        item = self.add(self.fcps[0], 10)
+        item = ShipmentItem.objects.only('id').get(pk=item.pk)
+        item.qty_planned = 3
+        item.save()
+        self.assertTotals(self.shipment, 3, 0, 1, 0)
+
+    def test_move_between_shipments(self):
+        other = self.create_shipment()
+        item = self.add(self.fcps[0], 10, qty_received=8)
+        self.add(self.fcps[1], 5)
+        item.shipment = other
+        item.save()
+        self.assertTotals(self.shipment, 5, 0, 1, 0)
+        self.assertTotals(other, 10, 8, 1, 1)
+
+    def test_delete(self):
+        item = self.add(self.fcps[0], 10, qty_received=9)
+        self.add(self.fcps[1], 5)
+        item.delete()
+        self.assertTotals(self.shipment, 5, 0, 1, 0)
+
+    def test_cascade_delete(self):
+        self.add(self.fcps[0], 10, qty_received=9)
+        self.add(self.fcps[1], 5)
+        self.fcps[0].delete()
+        self.assertTotals(self.shipment, 5, 0, 1, 0)
+
+    def test_queryset_delete(self):
+        for fcp in self.fcps:
+            self.add(fcp, 2)
+        self.shipment.items.filter(fcp__in=self.fcps[:3]).delete()
+        self.assertTotals(self.shipment, 2, 0, 1, 0)
+
+    def test_queryset_update(self):
+        for fcp in self.fcps:
+            self.add(fcp, 2)
+        self.shipment.items.update(qty_received=F('qty_planned'))
+        self.assertTotals(self.shipment, 8, 8, 4, 0)
+        self.shipment.items.filter(fcp=self.fcps[0]).update(qty_received=0)
+        self.assertTotals(self.shipment, 8, 6, 4, 1)
+
+    def test_queryset_update_moves_items(self):
+        other = self.create_shipment()
+        for fcp in self.fcps:
+            self.add(fcp, 2)
+        self.shipment.items.filter(fcp__in=self.fcps[:2]).update(shipment=other)
+        self.assertTotals(self.shipment, 4, 0, 2, 0)
+        self.assertTotals(other, 4, 0, 2, 0)
+
+    def test_bulk_create(self):
+        ShipmentItem.objects.bulk_create([
+            ShipmentItem(shipment=self.shipment, fcp=fcp, qty_planned=3, qty_received=2)
+            for fcp in self.fcps
+        ])
+        self.assertTotals(self.shipment, 12, 8, 4, 4)
+
+    def test_bulk_update(self):
+        items = [self.add(fcp, 3) for fcp in self.fcps]
+        for item in items:
+            item.qty_received = 3
+        items[0].qty_received = 1
+        ShipmentItem.objects.bulk_update(items, ['qty_received'])
+        self.assertTotals(self.shipment, 12, 10, 4, 1)
+
+
+class ShipmentRollupTests(TestCase):
+    """The daily rollup keeps matching the shipments table on every write path"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('rollup_sdsa', role=User.Role.SDSA)
+        cls.clusters = [
+            Cluster.objects.create(name=f'Rollup Cluster {n}', sdsa_owner=cls.sdsa) for n in range(2)
+        ]
+        cls.centres = [
+            FCP.objects.create(code=f'UG930{n}', cluster=cluster, is_collection_centre=True)
+            for n, cluster in enumerate(cls.clusters)
+        ]
+
+    def shipment(self, n=0, direction=Shipment.Direction.OUT, **fields):
+        return Shipment(
+            direction=direction, cluster=self.clusters[n], collection_centre=self.centres[n],
+            estimated_delivery_date=timezone.localdate(), created_by=self.sdsa, **fields,
+        )
+
+    def assertRollupMatches(self):
+        stored = {
+            (row.day, row.cluster_id, row.direction, row.status): row.count
+            for row in ShipmentDailyRollup.objects.filter(count__gt=0)
+        }
+        self.assertEqual(stored, dict(rollup_counts(Shipment.objects.all())))
+
+    def test_create_and_save(self):
+        shipment = self.shipment()
+        shipment.save()
+        self.shipment(direction=Shipment.Direction.RET).save()
+        self.assertRollupMatches()
+
+        shipment.status = Shipment.Status.RECEIVED_CC
+        shipment.save()
+        self.assertRollupMatches()
+
+        shipment = Shipment.objects.get(pk=shipment.pk)
+        shipment.cluster = self.clusters[1]
+        shipment.save()
+        self.assertRollupMatches()
+
+    def test_backdated_creation_date(self):
+        shipment = self.shipment()
+        shipment.save()
+        Shipment.objects.filter(pk=shipment.pk).update(created_at=timezone.now() - timedelta(days=3))
+        self.assertRollupMatches()
+
+    def test_delete(self):
+        shipments = Shipment.objects.bulk_create([self.shipment(n % 2) for n in range(4)])
+        self.assertRollupMatches()
+        shipments[0].delete()
+        self.assertRollupMatches()
+        Shipment.objects.filter(cluster=self.clusters[1]).delete()
+        self.assertRollupMatches()
+
+    def test_cascade_delete(self):
+        self.shipment(0).save()
+        self.shipment(1).save()
+        self.clusters[1].delete()
+        self.assertRollupMatches()
+
+    def test_queryset_update(self):
+        Shipment.objects.bulk_create([self.shipment(n % 2) for n in range(4)])
+        Shipment.objects.filter(cluster=self.clusters[0]).update(status=Shipment.Status.RECEIVED_CC)
+        self.assertRollupMatches()
+
+    def test_transitions(self):
+        shipment = self.shipment()
+        shipment.save()
+        self.assertTrue(transition(shipment, RECEIVE))
+        self.assertTrue(transition(shipment, DISTRIBUTE))
+        self.assertRollupMatches()
+
+    def test_rows_change_in_two_statements(self):
+        # Whether or not the rows exist yet: one insert of missing rows, one update
+        for shipment in (self.shipment(), self.shipment()):
+            shipment.save()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(transition(shipment, RECEIVE))
+            rollup_writes = [query for query in queries if 'shipping_shipmentdailyrollup' in query['sql']]
+            self.assertEqual(len(rollup_writes), 2)
+        self.assertRollupMatches()
+
+    def test_rebuild(self):
+        Shipment.objects.bulk_create([self.shipment(n % 2) for n in range(4)])
+        ShipmentDailyRollup.objects.all().update(count=99)
+        ShipmentDailyRollup.objects.rebuild()
+        self.assertRollupMatches()
+
+
+class DiscrepancyReceiptTests(TestCase):
+    """Receipt confirmed from the differing items alone"""
+
+    @classmethod
+    def setUpTestData(cls):
+        sdsa = User.objects.create_user('receipt_sdsa', role=User.Role.SDSA)
+        cls.cluster = Cluster.objects.create(name='Receipt Cluster', sdsa_owner=sdsa)
+        cls.centre = FCP.objects.create(code='UG9400', cluster=cls.cluster, is_collection_centre=True)
+        cls.fcps = [FCP.objects.create(code=f'UG94{n:02d}', cluster=cls.cluster) for n in range(1, 6)]
+        cls.cc_user = User.objects.create_user('receipt_cc', role=User.Role.CC, must_change_password=False)
+        CollectionCentreUser.objects.create(user=cls.cc_user, fcp=cls.centre)
+        cls.sdsa = sdsa
+
+    def setUp(self):
+        self.shipment = Shipment.objects.create(
+            direction=Shipment.Direction.OUT, cluster=self.cluster, collection_centre=self.centre,
+            estimated_delivery_date=timezone.localdate(), created_by=self.sdsa,
+        )
+        ShipmentItem.objects.bulk_create([
+            ShipmentItem(shipment=self.shipment, fcp=fcp, qty_planned=10) for fcp in self.fcps
+        ])
+        self.shipment.refresh_from_db()
+
+    def form(self, discrepancies):
+        return DiscrepancyReceiptForm(
+            {'mode': DiscrepancyReceiptForm.MODE, 'discrepancies': json.dumps(discrepancies)},
+            shipment=self.shipment,
+        )
+
+    def test_totals_delta(self):
+        form = self.form({
+            'UG9401': {'qty': 7, 'note': 'Three missing'},
+            'UG9402': {'qty': 10},
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        # 50 planned, 3 short, one item differing; nothing received yet
+        self.assertEqual(form.totals_delta(), (47, 1))
+
+    def test_rejects_unknown_codes_and_unexplained_quantities(self):
+        self.assertFalse(self.form({'UG9999': {'qty': 1, 'note': 'x'}}).is_valid())
+        self.assertFalse(self.form({'UG9401': {'qty': 7}}).is_valid())
+        self.assertFalse(self.form({'UG9401': {'qty': -1, 'note': 'x'}}).is_valid())
+        self.assertFalse(self.form({'UG9401': {'qty': True, 'note': 'x'}}).is_valid())
+
+    def test_rejects_quantities_beyond_the_columns(self):
+        self.assertFalse(self.form({'UG9401': {'qty': 10 ** 12, 'note': 'x'}}).is_valid())
+        # Each fits, but the shipment's received total would not
+        self.assertFalse(self.form({
+            'UG9401': {'qty': max_quantity(), 'note': 'x'},
+            'UG9402': {'qty': max_quantity(), 'note': 'x'},
+        }).is_valid())
+        self.assertTrue(self.form({'UG9401': {'qty': max_quantity() - 40, 'note': 'x'}}).is_valid())
+
+    def test_confirm_applies_quantities_and_event(self):
+        self.client.force_login(self.cc_user)
+        self.client.post(f'/shipping/shipments/{self.shipment.pk}/confirm-receipt/', {
+            'mode': DiscrepancyReceiptForm.MODE,
+            'discrepancies': json.dumps({'UG9401': {'qty': 12, 'note': 'Two extra'}}),
+        })
+        self.shipment.refresh_from_db()
+        self.assertEqual(self.shipment.status, Shipment.Status.RECEIVED_CC)
+        self.assertEqual((self.shipment.total_received, self.shipment.discrepancy_count), (52, 1))
+        self.assertFalse(Shipment.objects.with_drifted_totals().exists())
+        self.assertEqual(
+            dict(self.shipment.items.values_list('fcp__code', 'qty_received')),
+            {'UG9401': 12, 'UG9402': 10, 'UG9403': 10, 'UG9404': 10, 'UG9405': 10},
+        )
+        event = ShipmentEvent.objects.get(shipment=self.shipment)
+        self.assertEqual((event.received_delta, event.discrepancy_delta), (52, 1))
+
+    def test_confirm_refreshes_totals_once(self):
+        self.client.force_login(self.cc_user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(f'/shipping/shipments/{self.shipment.pk}/confirm-receipt/', {
+                'mode': DiscrepancyReceiptForm.MODE,
+                'discrepancies': json.dumps({'UG9401': {'qty': 12, 'note': 'Two extra'}}),
+            })
+        statements = [query['sql'] for query in queries]
+        self.assertEqual(sum('SET "total_packages"' in sql for sql in statements), 1)
+        self.assertFalse(any(sql.startswith('SELECT DISTINCT "shipping_shipment"."cluster_id"') for sql in statements))
+        self.assertFalse(Shipment.objects.with_drifted_totals().exists())
+
+
+class ShipmentRosterTests(TestCase):
+    """Roster quantities must fit the item and total columns"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('roster_sdsa', role=User.Role.SDSA, must_change_password=False)
+        cls.cluster = Cluster.objects.create(name='Roster Cluster', sdsa_owner=cls.sdsa)
+        FCP.objects.create(code='UG9500', cluster=cls.cluster, is_collection_centre=True)
+        cls.fcps = [FCP.objects.create(code=f'UG95{n:02d}', cluster=cls.cluster) for n in range(1, 3)]
+
+    def post(self, quantities):
+        self.client.force_login(self.sdsa)
+        return self.client.post('/shipping/shipments/outgoing/roster/', {
+            'cluster': self.cluster.pk,
+            'estimated_delivery_date': timezone.localdate().isoformat(),
+            'quantities': json.dumps({str(fcp.pk): qty for fcp, qty in zip(self.fcps, quantities)}),
+        })
+
+    def test_creates_shipment(self):
+        response = self.post([4, 6])
+        shipment = Shipment.objects.get(cluster=self.cluster)
+        self.assertRedirects(response, f'/shipping/shipments/{shipment.pk}/')
+        self.assertEqual(shipment.total_packages, 10)
+
+    def test_rejects_quantities_beyond_the_columns(self):
+        # One item too large, or items that each fit but add up to too much
+        for quantities in ([10 ** 12, 1], [max_quantity(), 1]):
+            with self.subTest(quantities=quantities):
+                response = self.post(quantities)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.context['form'].has_error('quantities'))
+        self.assertFalse(Shipment.objects.filter(cluster=self.cluster).exists())
+
+
+class DashboardCacheTests(TestCase):
+    """Item and totals changes invalidate the dashboards of their cluster only"""
+
+    @classmethod
+    def setUpTestData(cls):
+        sdsa = User.objects.create_user('cache_sdsa', role=User.Role.SDSA)
+        cls.clusters = [Cluster.objects.create(name=f'Cache Cluster {n}', sdsa_owner=sdsa) for n in range(2)]
+        centre = FCP.objects.create(code='UG9600', cluster=cls.clusters[0], is_collection_centre=True)
+        cls.shipment = Shipment.objects.create(
+            direction=Shipment.Direction.OUT, cluster=cls.clusters[0], collection_centre=centre,
+            estimated_delivery_date=timezone.localdate(), created_by=sdsa,
+        )
+        cls.item = ShipmentItem.objects.create(shipment=cls.shipment, fcp=centre, qty_planned=5)
+
+    def versions(self):
+        return cluster_versions([cluster.pk for cluster in self.clusters] + [ALL_CLUSTERS])
+
+    def assert_bumps_first_cluster(self, change):
+        before = self.versions()
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        after = self.versions()
+        self.assertNotEqual(after[self.clusters[0].pk], before[self.clusters[0].pk])
+        self.assertNotEqual(after[ALL_CLUSTERS], before[ALL_CLUSTERS])
+        self.assertEqual(after[self.clusters[1].pk], before[self.clusters[1].pk])
+
+    def test_item_save_bumps_cluster(self):
+        def change():
+            self.item.qty_received = 4
+            self.item.save()
+        self.assert_bumps_first_cluster(change)
+
+    def test_item_bulk_update_bumps_cluster(self):
+        self.assert_bumps_first_cluster(
+            lambda: ShipmentItem.objects.filter(shipment=self.shipment).update(qty_received=5)
+        )
+
+    def test_known_cluster_is_not_looked_up(self):
+        item = self.shipment.items.get()
+        item.qty_received = 3
+        # The item UPDATE and the totals UPDATE
+        with self.assertNumQueries(2):
+            item.save()
+        with self.assertNumQueries(3):
+            ShipmentItem.objects.filter(pk=item.pk).update(qty_received=4)
+
+    def test_refresh_totals_bumps_cluster(self):
+        self.assert_bumps_first_cluster(Shipment.objects.filter(pk=self.shipment.pk).refresh_totals)
+
+    def test_hit_and_miss_counts(self):
+        scope = mock.Mock(visible_cluster_ids=[self.clusters[1].pk])
+        before = dashboard_cache_stats()
+        for _ in range(3):
+            cached_dashboard('test', scope, dict)
+        stats = dashboard_cache_stats()
+        self.assertEqual((stats['hits'] - before['hits'], stats['misses'] - before['misses']), (2, 1))
+
+
+class CSVImportReaderTests(SimpleTestCase):
+    """The import CSV is read lazily from arbitrary byte chunks"""
+
+    HEADER = 'username,first_name,last_name,email,role\n'
+
+    def read(self, data, chunk_size=3):
+        reader = CSVImportReader(data[n:n + chunk_size] for n in range(0, len(data), chunk_size))
+        return list(reader), reader.errors
+
+    def test_rows_split_across_chunks(self):
+        data = ('\ufeff' + self.HEADER + 'amos,Amos,Okello,amos@example.org,SDSA\r\n'
+                'bea,Béatrice,Nakato,,CC\n').encode()
+        for chunk_size in (1, 2, 3, 7, len(data)):
+            rows, errors = self.read(data, chunk_size)
+            self.assertEqual(errors, [])
+            self.assertEqual([row_num for row_num, _ in rows], [2, 3])
+            self.assertEqual(rows[1][1]['first_name'], 'Béatrice')
+            self.assertEqual(rows[0][1]['role'], 'SDSA')
+
+    def test_bad_rows_are_reported_and_skipped(self):
+        data = (self.HEADER.encode()
+                + b'amos,Amos,Okello,,SDSA\n'
+                + b'bad,\xff\xfe,Name,,CC\n'
+                + b'\n'
+                + b'wide,A,B,,CC,extra\n'
+                + b'last,Last,Row,,ADMIN')
+        rows, errors = self.read(data)
+        self.assertEqual([row['username'] for _, row in rows], ['amos', 'last'])
+        self.assertEqual([row_num for row_num, _ in errors], [3, 5])
+        self.assertEqual(rows[-1][0], 6)
+
+    def test_header_problems_fail_the_file(self):
+        with self.assertRaises(ImportFileError):
+            CSVImportReader([b''])
+        with self.assertRaises(ImportFileError):
+            CSVImportReader([b'username,first_name\n'])
+        with self.assertRaises(ImportFileError):
+            CSVImportReader([b'\xff' + self.HEADER.encode()])
+
+
+class UserImportTests(TestCase):
+    """Bulk imports record each row's outcome on an ImportRun"""
+
+    CSV = (
+        'username,first_name,last_name,email,role,cluster,fcp_code\n'
+        'new_sdsa,Grace,Akello,grace@example.org,SDSA,Import Cluster,\n'
+        'lost_sdsa,Peter,Okot,,SDSA,No Such Cluster,\n'
+        'new_cc,Ruth,Auma,,CC,,ug9501\n'
+        'second_cc,John,Opio,,CC,,UG9501\n'
+        'existing,Old,User,,CC,,\n'
+        'new_sdsa,Again,Same,,SDSA,,\n'
+        'odd_role,Some,One,,BOSS,,\n'
+        'dup_email,Mary,Apio,grace@example.org,CC,,\n'
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('import_admin', role=User.Role.ADMIN, must_change_password=False)
+        User.objects.create_user('existing', role=User.Role.CC)
+        cls.cluster = Cluster.objects.create(name='Import Cluster', sdsa_owner=cls.admin)
+        cls.centre = FCP.objects.create(code='UG9501', cluster=cls.cluster, is_collection_centre=True)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def upload(self, **fields):
+        return self.client.post('/shipping/users/bulk-import/', {
+            'csv_file': SimpleUploadedFile('users.csv', self.CSV.encode(), content_type='text/csv'),
+            'default_password': 'Welcome-2024',
+            **fields,
+        })
+
+    def assertImported(self, run):
+        self.assertEqual(run.status, ImportRun.Status.COMPLETED)
+        self.assertEqual(
+            (run.rows_read, run.created_count, run.warning_count, run.error_count), (8, 4, 2, 4)
+        )
+        outcomes = dict(run.rows.values_list('row_number', 'outcome'))
+        Outcome = ImportRowResult.Outcome
+        self.assertEqual(outcomes, {
+            2: Outcome.CREATED, 3: Outcome.WARNING, 4: Outcome.CREATED, 5: Outcome.WARNING,
+            6: Outcome.ERROR, 7: Outcome.ERROR, 8: Outcome.ERROR, 9: Outcome.ERROR,
+        })
+
+        sdsa = User.objects.get(username='new_sdsa')
+        self.assertTrue(sdsa.check_password('Welcome-2024'))
+        self.cluster.refresh_from_db()
+        self.assertEqual(self.cluster.sdsa_owner, sdsa)
+        cc = User.objects.get(username='new_cc')
+        self.assertEqual(CollectionCentreUser.objects.get(fcp=self.centre).user, cc)
+        self.assertFalse(CollectionCentreUser.objects.filter(user__username='second_cc').exists())
+
+    def test_import_in_request(self):
+        response = self.upload()
+        run = ImportRun.objects.get()
+        self.assertRedirects(response, f'/shipping/users/imports/{run.pk}/')
+        self.assertImported(run)
+
+    def test_import_in_passes(self):
+        # Names and FCPs claimed by one pass are seen by the next
+        with mock.patch('shipping.user_import.IMPORT_ROWS_PER_PASS', 2):
+            self.upload()
+        self.assertImported(ImportRun.objects.get())
+
+    def test_import_with_hash_pool(self):
+        # Each pass hashes in the shared pool of spawned workers and bulk-creates its users
+        run = ImportRun.objects.create(created_by=self.admin)
+        rows = CSVImportReader([self.CSV.encode()])
+        with mock.patch('shipping.user_import.IMPORT_ROWS_PER_PASS', 3), \
+                mock.patch('shipping.user_import.MIN_PARALLEL_HASHES', 2), \
+                mock.patch('shipping.user_import.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool, \
+                mock.patch.object(User.objects, 'bulk_create', wraps=User.objects.bulk_create) as bulk_create:
+            import_users(run, rows, workers=2)
+
+        pool.assert_called_once()
+        self.assertEqual(pool.call_args.kwargs['mp_context'].get_start_method(), 'spawn')
+        self.assertEqual([len(call.args[0]) for call in bulk_create.call_args_list], [3, 1])
+
+        run.refresh_from_db()
+        self.assertEqual(
+            (run.status, run.rows_read, run.created_count, run.warning_count, run.error_count),
+            (ImportRun.Status.COMPLETED, 8, 4, 2, 4),
+        )
+        users = User.objects.filter(username__in=['new_sdsa', 'lost_sdsa', 'new_cc', 'second_cc'])
+        # Without a default password each user's password is their username, salted apart
+        for user in users:
+            self.assertTrue(user.check_password(user.username))
+        self.assertEqual(len({user.password for user in users}), 4)
+
+    def test_import_in_background(self):
+        self.upload(run_in_background='on')
+        job = Job.objects.claim('test-worker')
+        self.assertEqual(job.kind, 'user_import')
+        self.assertEqual(b''.join(read_file(job, JobFileChunk.Kind.INPUT)), self.CSV.encode())
+        # The queued job keeps the default password only as a hash
+        self.assertNotIn('Welcome-2024', json.dumps(job.payload))
+        job = run_job(job)
+        self.assertEqual(job.status, Job.Status.SUCCEEDED)
+        self.assertNotIn('default_password_hash', job.payload)
+        self.assertFalse(job.file_chunks.exists())
+        run = ImportRun.objects.get()
+        self.assertEqual(run.job, job)
+        self.assertImported(run)
+
+    def test_run_page_and_errors_csv(self):
+        self.upload()
+        run = ImportRun.objects.get()
+        response = self.client.get(f'/shipping/users/imports/{run.pk}/', {'outcome': 'ERROR'})
+        self.assertEqual(
+            [row.row_number for row in response.context['rows']], [6, 7, 8, 9]
+        )
+        response = self.client.get(f'/shipping/users/imports/{run.pk}/errors.csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'Row,Username,Outcome,Message')
+        self.assertEqual(len(lines), 1 + 6)
+
+
+class ShipmentFormQueryTests(TestCase):
+    """Creating a shipment costs the same number of queries however many items it has"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('form_sdsa', role=User.Role.SDSA, must_change_password=False)
+        cls.cluster = Cluster.objects.create(name='Form Cluster', sdsa_owner=cls.sdsa)
+        cls.centre = FCP.objects.create(code='UG9800', cluster=cls.cluster, is_collection_centre=True)
+        cls.fcps = [FCP.objects.create(code=f'UG98{n:02d}', cluster=cls.cluster) for n in range(1, 21)]
+        cls.cc_user = User.objects.create_user('form_cc', role=User.Role.CC, must_change_password=False)
+        CollectionCentreUser.objects.create(user=cls.cc_user, fcp=cls.centre)
+
+    def setUp(self):
+        settle_org_directory()
+
+    def post(self, url, rows):
+        data = {
+            'cluster': self.cluster.pk,
+            'estimated_delivery_date': timezone.localdate().isoformat(),
+            'items-TOTAL_FORMS': rows,
+            'items-INITIAL_FORMS': 0,
+        }
+        for n, fcp in enumerate(self.fcps[:rows]):
+            data[f'items-{n}-fcp'] = fcp.pk
+            data[f'items-{n}-qty_planned'] = n + 1
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+
+    def assert_flat(self, user, url):
+        self.client.force_login(user)
+        # The first shipment of the day also creates its rollup row
+        self.post(url, 1)
+        few = count_queries(lambda: self.post(url, 2))
+        with self.assertNumQueries(few):
+            self.post(url, 20)
+        shipment = Shipment.objects.filter(created_by=user).latest('pk')
+        self.assertEqual((shipment.item_count, shipment.total_packages), (20, 210))
+        self.assertFalse(Shipment.objects.with_drifted_totals().exists())
+
+    def test_outgoing(self):
+        self.assert_flat(self.sdsa, '/shipping/shipments/outgoing/create/')
+
+    def test_return(self):
+        self.assert_flat(self.cc_user, '/shipping/shipments/return/create/')
+
+
+class ShipmentExportTests(TestCase):
+    """The CSV export streams every filtered, visible shipment"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('export_sdsa', role=User.Role.SDSA, must_change_password=False)
+        other = User.objects.create_user('export_other', role=User.Role.SDSA)
+        cls.cluster = Cluster.objects.create(name='Export Cluster', sdsa_owner=cls.sdsa)
+        hidden = Cluster.objects.create(name='Export Hidden Cluster', sdsa_owner=other)
+        cls.centre = FCP.objects.create(code='UG9100', cluster=cls.cluster, is_collection_centre=True)
+        hidden_centre = FCP.objects.create(code='UG9110', cluster=hidden, is_collection_centre=True)
+        for n in range(7):
+            for cluster, centre in ((cls.cluster, cls.centre), (hidden, hidden_centre)):
+                shipment = Shipment.objects.create(
+                    direction=Shipment.Direction.OUT if n % 3 else Shipment.Direction.RET,
+                    cluster=cluster, collection_centre=centre,
+                    estimated_delivery_date=timezone.localdate(), created_by=cls.sdsa,
+                )
+                ShipmentItem.objects.create(shipment=shipment, fcp=centre, qty_planned=n + 1)
+
+    def test_streams_filtered_rows(self):
+        self.client.force_login(self.sdsa)
+        # A small fetch size makes the export read in several round trips
+        with mock.patch('shipping.exports.EXPORT_CHUNK_SIZE', 2):
+            response = self.client.get('/shipping/shipments/export/', {'direction': Shipment.Direction.OUT})
+            self.assertIsInstance(response, StreamingHttpResponse)
+            body = b''.join(response.streaming_content).decode()
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="shipments.csv"')
+
+        header, *rows = csv.reader(io.StringIO(body))
+        self.assertEqual(header, SHIPMENT_CSV_HEADER)
+        expected = Shipment.objects.filter(
+            cluster=self.cluster, direction=Shipment.Direction.OUT
+        ).order_by('-created_at')
+        self.assertEqual([int(row[0]) for row in rows], [shipment.pk for shipment in expected])
+        first = expected[0]
+        self.assertEqual(rows[0][1:8], [
+            'Outgoing (SDSA → Collection Centre)', 'Export Cluster', 'UG9100', 'Created/Sent',
+            str(first.estimated_delivery_date), str(first.total_packages), '0',
+        ])
+        self.assertEqual(rows[0][8], 'export_sdsa')
+
+    def test_collection_centres_cannot_export(self):
+        cc_user = User.objects.create_user('export_cc', role=User.Role.CC, must_change_password=False)
+        CollectionCentreUser.objects.create(user=cc_user, fcp=self.centre)
+        self.client.force_login(cc_user)
+        response = self.client.get('/shipping/shipments/export/')
+        self.assertRedirects(response, '/shipping/shipments/', fetch_redirect_response=False)
+
+
+class FCPDirectoryTests(TestCase):
+    """FCP rosters are served with ETags that change only when a roster does"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('roster_etag_sdsa', role=User.Role.SDSA, must_change_password=False)
+        other = User.objects.create_user('roster_etag_other', role=User.Role.SDSA)
+        cls.clusters = [Cluster.objects.create(name=f'ETag Cluster {n}', sdsa_owner=cls.sdsa) for n in range(2)]
+        cls.hidden = Cluster.objects.create(name='ETag Hidden Cluster', sdsa_owner=other)
+        for n, cluster in enumerate(cls.clusters + [cls.hidden]):
+            FCP.objects.create(code=f'UG92{n}0', cluster=cluster, is_collection_centre=True)
+            FCP.objects.create(code=f'UG92{n}1', cluster=cluster)
+
+    def setUp(self):
+        self.client.force_login(self.sdsa)
+
+    def get(self, etag=None, **params):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get('/shipping/ajax/get-fcps/', params, **headers)
+
+    def test_cluster_roster_revalidates(self):
+        response = self.get(cluster_id=self.clusters[0].pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([fcp['code'] for fcp in response.json()['fcps']], ['UG9200', 'UG9201'])
+        etag = response['ETag']
+
+        revalidated = self.get(etag, cluster_id=self.clusters[0].pk)
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.content, b'')
+        self.assertEqual(revalidated['ETag'], etag)
+        # Another cluster's roster has its own tag
+        self.assertNotEqual(self.get(cluster_id=self.clusters[1].pk)['ETag'], etag)
+
+    def test_all_rosters(self):
+        response = self.get(all=1)
+        self.assertEqual(response.status_code, 200)
+        rosters = response.json()['clusters']
+        self.assertEqual(set(rosters), {str(cluster.pk) for cluster in self.clusters})
+        self.assertEqual([fcp[1] for fcp in rosters[str(self.clusters[1].pk)]], ['UG9210', 'UG9211'])
+        self.assertEqual(self.get(response['ETag'], all=1).status_code, 304)
+
+    def test_hidden_cluster(self):
+        response = self.get(cluster_id=self.hidden.pk)
+        self.assertEqual(response.json()['fcps'], [])
+        self.assertIn('error', response.json())
+
+    def test_fcp_change_gives_new_etag(self):
+        single, every = self.get(cluster_id=self.clusters[0].pk), self.get(all=1)
+        other = self.get(cluster_id=self.clusters[1].pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            FCP.objects.create(code='UG9202', name='New FCP', cluster=self.clusters[0])
+
+        response = self.get(single['ETag'], cluster_id=self.clusters[0].pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], single['ETag'])
+        self.assertIn('UG9202', [fcp['code'] for fcp in response.json()['fcps']])
+        self.assertEqual(self.get(every['ETag'], all=1).status_code, 200)
+        # The unchanged cluster still revalidates
+        self.assertEqual(self.get(other['ETag'], cluster_id=self.clusters[1].pk).status_code, 304)
+
+
+class ConfirmReceiptQueryTests(TestCase):
+    """Confirming receipt costs the same number of queries for small and large shipments"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('confirm_sdsa', role=User.Role.SDSA)
+        cls.cluster = Cluster.objects.create(name='Confirm Cluster', sdsa_owner=cls.sdsa)
+        cls.centre = FCP.objects.create(code='UG9900', cluster=cls.cluster, is_collection_centre=True)
+        cls.fcps = [FCP.objects.create(code=f'UG99{n:02d}', cluster=cls.cluster) for n in range(1, 26)]
+        cls.cc_user = User.objects.create_user('confirm_cc', role=User.Role.CC, must_change_password=False)
+        CollectionCentreUser.objects.create(user=cls.cc_user, fcp=cls.centre)
+
+    def setUp(self):
+        settle_org_directory()
+        self.client.force_login(self.cc_user)
+        # The first receipt of the day also creates its rollup row
+        self.confirm(self.shipment(1), self.full_form)
+
+    def shipment(self, items):
+        shipment = Shipment.objects.create(
+            direction=Shipment.Direction.OUT, cluster=self.cluster, collection_centre=self.centre,
+            estimated_delivery_date=timezone.localdate(), created_by=self.sdsa,
+        )
+        ShipmentItem.objects.bulk_create([
+            ShipmentItem(shipment=shipment, fcp=fcp, qty_planned=10) for fcp in self.fcps[:items]
+        ])
+        return shipment
+
+    def full_form(self, shipment):
+        data = {}
+        for n, item in enumerate(shipment.items.all()):
+            data[f'qty_received_{item.pk}'] = 9 if n == 0 else 10
+            data[f'discrepancy_note_{item.pk}'] = 'One short' if n == 0 else ''
+        return data
+
+    def discrepancies(self, shipment):
+        return {
+            'mode': DiscrepancyReceiptForm.MODE,
+            'discrepancies': json.dumps({'UG9901': {'qty': 9, 'note': 'One short'}}),
+        }
+
+    def confirm(self, shipment, build):
+        response = self.client.post(f'/shipping/shipments/{shipment.pk}/confirm-receipt/', build(shipment))
+        self.assertEqual(response.status_code, 302)
+
+    def assert_flat(self, build):
+        small, large = self.shipment(3), self.shipment(25)
+        small_data, large_data = build(small), build(large)
+        few = count_queries(lambda: self.confirm(small, lambda shipment: small_data))
+        with self.assertNumQueries(few):
+            self.confirm(large, lambda shipment: large_data)
+        large.refresh_from_db()
+        self.assertEqual(large.status, Shipment.Status.RECEIVED_CC)
+        self.assertEqual((large.total_received, large.discrepancy_count), (249, 1))
+        self.assertFalse(Shipment.objects.with_drifted_totals().exists())
+
+    def test_full_form(self):
+        self.assert_flat(self.full_form)
+
+    def test_discrepancies_only(self):
+        self.assert_flat(self.discrepancies)
+
+
+class ShipmentScopeTests(TestCase):
+    """Permissions follow ownership and CC links as soon as they change, in every process"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('scope_owner', role=User.Role.SDSA)
+        cls.successor = User.objects.create_user('scope_successor', role=User.Role.SDSA)
+        cls.cluster = Cluster.objects.create(name='Scope Cluster', sdsa_owner=cls.owner)
+        centre = FCP.objects.create(code='UG9950', cluster=cls.cluster, is_collection_centre=True)
+        cls.cc_user = User.objects.create_user('scope_cc', role=User.Role.CC)
+        CollectionCentreUser.objects.create(user=cls.cc_user, fcp=centre)
+        cls.admin = User.objects.create_user('scope_admin', role=User.Role.ADMIN)
+
+    def test_one_query_per_scope(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(ShipmentScope.for_user(self.owner).visible_cluster_ids, {self.cluster.pk})
+        with self.assertNumQueries(1):
+            self.assertEqual(ShipmentScope.for_user(self.cc_user).visible_cluster_ids, {self.cluster.pk})
+        with self.assertNumQueries(0):
+            self.assertIsNone(ShipmentScope.for_user(self.admin).visible_cluster_ids)
+
+    def test_changes_apply_despite_a_stale_directory(self):
+        settle_org_directory()
+        # Writes another process made, which this process's directory has not seen
+        with mock.patch('org.directory.invalidate'):
+            Cluster.objects.filter(pk=self.cluster.pk).update(sdsa_owner=self.successor)
+            CollectionCentreUser.objects.filter(user=self.cc_user).delete()
+        self.assertEqual(ShipmentScope.for_user(self.owner).visible_cluster_ids, frozenset())
+        self.assertEqual(ShipmentScope.for_user(self.successor).visible_cluster_ids, {self.cluster.pk})
+        self.assertEqual(ShipmentScope.for_user(self.cc_user).visible_cluster_ids, frozenset())
+
+    def test_confirm_receipt_as_user(self):
+        shipment = Shipment.objects.create(
+            direction=Shipment.Direction.OUT, cluster=self.cluster,
+            collection_centre=FCP.objects.get(code='UG9950'),
+            estimated_delivery_date=timezone.localdate(), created_by=self.owner,
+        )
+        self.assertTrue(shipment.can_confirm_receipt_as_user(self.cc_user))
+        self.assertFalse(shipment.can_confirm_receipt_as_user(self.owner))
+        CollectionCentreUser.objects.filter(user=self.cc_user).delete()
+        self.assertFalse(shipment.can_confirm_receipt_as_user(self.cc_user))
+
+
+class ShipmentListQueryTests(TestCase):
+    """The shipment list costs the same number of queries however many shipments there are"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('list_sdsa', role=User.Role.SDSA, must_change_password=False)
+        cls.cluster = Cluster.objects.create(name='List Cluster', sdsa_owner=cls.sdsa)
+        cls.centre = FCP.objects.create(code='UG9800', cluster=cls.cluster, is_collection_centre=True)
+        cls.fcps = [FCP.objects.create(code=f'UG98{n:02d}', cluster=cls.cluster) for n in range(1, 4)]
+        cls.cc_user = User.objects.create_user('list_cc', role=User.Role.CC, must_change_password=False)
+        CollectionCentreUser.objects.create(user=cls.cc_user, fcp=cls.centre)
+        cls.admin = User.objects.create_user('list_admin', role=User.Role.ADMIN, must_change_password=False)
+
+    def add_shipments(self, count):
+        for n in range(count):
+            shipment = Shipment.objects.create(
+                direction=Shipment.Direction.OUT if n % 2 else Shipment.Direction.RET,
+                cluster=self.cluster, collection_centre=self.centre,
+                estimated_delivery_date=timezone.localdate(), created_by=self.sdsa,
+            )
+            ShipmentItem.objects.bulk_create([
+                ShipmentItem(shipment=shipment, fcp=fcp, qty_planned=5) for fcp in self.fcps
+            ])
+
+    def list_shipments(self):
+        response = self.client.get('/shipping/shipments/')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assert_flat(self, user, n=4):
+        settle_org_directory()
+        self.client.force_login(user)
+        self.add_shipments(n)
+        few = count_queries(self.list_shipments)
+        self.add_shipments(4 * n)
+        with self.assertNumQueries(few):
+            response = self.list_shipments()
+        self.assertEqual(len(response.context['shipments']), 5 * n)
+
+    def test_sdsa(self):
+        self.assert_flat(self.sdsa)
+
+    def test_collection_centre(self):
+        self.assert_flat(self.cc_user)
+
+    def test_admin(self):
+        self.assert_flat(self.admin)
+
+
+class QueryBudgetTests(TestCase):
+    """Every budgeted view stays within its QUERY_BUDGETS entry in normal use"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sdsa = User.objects.create_user('budget_sdsa', role=User.Role.SDSA, must_change_password=False)
+        cls.cluster = Cluster.objects.create(name='Budget Cluster', sdsa_owner=cls.sdsa)
+        cls.centre = FCP.objects.create(code='UG9700', cluster=cls.cluster, is_collection_centre=True)
+        cls.fcps = [FCP.objects.create(code=f'UG97{n:02d}', cluster=cls.cluster) for n in range(1, 21)]
+        cls.cc_user = User.objects.create_user('budget_cc', role=User.Role.CC, must_change_password=False)
+        CollectionCentreUser.objects.create(user=cls.cc_user, fcp=cls.centre)
+        cls.admin = User.objects.create_user('budget_admin', role=User.Role.ADMIN, must_change_password=False)
+        cls.shipments = []
+        for n in range(25):
+            shipment = Shipment.objects.create(
+                direction=Shipment.Direction.OUT if n % 2 else Shipment.Direction.RET,
+                cluster=cls.cluster, collection_centre=cls.centre,
+                estimated_delivery_date=timezone.localdate(), created_by=cls.sdsa,
+            )
+            ShipmentItem.objects.bulk_create([
+                ShipmentItem(shipment=shipment, fcp=fcp, qty_planned=5) for fcp in cls.fcps
+            ])
+            cls.shipments.append(shipment)
+
+    def setUp(self):
+        settle_org_directory()
+        # Dashboards are measured as cache misses
+        dashboard_cache().clear()
+
+    def assert_within_budget(self, user, view_name, request):
+        self.client.force_login(user)
+        response = request(self.client)
+        self.assertLess(response.status_code, 400)
+        self.assertEqual(response.wsgi_request.resolver_match.view_name, view_name)
+        budget = settings.QUERY_BUDGETS[view_name]
+        self.assertLessEqual(response.wsgi_request.query_stats.count, budget, view_name)
+        return response
+
+    def item_rows(self, rows):
+        data = {
+            'cluster': self.cluster.pk,
+            'estimated_delivery_date': timezone.localdate().isoformat(),
+            'items-TOTAL_FORMS': rows,
+            'items-INITIAL_FORMS': 0,
+        }
+        for n, fcp in enumerate(self.fcps[:rows]):
+            data[f'items-{n}-fcp'] = fcp.pk
+            data[f'items-{n}-qty_planned'] = n + 1
+        return data
+
+    def test_pages(self):
+        shipment = self.shipments[0]
+        for user in (self.sdsa, self.cc_user, self.admin):
+            for view_name, url in (
+                ('shipping:dashboard', '/shipping/'),
+                ('shipping:shipment_list', '/shipping/shipments/'),
+                ('shipping:shipment_detail', f'/shipping/shipments/{shipment.pk}/'),
+                ('shipping:get_fcps_for_cluster', f'/shipping/ajax/get-fcps/?cluster_id={self.cluster.pk}'),
+                ('shipping:get_fcps_for_cluster', '/shipping/ajax/get-fcps/?all=1'),
+                ('shipping:shipment_events_feed', '/shipping/shipments/events/'),
+            ):
+                with self.subTest(user=user.username, url=url):
+                    self.assert_within_budget(user, view_name, lambda client: client.get(url))
+        for user in (self.sdsa, self.admin):
+            with self.subTest(user=user.username):
+                self.assert_within_budget(user, 'shipping:reports', lambda client: client.get('/shipping/reports/'))
+
+    def test_forms(self):
+        for user, view_name, url in (
+            (self.sdsa, 'shipping:create_outgoing_shipment', '/shipping/shipments/outgoing/create/'),
+            (self.sdsa, 'shipping:create_roster_shipment', '/shipping/shipments/outgoing/roster/'),
+            (self.cc_user, 'shipping:create_return_shipment', '/shipping/shipments/return/create/'),
+        ):
+            with self.subTest(url=url):
+                self.assert_within_budget(user, view_name, lambda client: client.get(url))
+        roster = {
+            'cluster': self.cluster.pk,
+            'estimated_delivery_date': timezone.localdate().isoformat(),
+            'quantities': json.dumps({str(fcp.pk): 3 for fcp in self.fcps}),
+        }
+        for user, view_name, url, data in (
+            (self.sdsa, 'shipping:create_outgoing_shipment', '/shipping/shipments/outgoing/create/', self.item_rows(20)),
+            (self.sdsa, 'shipping:create_roster_shipment', '/shipping/shipments/outgoing/roster/', roster),
+            (self.cc_user, 'shipping:create_return_shipment', '/shipping/shipments/return/create/', self.item_rows(20)),
+        ):
+            with self.subTest(url=url):
+                # As for the first shipment of the day, which also creates its rollup row
+                ShipmentDailyRollup.objects.all().delete()
+                response = self.assert_within_budget(user, view_name, lambda client: client.post(url, data))
+                self.assertEqual(response.status_code, 302)
+
+    def test_actions(self):
+        outgoing = self.shipments[1]
+        url = f'/shipping/shipments/{outgoing.pk}/confirm-receipt/'
+        data = {}
+        for item in outgoing.items.all():
+            data[f'qty_received_{item.pk}'] = 5
+            data[f'discrepancy_note_{item.pk}'] = ''
+        self.assert_within_budget(self.cc_user, 'shipping:confirm_receipt', lambda client: client.post(url, data))
+        self.assertEqual(Shipment.objects.get(pk=outgoing.pk).status, Shipment.Status.RECEIVED_CC)
+
+        Shipment.objects.filter(direction=Shipment.Direction.OUT).update(status=Shipment.Status.RECEIVED_CC)
+        self.assert_within_budget(
+            self.sdsa, 'shipping:batch_transition',
+            lambda client: client.post('/shipping/shipments/batch-transition/', {
+                'action': DISTRIBUTE, 'ids': [shipment.pk for shipment in self.shipments],
+            }, HTTP_ACCEPT='application/json'),
+        )
+        self.assertEqual(
+            Shipment.objects.filter(status=Shipment.Status.DISTRIBUTED).count(),
+            len(self.shipments[1::2]),
+        )
@@ -0,0 +1,185 @@
+"""
+Shipment status transitions as compare-and-set updates.
+
+Each transition is one conditional ``UPDATE ... WHERE id = %s AND status = %s
+RETURNING`` that only matches while the shipment is still in the status the
+transition starts from. Two people clicking at once cannot both apply it, no
+row is locked while the request is handled, and only the status and the
+transition's timestamp column are written. Every transition that happens
+appends a ShipmentEvent in the same transaction.
+"""
+from collections import Counter
+
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from letterflow import metrics
+from .models import Shipment, ShipmentDailyRollup, ShipmentEvent
+
+
+RECEIVE = 'receive'
+DISTRIBUTE = 'distribute'
+POST = 'post'
+
+# (action, direction) -> (from status, to status, timestamp field)
+TRANSITIONS = {
+    (RECEIVE, Shipment.Direction.OUT): (
+        Shipment.Status.CREATED, Shipment.Status.RECEIVED_CC, 'received_at'
+    ),
+    (RECEIVE, Shipment.Direction.RET): (
+        Shipment.Status.CREATED, Shipment.Status.RECEIVED_NO, 'received_at'
+    ),
+    (DISTRIBUTE, Shipment.Direction.OUT): (
+        Shipment.Status.RECEIVED_CC, Shipment.Status.DISTRIBUTED, 'distributed_at'
+    ),
+    (POST, Shipment.Direction.RET): (
+        Shipment.Status.RECEIVED_NO, Shipment.Status.POSTED, 'posted_at'
+    ),
+}
+
+
+def action_between(direction, from_status, to_status):
+    """The action that moves a shipment of `direction` from one status to another, or None"""
+    for (action, rule_direction), (rule_from, rule_to, _) in TRANSITIONS.items():
+        if (rule_direction, rule_from, rule_to) == (direction, from_status, to_status):
+            return action
+    return None
+
+
+# Per-shipment outcomes reported by transition_many
+APPLIED = 'applied'
+NOT_ALLOWED = 'not_allowed'  # wrong direction or status, or another request got there first
+NOT_FOUND = 'not_found'  # missing, or outside the clusters the caller may change
+
+OUTCOME_LABELS = {
+    APPLIED: 'Updated',
+    NOT_ALLOWED: 'Not in a status this action applies to',
+    NOT_FOUND: 'Not found or outside your clusters',
+}
+
+
+def _compare_and_set(connection, shipment_ids, direction, rule, at, cluster_ids=None):
+    """
+    Run one conditional UPDATE for a transition rule over `shipment_ids`.
+
+    Returns (id, cluster_id) for every shipment it moved.
+    """
+    from_status, to_status, timestamp_field = rule
+    qn = connection.ops.quote_name
+    opts = Shipment._meta
+    timestamp = opts.get_field(timestamp_field)
+    
+    id_placeholders = ', '.join(['%s'] * len(shipment_ids))
+    sql = (
+        f'UPDATE {qn(opts.db_table)} '
+        f'SET {qn("status")} = %s, {qn(timestamp.column)} = %s '
+        f'WHERE {qn("id")} IN ({id_placeholders}) '
+        f'AND {qn("direction")} = %s AND {qn("status")} = %s'
+    )
+    params = [to_status, timestamp.get_db_prep_value(at, connection), *shipment_ids, direction, from_status]
+    if cluster_ids is not None:
+        sql += f' AND {qn("cluster_id")} IN ({", ".join(["%s"] * len(cluster_ids))})'
+        params.extend(cluster_ids)
+    sql += f' RETURNING {qn("id")}, {qn("cluster_id")}'
+    
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def transition(shipment, action, actor=None, received_delta=0, discrepancy_delta=0, at=None, using=None):
+    """
+    Apply `action` to the shipment if it is still in the status the action
+    starts from.
+
+    Returns True when this call moved the shipment, False when the action does
+    not apply to its direction or another request got there first. On success
+    the instance and the daily rollup are brought up to date, and an event
+    recording `actor` and the given quantity deltas is appended.
+    """
+    rule = TRANSITIONS.get((action, shipment.direction))
+    if rule is None:
+        return False
+    from_status, to_status, timestamp_field = rule
+    at = at or timezone.now()
+    using = using or router.db_for_write(Shipment, instance=shipment)
+    
+    with transaction.atomic(using=using):
+        moved = _compare_and_set(connections[using], [shipment.pk], shipment.direction, rule, at)
+        if not moved:
+            return False
+        
+        day = timezone.localdate(shipment.created_at)
+        cluster_id = moved[0][1]
+        ShipmentDailyRollup.objects.db_manager(using).apply({
+            (day, cluster_id, shipment.direction, from_status): -1,
+            (day, cluster_id, shipment.direction, to_status): 1,
+        })
+        ShipmentEvent.objects.using(using).create(
+            shipment_id=shipment.pk, cluster_id=cluster_id, actor=actor,
+            from_status=from_status, to_status=to_status, occurred_at=at,
+            received_delta=received_delta, discrepancy_delta=discrepancy_delta,
+        )
+        metrics.inc_on_commit(metrics.SHIPMENT_TRANSITIONS, using=using, status=to_status)
+        metrics.inc_on_commit(metrics.PACKAGES_RECEIVED, max(received_delta, 0), using=using)
+        metrics.inc_on_commit(metrics.DISCREPANCIES, max(discrepancy_delta, 0), using=using)
+    
+    shipment.cluster_id = cluster_id
+    shipment.status = to_status
+    setattr(shipment, timestamp_field, at)
+    shipment._snapshot_rollup_key()
+    return True
+
+
+def transition_many(shipment_ids, action, cluster_ids=None, actor=None, at=None, using=None):
+    """
+    Apply `action` to a set of shipments at once.
+
+    Only shipments in `cluster_ids` (None for every cluster) are touched. One
+    scoped query authorises the whole set, then each direction the action
+    applies to gets a single conditional UPDATE. Returns {id: outcome}.
+    """
+    outcomes = dict.fromkeys(set(shipment_ids), NOT_FOUND)
+    if not outcomes or (cluster_ids is not None and not cluster_ids):
+        return outcomes
+    if cluster_ids is not None:
+        cluster_ids = list(cluster_ids)
+    at = at or timezone.now()
+    using = using or router.db_for_write(Shipment)
+    
+    # created_at never changes, so the read also tells us each shipment's rollup day
+    found = Shipment.objects.using(using).filter(pk__in=outcomes)
+    if cluster_ids is not None:
+        found = found.filter(cluster_id__in=cluster_ids)
+    found = {
+        pk: (direction, timezone.localdate(created_at))
+        for pk, direction, created_at in found.values_list('pk', 'direction', 'created_at')
+    }
+    outcomes.update(dict.fromkeys(found, NOT_ALLOWED))
+    
+    changes = Counter()
+    events = []
+    with transaction.atomic(using=using):
+        for (rule_action, direction), rule in TRANSITIONS.items():
+            if rule_action != action:
+                continue
+            ids = [pk for pk, (found_direction, _) in found.items() if found_direction == direction]
+            if not ids:
+                continue
+            from_status, to_status, _ = rule
+            for pk, cluster_id in _compare_and_set(
+                connections[using], ids, direction, rule, at, cluster_ids
+            ):
+                outcomes[pk] = APPLIED
+                day = found[pk][1]
+                changes[(day, cluster_id, direction, from_status)] -= 1
+                changes[(day, cluster_id, direction, to_status)] += 1
+                events.append(ShipmentEvent(
+                    shipment_id=pk, cluster_id=cluster_id, actor=actor,
+                    from_status=from_status, to_status=to_status, occurred_at=at,
+                ))
+        ShipmentDailyRollup.objects.db_manager(using).apply(changes)
+        ShipmentEvent.objects.using(using).bulk_create(events)
+        for status, count in Counter(event.to_status for event in events).items():
+            metrics.inc_on_commit(metrics.SHIPMENT_TRANSITIONS, count, using=using, status=status)
+    return outcomes
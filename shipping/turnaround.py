@@ -0,0 +1,147 @@
+import math
+from itertools import groupby
+from operator import itemgetter
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import DurationField, ExpressionWrapper, F
+
+from org.models import Cluster
+from .models import Shipment
+
+
+# (key, label, direction, start field, end field)
+STAGES = (
+    ('outgoing_receipt', 'Outgoing: Created → Received at CC',
+     Shipment.Direction.OUT, 'created_at', 'received_at'),
+    ('outgoing_distribution', 'Outgoing: Received → Distributed',
+     Shipment.Direction.OUT, 'received_at', 'distributed_at'),
+    ('returns_receipt', 'Returns: Created → Received at NO',
+     Shipment.Direction.RET, 'created_at', 'received_at'),
+    ('returns_posting', 'Returns: Received → Posted',
+     Shipment.Direction.RET, 'received_at', 'posted_at'),
+)
+
+SECONDS_PER_DAY = 86400
+
+
+def turnaround_stats(queryset):
+    """
+    Count, mean, median, p90 and max (in days) for each turnaround stage over
+    the shipments in `queryset`, overall and per cluster (in one query on
+    PostgreSQL).
+
+    Returns a list in STAGES order with one entry per stage that has data:
+    {'key', 'label', 'overall': {...}, 'clusters': [{'cluster', ...}, ...]}
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        rows = _postgres_rows(queryset, connection)
+    else:
+        rows = _python_rows(queryset)
+    return _collate(rows)
+
+
+def _postgres_rows(queryset, connection):
+    """Aggregate every stage and cluster with percentile_cont in a single statement"""
+    qn = connection.ops.quote_name
+    shipment_table = qn(Shipment._meta.db_table)
+    cluster_table = qn(Cluster._meta.db_table)
+    try:
+        ids_sql, ids_params = queryset.order_by().values('pk').query.sql_with_params()
+    except EmptyResultSet:
+        # e.g. an SDSA who owns no clusters
+        return
+
+    values, params = [], []
+    for key, label, direction, start, end in STAGES:
+        values.append(
+            f'(%s, CASE WHEN s.{qn("direction")} = %s '
+            f'THEN EXTRACT(EPOCH FROM s.{qn(end)} - s.{qn(start)}) / {SECONDS_PER_DAY} END)'
+        )
+        params.extend([key, direction])
+
+    sql = f'''
+        SELECT t.stage, c.{qn("id")}, c.{qn("name")},
+               COUNT(*), AVG(t.days),
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY t.days),
+               percentile_cont(0.9) WITHIN GROUP (ORDER BY t.days),
+               MAX(t.days)
+        FROM {shipment_table} s
+        JOIN {cluster_table} c ON c.{qn("id")} = s.{qn("cluster_id")}
+        CROSS JOIN LATERAL (VALUES {", ".join(values)}) AS t(stage, days)
+        WHERE s.{qn("id")} IN ({ids_sql}) AND t.days IS NOT NULL
+        GROUP BY GROUPING SETS ((t.stage, c.{qn("id")}, c.{qn("name")}), (t.stage))
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + list(ids_params))
+        # The overall row of each stage has no cluster id
+        for stage, cluster_id, cluster_name, count, mean, median, p90, longest in cursor.fetchall():
+            yield stage, cluster_id, cluster_name, _summary(count, mean, median, p90, longest)
+
+
+def _python_rows(queryset):
+    """
+    Fallback for backends without percentile_cont. The database filters each
+    stage's spans and sorts them by cluster and length, so the summaries only
+    read positions off ordered runs.
+    """
+    for key, label, direction, start, end in STAGES:
+        spans = queryset.order_by().filter(
+            direction=direction, **{f'{start}__isnull': False, f'{end}__isnull': False}
+        ).annotate(
+            span=ExpressionWrapper(F(end) - F(start), output_field=DurationField())
+        ).order_by('cluster_id', 'span').values_list('cluster_id', 'cluster__name', 'span')
+
+        overall = []
+        for (cluster_id, cluster_name), rows in groupby(spans.iterator(), key=itemgetter(0, 1)):
+            days = [span.total_seconds() / SECONDS_PER_DAY for _, _, span in rows]
+            overall.extend(days)
+            yield key, cluster_id, cluster_name, _sorted_summary(days)
+        if overall:
+            # Timsort merges the already sorted runs of each cluster
+            overall.sort()
+            yield key, None, None, _sorted_summary(overall)
+
+
+def _sorted_summary(days):
+    return _summary(
+        len(days), math.fsum(days) / len(days),
+        _percentile(days, 0.5), _percentile(days, 0.9), days[-1]
+    )
+
+
+def _percentile(ordered, fraction):
+    """Linear-interpolated percentile of a sorted list, matching percentile_cont"""
+    position = (len(ordered) - 1) * fraction
+    lower = math.floor(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _summary(count, mean, median, p90, longest):
+    return {
+        'count': count,
+        'mean': float(mean),
+        'median': float(median),
+        'p90': float(p90),
+        'max': float(longest),
+    }
+
+
+def _collate(rows):
+    stages = {}
+    for key, cluster_id, cluster_name, summary in rows:
+        stage = stages.setdefault(key, {'overall': None, 'clusters': []})
+        if cluster_id is None:
+            stage['overall'] = summary
+        else:
+            stage['clusters'].append({'cluster_id': cluster_id, 'cluster': cluster_name, **summary})
+
+    result = []
+    for key, label, direction, start, end in STAGES:
+        if key in stages:
+            stage = stages[key]
+            stage['clusters'].sort(key=lambda row: (row['cluster'], row['cluster_id']))
+            result.append({'key': key, 'label': label, **stage})
+    return result
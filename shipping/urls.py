@@ -7,6 +7,7 @@ urlpatterns = [
     # Dashboard
     path('', dashboard.DashboardView.as_view(), name='dashboard'),
     path('reports/', dashboard.reports_view, name='reports'),
+    path('dashboard/cache-stats/', dashboard.dashboard_cache_stats_view, name='dashboard_cache_stats'),
     
     # Authentication
     path('logout/', views.custom_logout, name='logout'),
@@ -17,12 +18,15 @@ urlpatterns = [
     
     # Create shipments
     path('shipments/outgoing/create/', views.create_outgoing_shipment, name='create_outgoing_shipment'),
+    path('shipments/outgoing/roster/', views.create_roster_shipment, name='create_roster_shipment'),
     path('shipments/return/create/', views.create_return_shipment, name='create_return_shipment'),
     
     # Shipment actions
     path('shipments/<int:pk>/confirm-receipt/', views.confirm_receipt, name='confirm_receipt'),
     path('shipments/<int:pk>/mark-distributed/', views.mark_distributed, name='mark_distributed'),
     path('shipments/<int:pk>/mark-posted/', views.mark_posted, name='mark_posted'),
+    path('shipments/batch-transition/', views.batch_transition, name='batch_transition'),
+    path('shipments/events/', views.shipment_events_feed, name='shipment_events_feed'),
     
     # Export
     path('shipments/export/', views.export_shipments_csv, name='export_shipments_csv'),
@@ -30,7 +34,19 @@ urlpatterns = [
     # AJAX
     path('ajax/get-fcps/', views.get_fcps_for_cluster, name='get_fcps_for_cluster'),
 
+    # Background jobs
+    path('jobs/<int:pk>/', views.job_detail, name='job_detail'),
+    path('jobs/<int:pk>/status/', views.job_status, name='job_status'),
+    path('jobs/<int:pk>/download/', views.job_download, name='job_download'),
+
     # Bulk operations
     path('users/bulk-import/', views.bulk_user_import, name='bulk_user_import'),
+    path('users/imports/<int:pk>/', views.import_run_detail, name='import_run_detail'),
+    path('users/imports/<int:pk>/errors.csv', views.import_run_errors_csv, name='import_run_errors_csv'),
     path('users/download-template/', views.download_csv_template, name='download_csv_template'),
+
+    # Request profiles (letterflow.middleware.ProfilingMiddleware)
+    path('profiles/', views.profile_list, name='profile_list'),
+    path('profiles/<int:pk>/profile.prof', views.profile_download, {'kind': 'prof'}, name='profile_stats'),
+    path('profiles/<int:pk>/report.txt', views.profile_download, {'kind': 'txt'}, name='profile_report'),
 ]
@@ -0,0 +1,416 @@
+import csv
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from accounts.models import User
+from org import directory as org_directory
+from org.models import Cluster, FCP, CollectionCentreUser
+from .models import ImportRowResult, ImportRun
+
+
+IMPORT_BATCH_SIZE = 500
+
+# Rows validated, hashed and saved together; bounds memory on very large files
+IMPORT_ROWS_PER_PASS = 5000
+
+# Below this many passwords the pool start-up costs more than it saves
+MIN_PARALLEL_HASHES = 8
+
+REQUIRED_COLUMNS = ('username', 'first_name', 'last_name', 'email', 'role')
+
+
+class ImportFileError(ValueError):
+    """The file as a whole cannot be imported (encoding or header problems)"""
+
+
+def iter_lines(chunks):
+    """
+    Split an iterable of byte chunks into lines, newline included, holding at
+    most one partial line between chunks.
+    """
+    pending = b''
+    for chunk in chunks:
+        *lines, pending = (pending + bytes(chunk)).split(b'\n')
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+
+class CSVImportReader:
+    """
+    Reads an import CSV lazily from byte chunks (such as UploadedFile.chunks()).
+
+    The header is read and validated from the first line alone. Iterating
+    yields (row number, {column: value}) for each data row; rows that cannot
+    be read (bad encoding, too many columns) are skipped and listed in
+    `errors` as (row number, message) instead of failing the whole file.
+    """
+
+    def __init__(self, chunks, required_columns=REQUIRED_COLUMNS):
+        self.lines = iter_lines(chunks)
+        self.errors = []
+        self.line_num = 0
+        self._bad_encoding = False
+        self.fieldnames = self._read_header(required_columns)
+
+    def _read_header(self, required_columns):
+        try:
+            first = next(self.lines)
+        except StopIteration:
+            raise ImportFileError('CSV file must have at least a header row and one data row.')
+        self.line_num = 1
+        try:
+            text = first.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise ImportFileError('CSV file must be encoded in UTF-8.')
+
+        fieldnames = [name.strip().lower() for name in next(csv.reader([text]), [])]
+        for column in required_columns:
+            if column not in fieldnames:
+                raise ImportFileError(f'CSV must contain a "{column}" column.')
+        return fieldnames
+
+    def _decoded_lines(self):
+        for line in self.lines:
+            self.line_num += 1
+            try:
+                yield line.decode('utf-8')
+            except UnicodeDecodeError:
+                self._bad_encoding = True
+                yield line.decode('utf-8', errors='replace')
+
+    def __iter__(self):
+        reader = csv.reader(self._decoded_lines())
+        while True:
+            row_num = self.line_num + 1
+            self._bad_encoding = False
+            try:
+                values = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                self.errors.append((row_num, f'Could not read row: {e}'))
+                continue
+
+            # Skip empty rows
+            if not any(value.strip() for value in values):
+                continue
+            if self._bad_encoding:
+                self.errors.append((row_num, 'Row is not valid UTF-8.'))
+                continue
+            if len(values) > len(self.fieldnames):
+                self.errors.append(
+                    (row_num, f'Expected {len(self.fieldnames)} columns but found {len(values)}.')
+                )
+                continue
+            yield row_num, dict(zip(self.fieldnames, values))
+
+
+def hash_workers():
+    workers = getattr(settings, 'USER_IMPORT_HASH_WORKERS', None)
+    return workers or os.cpu_count() or 1
+
+
+def hash_pool(workers):
+    """
+    A process pool for hashing. Its workers are spawned rather than forked:
+    the web process runs threads (the logging queue listener) whose locks a
+    forked child could inherit held.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def hash_passwords(passwords, workers=None, progress=None, executor=None):
+    """
+    Hash each password with the configured hasher, spreading the work over a
+    process pool (`executor`, or one started for the call). Every hash gets
+    its own salt, as create_user would give it.
+    """
+    passwords = list(passwords)
+    workers = min(workers or hash_workers(), len(passwords))
+    if workers <= 1 or len(passwords) < MIN_PARALLEL_HASHES:
+        return _collect(map(make_password, passwords), len(passwords), progress)
+
+    if executor is None:
+        with hash_pool(workers) as executor:
+            return hash_passwords(passwords, workers, progress, executor)
+
+    chunksize = max(1, len(passwords) // (workers * 4))
+    return _collect(
+        executor.map(make_password, passwords, chunksize=chunksize), len(passwords), progress
+    )
+
+
+def _collect(hashes, total, progress):
+    collected = []
+    for hashed in hashes:
+        collected.append(hashed)
+        if progress and len(collected) % IMPORT_BATCH_SIZE == 0:
+            progress(len(collected), total)
+    return collected
+
+
+def _clean(row, column):
+    return (row.get(column) or '').strip()
+
+
+def _lookup_map():
+    """
+    Every cluster and collection centre FCP, keyed as ('cluster', lower-cased
+    name) and ('fcp', upper-cased code). Both tables are small.
+    """
+    lookup = {}
+    for cluster in Cluster.objects.all():
+        lookup['cluster', cluster.name.lower()] = cluster
+    for fcp in FCP.objects.filter(is_collection_centre=True).select_related('cc_user'):
+        lookup['fcp', fcp.code.upper()] = fcp
+    return lookup
+
+
+def _parse(rows, state):
+    """Validate each (row number, row) on its own, yielding the normalised rows"""
+    for row_num, row in rows:
+        state.run.rows_read += 1
+        username = User.normalize_username(_clean(row, 'username'))
+        first_name = _clean(row, 'first_name')
+        last_name = _clean(row, 'last_name')
+
+        # Skip empty rows
+        if not username or not first_name or not last_name:
+            continue
+
+        role = _clean(row, 'role').upper()
+        if role not in [User.Role.SDSA, User.Role.CC, User.Role.ADMIN]:
+            state.error(row_num, f'Invalid role "{role}". Must be SDSA, CC, or ADMIN.', username)
+            continue
+
+        row = dict(row)
+        row.update(
+            username=username, first_name=first_name, last_name=last_name, role=role,
+            email=User.objects.normalize_email(_clean(row, 'email')),
+        )
+        yield row_num, row
+
+
+def _passes(parsed):
+    batch = []
+    for item in parsed:
+        batch.append(item)
+        if len(batch) == IMPORT_ROWS_PER_PASS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _ImportState:
+    """
+    What earlier passes of one import have claimed (names, emails and CC
+    FCPs), and the row outcomes not yet written to the run.
+    """
+
+    def __init__(self, run, rows, workers):
+        self.run = run
+        self.rows = rows
+        self.workers = workers
+        self.lookup = None
+        self.taken_usernames = set()
+        self.taken_emails = set()
+        self.linked_fcps = set()
+        self.outcomes = []
+
+    def load_lookup(self):
+        if self.lookup is None:
+            self.lookup = _lookup_map()
+            self.linked_fcps = {
+                key for key, fcp in self.lookup.items()
+                if key[0] == 'fcp' and hasattr(fcp, 'cc_user')
+            }
+        return self.lookup
+
+    def _outcome(self, row_num, outcome, username='', message=''):
+        self.outcomes.append(ImportRowResult(
+            run=self.run, row_number=row_num, outcome=outcome,
+            username=username[:150], message=message[:255],
+        ))
+
+    def error(self, row_num, message, username=''):
+        self.run.error_count += 1
+        self._outcome(row_num, ImportRowResult.Outcome.ERROR, username, message)
+
+    def created(self, row_num, username, warning=''):
+        self.run.created_count += 1
+        if warning:
+            self.run.warning_count += 1
+            self._outcome(row_num, ImportRowResult.Outcome.WARNING, username, warning)
+        else:
+            self._outcome(row_num, ImportRowResult.Outcome.CREATED, username)
+
+    def flush(self):
+        """Write pending outcomes and the run's counters"""
+        # Rows the reader itself could not read
+        reader_errors = getattr(self.rows, 'errors', None)
+        if reader_errors:
+            for row_num, message in reader_errors:
+                self.run.rows_read += 1
+                self.error(row_num, message)
+            reader_errors.clear()
+
+        ImportRowResult.objects.bulk_create(self.outcomes, batch_size=IMPORT_BATCH_SIZE)
+        self.outcomes = []
+        self.run.save(update_fields=['rows_read', 'created_count', 'warning_count', 'error_count'])
+
+
+def import_users(run, rows, default_password='', workers=None, progress=None, default_password_hash=''):
+    """
+    Create users from (row number, row dict) pairs, as CSVImportReader yields
+    them, recording each row's outcome against the ImportRun `run`.
+
+    Rows are handled in passes of IMPORT_ROWS_PER_PASS: existing usernames and
+    emails are fetched in one query per pass, clusters and collection centres
+    resolve from one lookup map, passwords are hashed in a process pool and
+    users are inserted with bulk_create. Each pass commits on its own, with
+    its outcomes. `progress(done, total, message)` is called as passwords
+    are hashed and users saved. `default_password_hash`, an already hashed
+    default password, saves hashing it again for every user.
+    """
+    state = _ImportState(run, rows, workers or hash_workers())
+    run.status = ImportRun.Status.RUNNING
+    run.save(update_fields=['status'])
+
+    # One pool for every pass; worker processes start on first use
+    executor = hash_pool(state.workers) if state.workers > 1 else None
+    try:
+        for batch in _passes(_parse(rows, state)):
+            _import_pass(batch, state, default_password, default_password_hash, executor, progress)
+        state.flush()
+    except Exception as e:
+        run.status = ImportRun.Status.FAILED
+        run.message = f'Import stopped: {e}'
+        raise
+    else:
+        run.status = ImportRun.Status.COMPLETED
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        run.finished_at = timezone.now()
+        run.save(update_fields=['status', 'message', 'finished_at'])
+    return run
+
+
+def _import_pass(parsed, state, default_password, default_password_hash, executor, progress):
+    # Usernames and emails already taken, in one query
+    usernames = {row['username'] for _, row in parsed}
+    emails = {row['email'] for _, row in parsed if row['email']}
+    for username, email in User.objects.filter(
+        Q(username__in=usernames) | Q(email__in=emails)
+    ).values_list('username', 'email'):
+        state.taken_usernames.add(username)
+        if email:
+            state.taken_emails.add(email)
+
+    accepted = []
+    for row_num, row in parsed:
+        username, email = row['username'], row['email']
+
+        # Check if user already exists, in the database or earlier in the file
+        if username in state.taken_usernames:
+            state.error(row_num, f'Username "{username}" already exists.', username)
+            continue
+        if email and email in state.taken_emails:
+            state.error(row_num, f'Email "{email}" already exists.', username)
+            continue
+        state.taken_usernames.add(username)
+        if email:
+            state.taken_emails.add(email)
+
+        # Handle role-specific setup
+        cluster = fcp = None
+        warning = ''
+        if row['role'] == User.Role.SDSA:
+            cluster_name = _clean(row, 'cluster')
+            if cluster_name:
+                cluster = state.load_lookup().get(('cluster', cluster_name.lower()))
+                if cluster is None:
+                    warning = f'Cluster "{cluster_name}" not found.'
+
+        elif row['role'] == User.Role.CC:
+            fcp_code = _clean(row, 'fcp_code')
+            if fcp_code:
+                key = ('fcp', fcp_code.upper())
+                fcp = state.load_lookup().get(key)
+                if fcp is None:
+                    warning = f'Collection Centre FCP "{fcp_code}" not found.'
+                elif key in state.linked_fcps:
+                    warning = f'Collection Centre FCP "{fcp_code}" already has a user.'
+                    fcp = None
+                else:
+                    state.linked_fcps.add(key)
+
+        accepted.append((row_num, row, cluster, fcp, warning))
+
+    if not accepted:
+        state.flush()
+        return
+
+    done = state.run.created_count
+
+    def hashing_progress(hashed, total):
+        progress(done + hashed, None, 'Hashing passwords')
+
+    if default_password_hash:
+        hashes = [default_password_hash] * len(accepted)
+    else:
+        hashes = hash_passwords(
+            (default_password or row['username'] for _, row, _, _, _ in accepted),
+            workers=state.workers,
+            progress=hashing_progress if progress else None,
+            executor=executor,
+        )
+
+    users = [
+        User(
+            username=row['username'],
+            email=row['email'],
+            password=password,
+            first_name=row['first_name'],
+            last_name=row['last_name'],
+            role=row['role'],
+        )
+        for (_, row, _, _, _), password in zip(accepted, hashes)
+    ]
+
+    with transaction.atomic():
+        User.objects.bulk_create(users, batch_size=IMPORT_BATCH_SIZE)
+
+        owned_clusters = {}
+        links = []
+        for (row_num, row, cluster, fcp, warning), user in zip(accepted, users):
+            if cluster is not None:
+                # A later row naming the same cluster takes it over, as before
+                cluster.sdsa_owner = user
+                owned_clusters[cluster.pk] = cluster
+            if fcp is not None:
+                links.append(CollectionCentreUser(user=user, fcp=fcp))
+            state.created(row_num, row['username'], warning)
+
+        if owned_clusters:
+            Cluster.objects.bulk_update(
+                owned_clusters.values(), ['sdsa_owner'], batch_size=IMPORT_BATCH_SIZE
+            )
+        CollectionCentreUser.objects.bulk_create(links, batch_size=IMPORT_BATCH_SIZE)
+        if owned_clusters:
+            # Bulk writes skip the signals that keep the org directory current
+            org_directory.invalidate()
+        state.flush()
+
+    if progress:
+        progress(state.run.created_count, None, 'Saving users')
@@ -1,47 +1,57 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST
 from django.utils import timezone
 from django.db import transaction
 from django.core.paginator import Paginator
-from django.db.models import Q, Count, Sum
+from django.db.models import F, Q, Count, Sum
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.views.generic import ListView, DetailView, CreateView, UpdateView
 from django.urls import reverse_lazy, reverse
 from django.contrib.auth import get_user_model
 from datetime import datetime, timedelta
 import csv
+import hashlib
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth import logout
+from django.contrib.auth.hashers import make_password
+from django.conf import settings
+from django.template.defaultfilters import pluralize
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.dateparse import parse_datetime
+from django.utils.http import url_has_allowed_host_and_scheme
 
-from .models import Shipment, ShipmentItem
+from .models import (
+    ImportRowResult, ImportRun, Job, JobFileChunk, RequestProfile, Shipment, ShipmentEvent, ShipmentItem,
+    refreshing_totals_once
+)
+from .cache import fcp_rosters
+from .exports import Echo, iter_shipment_csv
+from .filters import shipments_for_request
+from .pagination import KeysetPaginator, InvalidCursor
+from .scope import shipment_scope
+from .user_import import CSVImportReader, import_users
+from .jobs import read_file, submit
+from .transitions import (
+    APPLIED, DISTRIBUTE, OUTCOME_LABELS, POST, RECEIVE, transition, transition_many
+)
 from .forms import (
     ShipmentForm, ShipmentItemFormSet, ConfirmReceiptForm, 
-    MarkDistributedForm
+    MarkDistributedForm, DiscrepancyReceiptForm, FCPChoices, ShipmentRosterForm
 )
+from org.directory import get_directory
 from org.models import Cluster, FCP
 from accounts.models import User
 from .forms import BulkUserImportForm
 
 
-def user_can_access_shipment(user, shipment):
-    """Check if user can access a specific shipment"""
-    if user.is_admin():
-        return True
-    
-    if user.is_sdsa():
-        return shipment.cluster in user.managed_clusters.all()
-    
-    if user.is_collection_centre():
-        try:
-            return shipment.cluster == user.collection_centre.fcp.cluster
-        except:
-            return False
-    
-    return False
+STALE_SHIPMENT_MESSAGE = 'This shipment was already updated by someone else. Please review its current status.'
+
+# Above this many items the receipt form only asks for the items that differ
+RECEIPT_FULL_FORM_MAX_ITEMS = 30
 
 
 class ShipmentListView(LoginRequiredMixin, ListView):
@@ -51,75 +61,54 @@ class ShipmentListView(LoginRequiredMixin, ListView):
     paginate_by = 20
     
     def get_queryset(self):
-        queryset = Shipment.objects.select_related(
+        return shipments_for_request(self.request).select_related(
             'cluster', 'collection_centre', 'created_by'
-        ).prefetch_related('items')
-        
-        # Apply filters
-        cluster = self.request.GET.get('cluster')
-        direction = self.request.GET.get('direction')
-        status = self.request.GET.get('status')
-        date_from = self.request.GET.get('date_from')
-        date_to = self.request.GET.get('date_to')
-        
-        if cluster:
-            queryset = queryset.filter(cluster_id=cluster)
-        
-        if direction:
-            queryset = queryset.filter(direction=direction)
-        
-        if status:
-            queryset = queryset.filter(status=status)
-        
-        if date_from:
-            try:
-                date_from = datetime.strptime(date_from, '%Y-%m-%d').date()
-                queryset = queryset.filter(created_at__date__gte=date_from)
-            except ValueError:
-                pass
-        
-        if date_to:
-            try:
-                date_to = datetime.strptime(date_to, '%Y-%m-%d').date()
-                queryset = queryset.filter(created_at__date__lte=date_to)
-            except ValueError:
-                pass
-        
-        # Apply role-based filtering
-        user = self.request.user
-        if user.is_sdsa():
-            queryset = queryset.filter(cluster__in=user.managed_clusters.all())
-        elif user.is_collection_centre():
-            try:
-                queryset = queryset.filter(cluster=user.collection_centre.fcp.cluster)
-            except:
-                queryset = queryset.none()
+        ).prefetch_related('items__fcp')
+    
+    @property
+    def keyset_pagination(self):
+        return getattr(settings, 'SHIPMENT_LIST_PAGINATION', 'keyset') == 'keyset'
+    
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination:
+            return super().paginate_queryset(queryset, page_size)
         
-        return queryset.order_by('-created_at')
+        paginator = KeysetPaginator(
+            queryset, page_size,
+            estimate_total=getattr(settings, 'SHIPMENT_LIST_ESTIMATE_TOTAL', True)
+        )
+        try:
+            page = paginator.page(
+                after=self.request.GET.get('after'),
+                before=self.request.GET.get('before')
+            )
+        except InvalidCursor:
+            page = paginator.page()
+        return (paginator, page, page.object_list, page.has_other_pages())
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        user = self.request.user
+        scope = shipment_scope(self.request)
         
-        # Set current user on each shipment object for template permission checks
+        # Attach the request's scope to each shipment for template permission checks
         for shipment in context['shipments']:
-            shipment._current_user = user
+            shipment._scope = scope
         
         # Add filter options
-        if user.is_admin():
-            context['clusters'] = Cluster.objects.all()
-        elif user.is_sdsa():
-            context['clusters'] = user.managed_clusters.all()
-        elif user.is_collection_centre():
-            try:
-                context['clusters'] = [user.collection_centre.fcp.cluster]
-            except:
-                context['clusters'] = []
+        context['clusters'] = scope.clusters()
         
         context['directions'] = Shipment.Direction.choices
         context['statuses'] = Shipment.Status.choices
         context['current_filters'] = self.request.GET
         
+        # Filters without any pagination parameters, for building page links
+        filter_params = self.request.GET.copy()
+        for param in ('page', 'after', 'before'):
+            filter_params.pop(param, None)
+        context['filter_querystring'] = filter_params.urlencode()
+        context['keyset_pagination'] = self.keyset_pagination
+        context['batch_actions'] = scope.is_admin or scope.is_sdsa
+        
         return context
 
 
@@ -133,29 +122,44 @@ class ShipmentDetailView(LoginRequiredMixin, DetailView):
             'cluster', 'collection_centre', 'created_by'
         ).prefetch_related('items__fcp')
     
+    def get_object(self, queryset=None):
+        # Loaded once in dispatch() and reused by get() and get_context_data()
+        if not hasattr(self, '_shipment'):
+            self._shipment = super().get_object(queryset)
+        return self._shipment
+    
     def dispatch(self, request, *args, **kwargs):
-        shipment = self.get_object()
-        if not user_can_access_shipment(request.user, shipment):
-            messages.error(request, 'You do not have permission to view this shipment.')
-            return redirect('shipment_list')
+        if request.user.is_authenticated:
+            shipment = self.get_object()
+            if not shipment_scope(request).can_access(shipment):
+                messages.error(request, 'You do not have permission to view this shipment.')
+                return redirect('shipping:shipment_list')
         return super().dispatch(request, *args, **kwargs)
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        shipment = self.get_object()
+        shipment = self.object
+        scope = shipment_scope(self.request)
         
-        # Set current user on shipment object for template permission checks
-        shipment._current_user = self.request.user
+        # Attach the request's scope to the shipment for template permission checks
+        shipment._scope = scope
         
         # Add user to context for permission checks
         context['current_user'] = self.request.user
         
         # Add action forms
-        if shipment.can_confirm_receipt_as_user(self.request.user):
-            context['confirm_form'] = ConfirmReceiptForm(shipment=shipment)
+        items = shipment.items.all()  # prefetched with their FCPs
+        if scope.can_confirm_receipt(shipment):
+            if shipment.item_count > RECEIPT_FULL_FORM_MAX_ITEMS:
+                context['confirm_form'] = DiscrepancyReceiptForm(shipment=shipment)
+                context['discrepancies_only'] = True
+            else:
+                context['confirm_form'] = ConfirmReceiptForm(shipment=shipment, items=items)
         
         if shipment.can_mark_distributed():
-            context['distribute_form'] = MarkDistributedForm(shipment=shipment)
+            context['distribute_form'] = MarkDistributedForm(shipment=shipment, items=items)
+        
+        context['events'] = shipment.events.select_related('actor')
         
         return context
 
@@ -163,13 +167,21 @@ class ShipmentDetailView(LoginRequiredMixin, DetailView):
 @login_required
 def create_outgoing_shipment(request):
     """Create outgoing shipment (SDSA only)"""
-    if not request.user.is_sdsa():
+    scope = shipment_scope(request)
+    if not scope.is_sdsa:
         messages.error(request, 'Only SDSA users can create outgoing shipments.')
         return redirect('dashboard')
     
+    # FCP options for every item row, built once; SDSA users may send to any
+    # FCP in their clusters, collection centres included
+    item_kwargs = {
+        'direction': Shipment.Direction.OUT,
+        'fcp_choices': FCPChoices(scope.managed_cluster_ids),
+    }
+    
     if request.method == 'POST':
-        form = ShipmentForm(request.POST, user=request.user)
-        formset = ShipmentItemFormSet(request.POST, instance=Shipment())
+        form = ShipmentForm(request.POST, scope=scope)
+        formset = ShipmentItemFormSet(request.POST, instance=Shipment(), form_kwargs=item_kwargs)
         
         if form.is_valid() and formset.is_valid():
             with transaction.atomic():
@@ -179,52 +191,22 @@ def create_outgoing_shipment(request):
                 shipment.direction = Shipment.Direction.OUT
                 
                 # Set collection centre from cluster
-                if shipment.cluster:
-                    cc = shipment.cluster.get_collection_centre()
-                    if cc:
-                        shipment.collection_centre = cc
+                if shipment.cluster_id:
+                    cc_id = get_directory().collection_centre_ids.get(shipment.cluster_id)
+                    if cc_id:
+                        shipment.collection_centre_id = cc_id
                 
                 shipment.save()
                 
-                # Create shipment items
+                # Create shipment items in one INSERT
                 formset.instance = shipment
-                formset.save()
+                formset.save_new_items()
                 
                 messages.success(request, 'Outgoing shipment created successfully.')
                 return redirect('shipping:shipment_detail', pk=shipment.pk)
     else:
-        form = ShipmentForm(user=request.user)
-        # Create formset with proper parameters
-        formset = ShipmentItemFormSet(
-            instance=Shipment(),
-            form_kwargs={'cluster': None, 'direction': Shipment.Direction.OUT}
-        )
-    
-    # Pre-populate FCP dropdowns with available FCPs for the user's managed clusters
-    if request.user.role == User.Role.SDSA:
-        managed_clusters = request.user.managed_clusters.all()
-        if managed_clusters:
-            # Get all FCPs from managed clusters (including collection centres)
-            # Collection centres can now receive packages for their own use
-            available_fcps = FCP.objects.filter(
-                cluster__in=managed_clusters
-                # Removed is_collection_centre=False filter to allow collection centres
-            )
-            
-            # Set the queryset for all FCP dropdowns
-            for formset_form in formset.forms:
-                formset_form.fields['fcp'].queryset = available_fcps
-                formset_form.fields['fcp'].empty_label = "Select FCP"
-                formset_form.fields['fcp'].widget.attrs.update({
-                    'class': 'form-select fcp-select'
-                })
-    else:
-        # For other user types, start with empty queryset
-        for formset_form in formset.forms:
-            formset_form.fields['fcp'].queryset = FCP.objects.none()
-            formset_form.fields['fcp'].widget.attrs.update({
-                'class': 'form-select fcp-select'
-            })
+        form = ShipmentForm(scope=scope)
+        formset = ShipmentItemFormSet(instance=Shipment(), form_kwargs=item_kwargs)
     
     context = {
         'form': form,
@@ -235,23 +217,69 @@ def create_outgoing_shipment(request):
     return render(request, 'shipping/shipment_form.html', context)
 
 
+@login_required
+def create_roster_shipment(request):
+    """Create an outgoing shipment from a quantity grid of every FCP in a cluster (SDSA only)"""
+    scope = shipment_scope(request)
+    if not scope.is_sdsa:
+        messages.error(request, 'Only SDSA users can create outgoing shipments.')
+        return redirect('shipping:dashboard')
+    
+    if request.method == 'POST':
+        form = ShipmentRosterForm(request.POST, scope=scope)
+        
+        if form.is_valid():
+            with transaction.atomic():
+                shipment = form.save(commit=False)
+                shipment.created_by = request.user
+                shipment.direction = Shipment.Direction.OUT
+                shipment.collection_centre_id = get_directory().collection_centre_ids[shipment.cluster_id]
+                shipment.save()
+                
+                # One INSERT for every item; bulk_create also refreshes the totals
+                items = ShipmentItem.objects.bulk_create(form.build_items(shipment))
+            
+            messages.success(
+                request,
+                f'Outgoing shipment created with {len(items)} FCP{pluralize(len(items))}.'
+            )
+            return redirect('shipping:shipment_detail', pk=shipment.pk)
+    else:
+        form = ShipmentRosterForm(scope=scope)
+    
+    context = {
+        'form': form,
+        'title': 'Create Outgoing Shipment',
+    }
+    return render(request, 'shipping/shipment_roster_form.html', context)
+
+
 @login_required
 def create_return_shipment(request):
     """Create return shipment (CC only)"""
-    if not request.user.is_collection_centre():
+    scope = shipment_scope(request)
+    if not scope.is_collection_centre:
         messages.error(request, 'Only Collection Centre users can create return shipments.')
         return redirect('dashboard')
     
-    try:
-        cc_fcp = request.user.collection_centre.fcp
-        cluster = cc_fcp.cluster
-    except:
+    if scope.cc_fcp_id is None:
         messages.error(request, 'Your collection centre is not properly configured.')
         return redirect('dashboard')
+    directory = get_directory()
+    cc_fcp = directory.fcp(scope.cc_fcp_id)
+    cluster = directory.cluster(scope.cc_cluster_id)
+    
+    # FCP options for every item row, built once; returns come from the
+    # cluster's FCPs, not the collection centre itself
+    item_kwargs = {
+        'cluster': cluster,
+        'direction': Shipment.Direction.RET,
+        'fcp_choices': FCPChoices([cluster.pk], include_collection_centres=False),
+    }
     
     if request.method == 'POST':
-        form = ShipmentForm(request.POST, user=request.user)
-        formset = ShipmentItemFormSet(request.POST, instance=Shipment())
+        form = ShipmentForm(request.POST, scope=scope)
+        formset = ShipmentItemFormSet(request.POST, instance=Shipment(), form_kwargs=item_kwargs)
         
         if form.is_valid() and formset.is_valid():
             with transaction.atomic():
@@ -263,26 +291,15 @@ def create_return_shipment(request):
                 shipment.collection_centre = cc_fcp
                 shipment.save()
                 
-                # Create shipment items
+                # Create shipment items in one INSERT
                 formset.instance = shipment
-                formset.save()
+                formset.save_new_items()
                 
                 messages.success(request, 'Return shipment created successfully.')
                 return redirect('shipping:shipment_detail', pk=shipment.pk)
     else:
-        form = ShipmentForm(user=request.user)
-        # Create formset with proper parameters
-        formset = ShipmentItemFormSet(
-            instance=Shipment(),
-            form_kwargs={'cluster': cluster, 'direction': Shipment.Direction.RET}
-        )
-    
-    # Set cluster and direction for formset
-    for formset_form in formset.forms:
-        formset_form.fields['fcp'].queryset = FCP.objects.filter(
-            cluster=cluster, 
-            is_collection_centre=False
-        )
+        form = ShipmentForm(scope=scope)
+        formset = ShipmentItemFormSet(instance=Shipment(), form_kwargs=item_kwargs)
     
     context = {
         'form': form,
@@ -299,46 +316,101 @@ def confirm_receipt(request, pk):
     """Confirm receipt of shipment"""
     shipment = get_object_or_404(Shipment, pk=pk)
     
-    if not shipment.can_confirm_receipt_as_user(request.user):
+    if not shipment_scope(request).can_confirm_receipt(shipment):
         messages.error(request, 'You do not have permission to confirm this shipment.')
         return redirect('shipping:shipment_detail', pk=pk)
     
-    form = ConfirmReceiptForm(request.POST, shipment=shipment)
+    if request.POST.get('mode') == DiscrepancyReceiptForm.MODE:
+        return _confirm_receipt_discrepancies(request, shipment)
+    
+    # Items and their FCPs are loaded once and shared with the form
+    items = list(shipment.items.select_related('fcp'))
+    form = ConfirmReceiptForm(request.POST, shipment=shipment, items=items)
     if form.is_valid():
-        with transaction.atomic():
-            # Update shipment status
-            if shipment.direction == Shipment.Direction.OUT:
-                shipment.status = Shipment.Status.RECEIVED_CC
-            else:  # RET
-                shipment.status = Shipment.Status.RECEIVED_NO
+        # Apply the quantities in memory first so the event can record what they change
+        received_before = sum(item.qty_received or 0 for item in items)
+        discrepancies_before = sum(item.has_discrepancy for item in items)
+        received = []
+        for item in items:
+            qty_field = f'qty_received_{item.id}'
+            note_field = f'discrepancy_note_{item.id}'
             
-            shipment.received_at = timezone.now()
-            shipment.save()
-            
-            # Update shipment items
-            for item in shipment.items.all():
-                qty_field = f'qty_received_{item.id}'
-                note_field = f'discrepancy_note_{item.id}'
-                
-                if qty_field in form.cleaned_data:
-                    item.qty_received = form.cleaned_data[qty_field]
-                    item.discrepancy_note = form.cleaned_data.get(note_field, '')
-                    item.save()
+            if qty_field in form.cleaned_data:
+                item.qty_received = form.cleaned_data[qty_field]
+                item.discrepancy_note = form.cleaned_data.get(note_field, '')
+                received.append(item)
+        
+        with transaction.atomic():
+            # Only the request that moves the shipment out of CREATED records quantities
+            if not transition(
+                shipment, RECEIVE, actor=request.user,
+                received_delta=sum(item.qty_received or 0 for item in items) - received_before,
+                discrepancy_delta=sum(item.has_discrepancy for item in items) - discrepancies_before,
+            ):
+                messages.error(request, STALE_SHIPMENT_MESSAGE)
+                return redirect('shipping:shipment_detail', pk=pk)
             
-            messages.success(request, 'Shipment receipt confirmed successfully.')
+            # Update shipment items in one statement; the queryset keeps the
+            # shipment's stored totals in step
+            ShipmentItem.objects.bulk_update(received, ['qty_received', 'discrepancy_note'])
+        
+        messages.success(request, 'Shipment receipt confirmed successfully.')
     else:
         messages.error(request, 'Please correct the errors below.')
     
     return redirect('shipping:shipment_detail', pk=pk)
 
 
+def _confirm_receipt_discrepancies(request, shipment):
+    """
+    Confirm receipt from the items that differ from the plan alone.
+    
+    Every other item is received in full by one UPDATE, and the listed ones
+    are written by one bulk_update, so the request costs the same for 10
+    items as for 1,000.
+    """
+    form = DiscrepancyReceiptForm(request.POST, shipment=shipment)
+    if not form.is_valid():
+        for error in form.errors.get('discrepancies', []):
+            messages.error(request, error)
+        return redirect('shipping:shipment_detail', pk=shipment.pk)
+    
+    received_delta, discrepancy_delta = form.totals_delta()
+    with transaction.atomic():
+        if not transition(
+            shipment, RECEIVE, actor=request.user,
+            received_delta=received_delta, discrepancy_delta=discrepancy_delta,
+        ):
+            messages.error(request, STALE_SHIPMENT_MESSAGE)
+            return redirect('shipping:shipment_detail', pk=shipment.pk)
+        
+        # Both writes go through the queryset, which keeps the stored totals
+        # in step; they are refreshed once for the two
+        with refreshing_totals_once():
+            shipment.items.exclude(pk__in=[item.pk for item in form.exceptions]).update(
+                qty_received=F('qty_planned'), discrepancy_note=''
+            )
+            ShipmentItem.objects.bulk_update(form.exceptions, ['qty_received', 'discrepancy_note'])
+    
+    discrepancies = sum(item.has_discrepancy for item in form.exceptions)
+    if discrepancies:
+        messages.success(
+            request,
+            f'Shipment receipt confirmed with {discrepancies} '
+            f'discrepanc{pluralize(discrepancies, "y,ies")} recorded.'
+        )
+    else:
+        messages.success(request, 'Shipment receipt confirmed successfully.')
+    return redirect('shipping:shipment_detail', pk=shipment.pk)
+
+
 @login_required
 @require_POST
 def mark_distributed(request, pk):
     """Mark shipment as distributed to FCPs (OUT only)"""
     shipment = get_object_or_404(Shipment, pk=pk)
     
-    if not user_can_access_shipment(request.user, shipment):
+    if not shipment_scope(request).can_access(shipment):
         messages.error(request, 'You do not have permission to mark this shipment as distributed.')
         return redirect('shipping:shipment_detail', pk=pk)
     
@@ -346,13 +418,13 @@ def mark_distributed(request, pk):
         messages.error(request, 'This shipment cannot be marked as distributed.')
         return redirect('shipping:shipment_detail', pk=pk)
     
-    form = MarkDistributedForm(request.POST, shipment=shipment)
+    form = MarkDistributedForm(request.POST, shipment=shipment,
+                               items=shipment.items.select_related('fcp'))
     if form.is_valid():
-        shipment.status = Shipment.Status.DISTRIBUTED
-        shipment.distributed_at = timezone.now()
-        shipment.save()
-        
-        messages.success(request, 'Shipment marked as distributed successfully.')
+        if transition(shipment, DISTRIBUTE, actor=request.user):
+            messages.success(request, 'Shipment marked as distributed successfully.')
+        else:
+            messages.error(request, STALE_SHIPMENT_MESSAGE)
     else:
         messages.error(request, 'Please correct the errors below.')
     
@@ -365,11 +437,12 @@ def mark_posted(request, pk):
     """Mark return shipment as posted (SDSA only)"""
     shipment = get_object_or_404(Shipment, pk=pk)
     
-    if not request.user.is_sdsa():
+    scope = shipment_scope(request)
+    if not scope.is_sdsa:
         messages.error(request, 'Only SDSA users can mark shipments as posted.')
         return redirect('shipping:shipment_detail', pk=pk)
     
-    if not user_can_access_shipment(request.user, shipment):
+    if not scope.can_access(shipment):
         messages.error(request, 'You do not have permission to mark this shipment as posted.')
         return redirect('shipping:shipment_detail', pk=pk)
     
@@ -377,76 +450,221 @@ def mark_posted(request, pk):
         messages.error(request, 'This shipment cannot be marked as posted.')
         return redirect('shipping:shipment_detail', pk=pk)
     
-    shipment.status = Shipment.Status.POSTED
-    shipment.posted_at = timezone.now()
-    shipment.save()
-    
-    messages.success(request, 'Shipment marked as posted successfully.')
+    if transition(shipment, POST, actor=request.user):
+        messages.success(request, 'Shipment marked as posted successfully.')
+    else:
+        messages.error(request, STALE_SHIPMENT_MESSAGE)
     return redirect('shipping:shipment_detail', pk=pk)
 
 
+# Actions offered on the shipment list; receipts need per-item quantities
+BATCH_ACTIONS = {
+    DISTRIBUTE: 'marked as distributed',
+    POST: 'marked as posted',
+}
+BATCH_TRANSITION_LIMIT = 500
+
+
+@login_required
+@require_POST
+def batch_transition(request):
+    """Apply one transition to a set of shipments, reporting the outcome per shipment"""
+    scope = shipment_scope(request)
+    wants_json = 'application/json' in request.headers.get('Accept', '')
+    next_url = request.POST.get('next')
+    if not url_has_allowed_host_and_scheme(next_url, allowed_hosts={request.get_host()}):
+        next_url = reverse('shipping:shipment_list')
+    
+    def reject(message, status=400):
+        if wants_json:
+            return JsonResponse({'error': message}, status=status)
+        messages.error(request, message)
+        return redirect(next_url)
+    
+    if not (scope.is_admin or scope.is_sdsa):
+        return reject('Only SDSA and admin users can update shipments in batches.', status=403)
+    
+    action = request.POST.get('action')
+    if action not in BATCH_ACTIONS:
+        return reject('Unknown batch action.')
+    
+    try:
+        shipment_ids = {int(pk) for pk in request.POST.getlist('ids')}
+    except ValueError:
+        return reject('Invalid shipment selection.')
+    if not shipment_ids:
+        return reject('Select at least one shipment.')
+    if len(shipment_ids) > BATCH_TRANSITION_LIMIT:
+        return reject(f'Select at most {BATCH_TRANSITION_LIMIT} shipments at a time.')
+    
+    outcomes = transition_many(
+        shipment_ids, action, cluster_ids=scope.batch_cluster_ids, actor=request.user
+    )
+    
+    if wants_json:
+        return JsonResponse({
+            'action': action,
+            'results': {str(pk): outcome for pk, outcome in sorted(outcomes.items())},
+        })
+    
+    by_outcome = {}
+    for pk, outcome in sorted(outcomes.items()):
+        by_outcome.setdefault(outcome, []).append(f'#{pk}')
+    applied = len(by_outcome.pop(APPLIED, []))
+    if applied:
+        messages.success(request, f'{applied} shipment{pluralize(applied)} {BATCH_ACTIONS[action]}.')
+    for outcome, ids in by_outcome.items():
+        messages.warning(request, f'{OUTCOME_LABELS[outcome]}: {", ".join(ids)}')
+    return redirect(next_url)
+
+
+EVENT_FEED_PAGE_SIZE = 500
+
+
+def _parse_event_cursor(value):
+    """
+    (xact_id, id) from an events feed cursor, or None for the start.
+    
+    Cursors are "<xact_id>.<id>"; a bare event id (the earlier format)
+    resumes after that event.
+    """
+    if not value:
+        return None
+    xact_id, dot, event_id = value.partition('.')
+    if dot:
+        return int(xact_id), int(event_id)
+    event_id = int(value)
+    xact_id = ShipmentEvent.objects.filter(pk=event_id).values_list('xact_id', flat=True).first()
+    return (xact_id, event_id) if xact_id is not None else None
+
+
+@login_required
+def shipment_events_feed(request):
+    """
+    Shipment events in the user's clusters as JSON, in commit-safe order.
+    
+    Consumers start from ?since=<ISO datetime> (or the beginning) and then
+    page with ?after=<next_after of the last page>, which only ever scans
+    new rows. Events appear once the transactions older than theirs have
+    finished, so a long-running transaction delays the feed but never makes
+    it skip an event.
+    """
+    try:
+        after = _parse_event_cursor(request.GET.get('after'))
+        limit = max(1, min(int(request.GET.get('limit') or EVENT_FEED_PAGE_SIZE), EVENT_FEED_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({'error': 'after must be a feed cursor and limit an integer'}, status=400)
+    
+    events = ShipmentEvent.objects.visible_to(shipment_scope(request)).after(after)
+    since = request.GET.get('since')
+    if since:
+        since = parse_datetime(since)
+        if since is None:
+            return JsonResponse({'error': 'since must be an ISO 8601 datetime'}, status=400)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        events = events.occurred_between(start=since)
+    
+    page = list(events.values(
+        'id', 'shipment_id', 'cluster_id', 'actor_id', 'from_status', 'to_status',
+        'occurred_at', 'received_delta', 'discrepancy_delta', 'xact_id'
+    )[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    if page:
+        after = (page[-1]['xact_id'], page[-1]['id'])
+    for event in page:
+        del event['xact_id']
+    return JsonResponse({
+        'events': page,
+        'next_after': f'{after[0]}.{after[1]}' if after else '',
+        'has_more': has_more,
+    })
+
+
 @login_required
 def export_shipments_csv(request):
     """Export shipments to CSV"""
-    if not request.user.is_admin() and not request.user.is_sdsa():
+    scope = shipment_scope(request)
+    if not scope.is_admin and not scope.is_sdsa:
         messages.error(request, 'You do not have permission to export shipments.')
         return redirect('shipping:shipment_list')
     
-    # Get filtered queryset
-    shipments = ShipmentListView.as_view()(request).context_data['shipments']
-    
-    response = HttpResponse(content_type='text/csv')
+    # Large exports can be built by the job worker and downloaded when ready
+    if request.GET.get('background'):
+        params = {key: value for key, value in request.GET.items() if key != 'background'}
+        job = submit('shipment_export', request.user, {'params': params})
+        return redirect('shipping:job_detail', pk=job.pk)
+    
+    # Same filters and role scoping as the list view, but every matching row
+    response = StreamingHttpResponse(
+        iter_shipment_csv(shipments_for_request(request)),
+        content_type='text/csv'
+    )
     response['Content-Disposition'] = 'attachment; filename="shipments.csv"'
-    
-    writer = csv.writer(response)
-    writer.writerow([
-        'ID', 'Direction', 'Cluster', 'Collection Centre', 'Status', 
-        'ETA', 'Total Packages', 'Total Received', 'Created By', 'Created At'
-    ])
-    
-    for shipment in shipments:
-        writer.writerow([
-            shipment.id,
-            shipment.get_direction_display(),
-            shipment.cluster.name,
-            shipment.collection_centre.code,
-            shipment.get_status_display(),
-            shipment.estimated_delivery_date,
-            shipment.total_packages,
-            shipment.total_received,
-            shipment.created_by.username,
-            shipment.created_at.strftime('%Y-%m-%d %H:%M')
-        ])
-    
     return response
 
 
 # AJAX views for dynamic form handling
+def _fcp_directory_response(request, payload, etag):
+    """JSON response the browser may keep and revalidate with If-None-Match"""
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = JsonResponse(payload)
+    response['ETag'] = etag
+    patch_cache_control(
+        response, private=True, must_revalidate=True,
+        max_age=getattr(settings, 'FCP_DIRECTORY_MAX_AGE', 0)
+    )
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
 @login_required
 def get_fcps_for_cluster(request):
-    """Get FCPs for a specific cluster (AJAX)"""
-    cluster_id = request.GET.get('cluster_id') or request.GET.get('cluster')
-    direction = request.GET.get('direction')
+    """
+    Get FCPs for a specific cluster (AJAX), or with ?all=1 for every cluster
+    the user can see.
+
+    Rosters are versioned per cluster and served with strong ETags, so
+    unchanged data costs the browser a 304 rather than a fresh download.
+    """
+    scope = shipment_scope(request)
+    visible = scope.visible_cluster_ids
+    
+    if request.GET.get('all'):
+        if visible is None:
+            visible = get_directory().clusters
+        cluster_ids = sorted(visible)
+        versions, rosters = fcp_rosters(cluster_ids)
+        fingerprint = ','.join(f'{cluster_id}={versions[cluster_id]}' for cluster_id in cluster_ids)
+        etag = f'"fcp-all-{hashlib.md5(fingerprint.encode()).hexdigest()}"'
+        # [[id, code, name, is_collection_centre], ...] per cluster id
+        payload = {'clusters': {str(cluster_id): rosters[cluster_id] for cluster_id in cluster_ids}}
+        return _fcp_directory_response(request, payload, etag)
     
+    cluster_id = request.GET.get('cluster_id') or request.GET.get('cluster')
     if not cluster_id:
         return JsonResponse({'fcps': [], 'error': 'No cluster ID provided'})
-    
     try:
-        cluster = Cluster.objects.get(pk=cluster_id)
-        fcps = FCP.objects.filter(cluster=cluster)
-        
-        # For outgoing shipments, we now allow collection centre FCPs
-        # Collection centres can receive packages for their own use
-        if direction == 'OUT':
-            # Include all FCPs including collection centres
-            pass
-        
-        fcp_data = [{'id': fcp.id, 'code': fcp.code, 'name': fcp.name or ''} for fcp in fcps]
-        return JsonResponse({'fcps': fcp_data})
-    except Cluster.DoesNotExist:
+        cluster_id = int(cluster_id)
+    except ValueError:
+        return JsonResponse({'fcps': [], 'error': f'Cluster with ID {cluster_id} not found'})
+    
+    if visible is None:
+        known = cluster_id in get_directory().clusters
+    else:
+        known = cluster_id in visible
+    if not known:
         return JsonResponse({'fcps': [], 'error': f'Cluster with ID {cluster_id} not found'})
-    except Exception as e:
-        return JsonResponse({'fcps': [], 'error': f'Unexpected error: {str(e)}'})
+    
+    versions, rosters = fcp_rosters([cluster_id])
+    fcp_data = [
+        {'id': fcp_id, 'code': code, 'name': name or ''}
+        for fcp_id, code, name, _ in rosters[cluster_id]
+    ]
+    etag = f'"fcp-{cluster_id}-{versions[cluster_id]}"'
+    return _fcp_directory_response(request, {'fcps': fcp_data}, etag)
 
 
 @csrf_exempt
@@ -471,111 +689,235 @@ def bulk_user_import(request):
             default_password = form.cleaned_data['default_password']
             send_welcome_emails = form.cleaned_data['send_welcome_emails']
             
+            run = ImportRun.objects.create(filename=csv_file.name[:255], created_by=request.user)
+            
+            if form.cleaned_data['run_in_background']:
+                # Imports are not safe to repeat, so the job is not retried.
+                # The queued job keeps only a hash of the default password.
+                job = submit(
+                    'user_import', request.user,
+                    {
+                        'default_password_hash': make_password(default_password) if default_password else '',
+                        'run_id': run.pk,
+                    },
+                    input_file=csv_file.chunks(),
+                    max_attempts=1,
+                )
+                run.job = job
+                run.save(update_fields=['job'])
+                return redirect('shipping:job_detail', pk=job.pk)
+            
             try:
-                import csv
-                from django.contrib.auth import get_user_model
-                from django.db import transaction
-                
-                User = get_user_model()
-                results = {
-                    'success': [],
-                    'errors': [],
-                    'total_processed': 0
-                }
-                
-                # Read CSV file
-                content = csv_file.read().decode('utf-8')
-                reader = csv.DictReader(content.splitlines())
-                
-                with transaction.atomic():
-                    for row_num, row in enumerate(reader, start=2):  # Start at 2 for row numbers
-                        try:
-                            # Clean and validate row data
-                            username = row['username'].strip()
-                            first_name = row['first_name'].strip()
-                            last_name = row['last_name'].strip()
-                            email = row['email'].strip()
-                            role = row['role'].strip().upper()
-                            
-                            # Skip empty rows
-                            if not username or not first_name or not last_name:
-                                continue
-                            
-                            # Validate role
-                            if role not in [User.Role.SDSA, User.Role.CC, User.Role.ADMIN]:
-                                results['errors'].append(f'Row {row_num}: Invalid role "{role}". Must be SDSA, CC, or ADMIN.')
-                                continue
-                            
-                            # Check if user already exists
-                            if User.objects.filter(username=username).exists():
-                                results['errors'].append(f'Row {row_num}: Username "{username}" already exists.')
-                                continue
-                            
-                            if email and User.objects.filter(email=email).exists():
-                                results['errors'].append(f'Row {row_num}: Email "{email}" already exists.')
-                                continue
-                            
-                            # Create user
-                            password = default_password or username
-                            user = User.objects.create_user(
-                                username=username,
-                                email=email,
-                                password=password,
-                                first_name=first_name,
-                                last_name=last_name,
-                                role=role
-                            )
-                            
-                            # Handle role-specific setup
-                            if role == User.Role.SDSA:
-                                # Handle cluster assignment if provided
-                                cluster_name = row.get('cluster', '').strip()
-                                if cluster_name:
-                                    try:
-                                        cluster = Cluster.objects.get(name__iexact=cluster_name)
-                                        user.managed_clusters.add(cluster)
-                                    except Cluster.DoesNotExist:
-                                        results['errors'].append(f'Row {row_num}: Cluster "{cluster_name}" not found.')
-                            
-                            elif role == User.Role.CC:
-                                # Handle collection centre FCP assignment if provided
-                                fcp_code = row.get('fcp_code', '').strip()
-                                if fcp_code:
-                                    try:
-                                        fcp = FCP.objects.get(code__iexact=fcp_code, is_collection_centre=True)
-                                        # Create collection centre user link
-                                        from accounts.models import CollectionCentreUser
-                                        CollectionCentreUser.objects.create(user=user, fcp=fcp)
-                                    except FCP.DoesNotExist:
-                                        results['errors'].append(f'Row {row_num}: Collection Centre FCP "{fcp_code}" not found.')
-                            
-                            results['success'].append(f'Row {row_num}: User "{username}" created successfully.')
-                            results['total_processed'] += 1
-                            
-                        except Exception as e:
-                            results['errors'].append(f'Row {row_num}: Error creating user: {str(e)}')
-                
-                # Show results
-                if results['success']:
-                    messages.success(request, f'Successfully created {results["total_processed"]} users!')
-                if results['errors']:
-                    for error in results['errors']:
-                        messages.warning(request, error)
-                
-                return redirect('shipping:bulk_user_import')
-                
+                # Rows are read and imported as the upload is streamed
+                import_users(run, CSVImportReader(csv_file.chunks()), default_password)
             except Exception as e:
                 messages.error(request, f'Error processing CSV file: {str(e)}')
+            else:
+                # One summary message; the row outcomes stay on the run
+                messages.success(
+                    request,
+                    f'Created {run.created_count} users; {run.error_count} rows not imported.'
+                )
+            return redirect('shipping:import_run_detail', pk=run.pk)
     else:
         form = BulkUserImportForm()
     
     context = {
         'form': form,
-        'title': 'Bulk User Import'
+        'title': 'Bulk User Import',
+        'recent_runs': ImportRun.objects.select_related('created_by')[:10],
     }
     return render(request, 'shipping/bulk_user_import.html', context)
 
 
+IMPORT_ROWS_PER_PAGE = 50
+
+
+@login_required
+def import_run_detail(request, pk):
+    """Outcome of an import run, one page of rows at a time"""
+    if not request.user.is_admin():
+        messages.error(request, 'Only admin users can view imports.')
+        return redirect('shipping:dashboard')
+    
+    run = get_object_or_404(ImportRun.objects.select_related('created_by'), pk=pk)
+    rows = run.rows.all()
+    
+    outcome = request.GET.get('outcome')
+    if outcome in ImportRowResult.Outcome.values:
+        rows = rows.filter(outcome=outcome)
+    search = request.GET.get('q', '').strip()
+    if search:
+        rows = rows.filter(Q(username__icontains=search) | Q(message__icontains=search))
+    
+    filter_params = request.GET.copy()
+    filter_params.pop('page', None)
+    
+    page_obj = Paginator(rows, IMPORT_ROWS_PER_PAGE).get_page(request.GET.get('page'))
+    context = {
+        'run': run,
+        'page_obj': page_obj,
+        'rows': page_obj.object_list,
+        'outcome': outcome,
+        'search': search,
+        'outcomes': ImportRowResult.Outcome.choices,
+        'filter_querystring': filter_params.urlencode(),
+    }
+    return render(request, 'shipping/import_run_detail.html', context)
+
+
+@login_required
+def import_run_errors_csv(request, pk):
+    """Download the rows of an import run that were not imported cleanly"""
+    if not request.user.is_admin():
+        messages.error(request, 'Only admin users can view imports.')
+        return redirect('shipping:dashboard')
+    
+    run = get_object_or_404(ImportRun, pk=pk)
+    rows = run.rows.exclude(outcome=ImportRowResult.Outcome.CREATED).values_list(
+        'row_number', 'username', 'outcome', 'message'
+    )
+    outcomes = dict(ImportRowResult.Outcome.choices)
+    
+    def lines():
+        writer = csv.writer(Echo())
+        yield writer.writerow(['Row', 'Username', 'Outcome', 'Message'])
+        for row_number, username, outcome, message in rows.iterator(chunk_size=2000):
+            yield writer.writerow([row_number, username, outcomes[outcome], message])
+    
+    response = StreamingHttpResponse(lines(), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="import_{run.pk}_errors.csv"'
+    return response
+
+
+def _job_for_user(request, pk):
+    job = get_object_or_404(Job, pk=pk)
+    if not job.can_view(shipment_scope(request)):
+        return None
+    return job
+
+
+@login_required
+def job_detail(request, pk):
+    """Progress page for a background job; polls job_status until it finishes"""
+    job = _job_for_user(request, pk)
+    if job is None:
+        messages.error(request, 'You do not have permission to view this job.')
+        return redirect('shipping:dashboard')
+    return render(request, 'shipping/job_detail.html', {'job': job})
+
+
+@login_required
+def job_status(request, pk):
+    """Job status, progress and result as JSON"""
+    job = _job_for_user(request, pk)
+    if job is None:
+        return JsonResponse({'error': 'You do not have permission to view this job.'}, status=403)
+    
+    data = {
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'finished': job.is_finished,
+        'attempts': job.attempts,
+        'progress': {
+            'done': job.progress_done,
+            'total': job.progress_total,
+            'message': job.progress_message,
+        },
+        'result': job.result,
+        'error': job.error.strip().splitlines()[-1] if job.error else '',
+        'download_url': None,
+    }
+    if job.status == Job.Status.SUCCEEDED and job.result_filename:
+        data['download_url'] = reverse('shipping:job_download', args=[job.pk])
+    return JsonResponse(data)
+
+
+@login_required
+def job_download(request, pk):
+    """Download the file a finished job produced"""
+    job = _job_for_user(request, pk)
+    if job is None or job.status != Job.Status.SUCCEEDED or not job.result_filename:
+        messages.error(request, 'This job has no file to download.')
+        return redirect('shipping:dashboard')
+    
+    response = StreamingHttpResponse(read_file(job, JobFileChunk.Kind.RESULT), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{job.result_filename}"'
+    return response
+
+
+PROFILES_PER_PAGE = 50
+
+# ?sort= value -> ordering of the profile list
+PROFILE_ORDERINGS = {
+    'recent': ('-created_at',),
+    'slowest': ('-duration_ms',),
+    'queries': ('-query_count', '-created_at'),
+}
+
+
+@login_required
+def profile_list(request):
+    """Profiles recorded by ProfilingMiddleware, newest or slowest first"""
+    if not request.user.is_admin():
+        messages.error(request, 'Only admin users can view request profiles.')
+        return redirect('shipping:dashboard')
+    
+    # The stored stats and reports are only read on download
+    profiles = RequestProfile.objects.select_related('created_by').defer(
+        'stats', 'call_tree', 'allocations'
+    )
+    sort = request.GET.get('sort')
+    if sort not in PROFILE_ORDERINGS:
+        sort = 'recent'
+    profiles = profiles.order_by(*PROFILE_ORDERINGS[sort])
+    search = request.GET.get('q', '').strip()
+    if search:
+        profiles = profiles.filter(Q(path__icontains=search) | Q(view_name__icontains=search))
+    
+    filter_params = request.GET.copy()
+    filter_params.pop('page', None)
+    
+    page_obj = Paginator(profiles, PROFILES_PER_PAGE).get_page(request.GET.get('page'))
+    context = {
+        'page_obj': page_obj,
+        'profiles': page_obj.object_list,
+        'sort': sort,
+        'search': search,
+        'filter_querystring': filter_params.urlencode(),
+    }
+    return render(request, 'shipping/profile_list.html', context)
+
+
+@login_required
+def profile_download(request, pk, kind):
+    """
+    Download a profile: `prof` is the pstats file (for snakeviz or
+    pstats.Stats), `txt` the call tree and allocation report.
+    """
+    if not request.user.is_admin():
+        messages.error(request, 'Only admin users can view request profiles.')
+        return redirect('shipping:dashboard')
+    
+    profile = get_object_or_404(RequestProfile, pk=pk)
+    if kind == 'prof':
+        response = HttpResponse(bytes(profile.stats), content_type='application/octet-stream')
+    else:
+        report = (
+            f'{profile.method} {profile.path}\n'
+            f'view={profile.view_name or "-"} status={profile.status_code} '
+            f'duration_ms={profile.duration_ms:.1f} queries={profile.query_count} '
+            f'peak_memory={profile.peak_memory}\n\n'
+            f'Call tree\n=========\n{profile.call_tree}\n'
+            f'Allocations held at the end of the request\n'
+            f'===========================================\n{profile.allocations}\n'
+        )
+        response = HttpResponse(report, content_type='text/plain; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="profile_{profile.pk}.{kind}"'
+    return response
+
+
 @login_required
 def download_csv_template(request):
     """Download CSV template for bulk user import"""